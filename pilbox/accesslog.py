@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+#
+# Copyright 2013 Adam Gschwender
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Writes a structured access log of the image requests.
+
+Every image request is logged as one line of JSON, e.g.
+
+    {"ts": 1381442212.61, "method": "GET", "uri": "/a/shop/MS5qcGc=",
+     "status": 200, "route": "a", "bucket": "shop", "cache": "miss",
+     "source_bytes": 48213, "source_width": 1200, "source_height": 800,
+     "bytes": 3821, "fetch": 0.0412, "queue": 0.0003, "resize": 0.0183,
+     "encode": 0.0021, "write": 0.0001, "total": 0.0644}
+
+Durations are in seconds, see pilbox.tracing for the stages. Pillow
+decodes while it resizes, so decode is only timed with the opencv
+backend. Records
+are handed to a background thread, which appends them to the log in
+batches, so the IOLoop never waits on the disk; records are dropped if
+the thread falls behind. Workers append to the same file, each batch in
+one write. The timestamp, method and uri are all that is needed to
+replay the log, e.g.
+
+    $ python -m pilbox.accesslog access.log > urls.txt
+    $ siege -f urls.txt
+"""
+
+from __future__ import absolute_import, division, print_function, \
+    with_statement
+
+import json
+import logging
+import os
+import sys
+import threading
+
+try:
+    from Queue import Empty, Full, Queue
+except ImportError:
+    from queue import Empty, Full, Queue
+
+logger = logging.getLogger("tornado.application")
+
+
+class AccessLog(object):
+    """Appends records to the log at path from a background thread, which
+    is started by the first write, i.e. after the server forks. At most
+    max_pending records wait to be written, more are dropped."""
+
+    def __init__(self, path, max_pending=10000, flush_interval=1.0):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.queue = Queue(max_pending)
+        self.dropped = 0
+        self.thread = None
+
+    def write(self, record):
+        """Queues record, a JSON serializable dict, to be written."""
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._run,
+                                           name="pilbox-access-log")
+            self.thread.daemon = True
+            self.thread.start()
+        try:
+            self.queue.put_nowait(record)
+        except Full:
+            self.dropped += 1
+
+    def close(self):
+        """Writes the queued records and stops the thread."""
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+
+    def _run(self):
+        while True:
+            try:
+                records = [self.queue.get(timeout=self.flush_interval)]
+            except Empty:
+                continue
+            try:
+                while len(records) < 1000:
+                    records.append(self.queue.get_nowait())
+            except Empty:
+                pass
+            done = None in records
+            self._append([r for r in records if r is not None])
+            if done:
+                return
+
+    def _append(self, records):
+        if not records:
+            return
+        data = "".join(json.dumps(r, sort_keys=True) + "\n"
+                       for r in records).encode("utf-8")
+        try:
+            fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT,
+                         0o644)
+            try:
+                while data:
+                    data = data[os.write(fd, data):]
+            finally:
+                os.close(fd)
+        except (IOError, OSError) as e:
+            logger.warn("Failed to write access log %s: %s" % (self.path, e))
+            self.dropped += len(records)
+
+
+def read_records(f):
+    """Yields the records of the access log file f, skipping lines that
+    are not JSON, e.g. a partial last line."""
+    for line in f:
+        try:
+            record = json.loads(line)
+        except ValueError:
+            continue
+        if isinstance(record, dict):
+            yield record
+
+
+def main():
+    """Prints the uris of the requests in the access logs given as
+    arguments, or on stdin, in the order they were made."""
+    paths = sys.argv[1:] or ["-"]
+    for path in paths:
+        f = sys.stdin if path == "-" else open(path)
+        try:
+            for record in read_records(f):
+                if record.get("uri"):
+                    print(record["uri"])
+        finally:
+            if f is not sys.stdin:
+                f.close()
+
+
+if __name__ == "__main__":
+    main()
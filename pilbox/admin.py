@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+#
+# Copyright 2013 Adam Gschwender
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Base of the administrative routes. Their query strings must be signed
+with the admin_key, see pilbox.signature, e.g.
+
+    $ python -m pilbox.signature --key=<admin_key> "bucket=shop"
+
+Only the query string is signed, so arguments are only read from it and
+requests with a body are rejected.
+"""
+
+from __future__ import absolute_import, division, print_function, \
+    with_statement
+
+import tornado.escape
+import tornado.web
+
+from pilbox import errors
+from pilbox.signature import verify_signature
+
+
+class AdminHandler(tornado.web.RequestHandler):
+    """Rejects requests unless an admin_key is configured and the query
+    string is signed with it. Errors are reported as JSON. Handlers read
+    their arguments with get_query_argument()."""
+
+    def prepare(self):
+        key = self.settings.get("admin_key")
+        if not key:
+            raise errors.SignatureError("Admin routes are disabled")
+        if not verify_signature(key, self.request.query):
+            raise errors.SignatureError("Invalid signature")
+        if self.request.body:
+            raise errors.UrlError("Arguments must be in the query string")
+
+    def write_json(self, value):
+        self.set_header("Cache-Control", "no-cache")
+        self.set_header("Content-Type", "application/json")
+        self.finish(tornado.escape.json_encode(value))
+
+    def write_error(self, status_code, **kwargs):
+        err = kwargs["exc_info"][1] if "exc_info" in kwargs else None
+        if isinstance(err, errors.PilboxError):
+            self.write_json(dict(status_code=status_code,
+                                 error_code=err.get_code(),
+                                 error=err.log_message))
+        else:
+            super(AdminHandler, self).write_error(status_code, **kwargs)
@@ -18,97 +18,647 @@ from __future__ import absolute_import, division, with_statement
 
 import base64
 import logging
+import multiprocessing
+import re
 import socket
+import time
+import uuid
 
+try:
+    from concurrent.futures import CancelledError, ThreadPoolExecutor
+except ImportError:
+    CancelledError = ThreadPoolExecutor = None
+
+try:
+    import pycurl
+except ImportError:
+    pycurl = None
+
+import tornado.concurrent
 import tornado.escape
 import tornado.gen
 import tornado.httpclient
 import tornado.httpserver
 import tornado.ioloop
 import tornado.options
+import tornado.process
 import tornado.web
 from tornado.options import define, options, parse_config_file
 
 from pilbox import errors
-from pilbox.image import Image
+from pilbox.accesslog import AccessLog
+from pilbox.backend import get_backend
+from pilbox.cache import FileCache, MemoryCache, SharedMemoryCache, \
+    TieredCache, make_key
+from pilbox.cluster import FORWARDED_HEADER, PeerRouter
+from pilbox.deadline import Deadline
+from pilbox.dedup import ContentIndex, hash_content
+from pilbox.health import HealthHandler, ReadyHandler
+from pilbox.image import ENCODER_DEFAULTS, Image, PixelBudget, \
+    QualityEstimator
+from pilbox.memory import MemoryHandler, PeakTracker, get_max_rss, \
+    get_rss, tracemalloc
+from pilbox.metrics import Metrics, MetricsHandler
+from pilbox.origin import OriginFetcher
+from pilbox.profiler import ProfileHandler, run_profiled
+from pilbox.purge import IndexedCache, PurgeHandler, PurgeIndex, \
+    get_index_dir
+from pilbox.resolver import CachingResolver
+from pilbox.store import ObjectStore
+from pilbox.tracing import TraceHandler, Tracer, make_trace
+from pilbox.warmup import Warmer, read_popular
+
+try:
+    from io import BytesIO
+except ImportError:
+    from cStringIO import StringIO as BytesIO
 
 # general settings
 define("config", help="path to configuration file",
        callback=lambda path: parse_config_file(path, final=False))
 define("debug", help="run in debug mode", type=bool, default=False)
 define("port", help="run on the given port", type=int, default=8888)
+define("admin_key", help="key admin requests are signed with, admin routes "
+       "are disabled without one")
+define("max_profile_seconds", help="max seconds a worker can be profiled for",
+       type=float, default=60)
+define("tracemalloc", help="trace allocations with this many frames from the "
+       "start, 0 to only trace once started by /debug/memory",
+       type=int, default=0)
+define("access_log", help="path of the JSON lines access log of images, "
+       "see pilbox.accesslog")
+define("access_log_buffer", help="max access log records waiting to be "
+       "written, more are dropped", type=int, default=10000)
+define("trace_threshold", help="seconds an image request must take for its "
+       "trace to be kept, 0 to not trace", type=float, default=1)
+define("trace_buffer", help="max traces kept per process",
+       type=int, default=100)
+define("warmup_file", help="popularity file of the uris to render at "
+       "startup, see pilbox.warmup")
+define("warmup_top", help="number of uris of the popularity file to render",
+       type=int, default=1000)
+define("warmup_concurrency", help="max concurrent warm-up requests",
+       type=int, default=2)
+define("warmup_seconds", help="seconds after startup to stop warming up",
+       type=float, default=60)
 
 # request related settings
 define("max_requests", help="max concurrent requests", type=int, default=40)
 define("timeout", help="request timeout in seconds", type=float, default=10)
+define("deadline", help="seconds to answer a request in, including fetching "
+       "and processing, 0 for no limit", type=float, default=0)
+define("max_batch_size", help="max images per multi-image request",
+       type=int, default=100)
 define("implicit_base_url", help="prepend protocol/host to url paths")
 define("validate_cert", help="validate certificates", type=bool, default=True)
+define("hedge", help="hedge slow origin fetches with a second request",
+       type=bool, default=False)
+define("hedge_delay", help="seconds to wait for headers before hedging, "
+       "0 for the rolling 95th percentile", type=float, default=0)
+define("hedge_ratio", help="max fraction of fetches that are hedged",
+       type=float, default=0.05)
 
 define("s3_root", help="HTTP address of S3 bucket", type=str, default=None)
 
+# dns related settings
+define("dns_ttl", help="seconds to cache resolved origin hosts, 0 to "
+       "resolve every fetch", type=float, default=60)
+define("dns_grace", help="seconds to use the last good addresses of a "
+       "host that fails to resolve", type=float, default=300)
+
+# image related settings
+define("backend", help="image backend: pillow or opencv", default="pillow")
+define("passthrough", help="serve JPEGs that already fit without re-encoding",
+       type=bool, default=False)
+define("strip_metadata", help="strip metadata from passed through JPEGs",
+       type=bool, default=True)
+define("render_threads", help="image processing threads per process, 0 to "
+       "process images on the IOLoop", type=int, default=0)
+define("max_render_queue", help="renders waiting for a thread above which "
+       "a process is not ready, 0 for no limit", type=int, default=8)
+define("max_pixel_memory", help="bytes of decoded pixels per process, "
+       "0 for no limit", type=int, default=0)
+define("pixel_memory_wait", help="seconds to wait for pixel memory",
+       type=float, default=5)
+
+# cache related settings
+define("cache_dir", help="directory of the on-disk render cache", type=str)
+define("shm_cache_size", help="bytes of shared memory render cache",
+       type=int, default=0)
+define("cache_ttl", help="seconds renders are fresh for, 0 for forever",
+       type=int, default=0)
+define("stale_while_revalidate", help="seconds past cache_ttl a render is "
+       "served while it is refreshed in the background", type=int, default=0)
+define("stale_if_error", help="seconds past cache_ttl a render is served "
+       "when the origin fails", type=int, default=0)
+define("index_dir", help="directory of the purge index, defaults to "
+       "<cache_dir>/index")
+define("dedup", help="render originals with identical content only once, "
+       "needs a cache", type=bool, default=False)
+define("varnish_url", help="url of the Varnish in front of pilbox, which "
+       "purges are sent to as bans")
+
+# cluster related settings
+define("cluster_peers", help="comma separated urls of all nodes, including "
+       "this one, to render each variant on one node only")
+define("cluster_self", help="url of this node as listed in cluster_peers")
+define("cluster_cache_size", help="bytes of renders from peers to keep",
+       type=int, default=64 * 1024 * 1024)
+define("cluster_cache_ttl", help="seconds to keep renders from peers",
+       type=float, default=60)
+
+# object store related settings
+define("store_url", help="url of an S3 compatible bucket/prefix renders are "
+       "written back to")
+define("store_access_key", help="access key of the store")
+define("store_secret_key", help="secret key of the store")
+define("store_region", help="region of the store", default="us-east-1")
+define("store_timeout", help="seconds to wait for the store",
+       type=float, default=2)
+define("store_max_clients", help="max concurrent requests to the store",
+       type=int, default=10)
+
 logger = logging.getLogger("tornado.application")
 
+# Encoder profiles of the image routes, which override ENCODER_DEFAULTS of
+# pilbox.image, see "python -m pilbox.test.benchmark profiles". Thumbnails
+# save about a fifth of the bytes of the defaults; progressive encoding,
+# which libjpeg always Huffman optimizes, saves about 5% on product shots
+# for several times the encode time. Mobile listings get the best quality
+# that fits in 8KB.
+PROFILES = dict(
+    thumbnail=dict(quality=80, optimize=True),
+    product=dict(progressive=True),
+    mobile=dict(quality=90, optimize=True, max_bytes=8 * 1024))
+
 class PilboxApplication(tornado.web.Application):
 
     def __init__(self, **kwargs):
         settings = dict(debug=options.debug,
+                        admin_key=options.admin_key,
+                        max_profile_seconds=options.max_profile_seconds,
+                        tracemalloc=options.tracemalloc,
+                        access_log=options.access_log,
+                        access_log_buffer=options.access_log_buffer,
+                        trace_threshold=options.trace_threshold,
+                        trace_buffer=options.trace_buffer,
+                        warmup_file=options.warmup_file,
+                        warmup_top=options.warmup_top,
+                        warmup_concurrency=options.warmup_concurrency,
+                        warmup_seconds=options.warmup_seconds,
                         max_requests=options.max_requests,
                         timeout=options.timeout,
+                        deadline=options.deadline,
+                        max_batch_size=options.max_batch_size,
                         implicit_base_url=options.implicit_base_url,
                         validate_cert=options.validate_cert,
-                        s3_root=options.s3_root)
+                        hedge=options.hedge,
+                        hedge_delay=options.hedge_delay,
+                        hedge_ratio=options.hedge_ratio,
+                        s3_root=options.s3_root,
+                        dns_ttl=options.dns_ttl,
+                        dns_grace=options.dns_grace,
+                        backend=options.backend,
+                        passthrough=options.passthrough,
+                        strip_metadata=options.strip_metadata,
+                        render_threads=options.render_threads,
+                        max_render_queue=options.max_render_queue,
+                        max_pixel_memory=options.max_pixel_memory,
+                        pixel_memory_wait=options.pixel_memory_wait,
+                        cache_dir=options.cache_dir,
+                        shm_cache_size=options.shm_cache_size,
+                        cache_ttl=options.cache_ttl,
+                        stale_while_revalidate=options.stale_while_revalidate,
+                        stale_if_error=options.stale_if_error,
+                        index_dir=options.index_dir,
+                        dedup=options.dedup,
+                        varnish_url=options.varnish_url,
+                        cluster_peers=options.cluster_peers,
+                        cluster_self=options.cluster_self,
+                        cluster_cache_size=options.cluster_cache_size,
+                        cluster_cache_ttl=options.cluster_cache_ttl,
+                        store_url=options.store_url,
+                        store_access_key=options.store_access_key,
+                        store_secret_key=options.store_secret_key,
+                        store_region=options.store_region,
+                        store_timeout=options.store_timeout,
+                        store_max_clients=options.store_max_clients)
         settings.update(kwargs)
         tornado.web.Application.__init__(self, self.get_handlers(), **settings)
+        # Fail at startup rather than on every request
+        get_backend(self.settings.get("backend"))
+        self.metrics = Metrics()
+        self.index = self.get_index()
+        self.cache = self.get_cache()
+        self.dedup = self.get_dedup()
+        # Keys being refreshed in the background by this worker
+        self.refreshing = set()
+        # Whether this worker is being profiled and, with cProfile, the
+        # profiles of the renders on the executor, see pilbox.profiler
+        self.profiling = False
+        self.render_profiles = None
+        if self.settings.get("tracemalloc") and tracemalloc is not None:
+            tracemalloc.start(self.settings["tracemalloc"])
+        self.memory = PeakTracker()
+        # The snapshot /debug/memory diffs are taken against
+        self.memory_snapshot = None
+        # Image requests being served and renders submitted to the
+        # executor, see pilbox.health
+        self.in_flight = 0
+        self.renders = 0
+        self.access_log = self.get_access_log()
+        self.tracer = self.get_tracer()
+        self.executor = self.get_executor()
+        self.pixel_budget = PixelBudget(self.settings.get("max_pixel_memory"))
+        self.quality_estimator = QualityEstimator()
+        self.fetcher = OriginFetcher(
+            hedge=self.settings.get("hedge"),
+            delay=self.settings.get("hedge_delay"),
+            ratio=self.settings.get("hedge_ratio"),
+            metrics=self.metrics)
+        self.metrics.gauge("origin.hedge_delay", self.fetcher.get_delay)
+        self.resolver = self.get_resolver()
+        self.router = self.get_router()
+        self.store = self.get_store()
+        # Set until the caches are warm, shared by all workers as it is
+        # created before the server forks, see warm_up()
+        self.warming = multiprocessing.RawValue("b", self.can_warm_up())
+        # Created on first use, see get_origin_client() and
+        # get_batch_client()
+        self.origin_client = None
+        self.batch_client = None
+        self.peer_cache = MemoryCache(
+            self.settings.get("cluster_cache_size") or 0,
+            self.settings.get("cluster_cache_ttl"))
+        self.metrics.gauge("pixel_memory.current",
+                           lambda: self.pixel_budget.current)
+        self.metrics.gauge("pixel_memory.peak",
+                           lambda: self.pixel_budget.peak)
+        self.metrics.gauge("pixel_memory.waiting",
+                           lambda: len(self.pixel_budget.waiters))
+        self.metrics.gauge("requests.in_flight", lambda: self.in_flight)
+        self.metrics.gauge("render.queue", lambda: max(
+            0, self.renders - (self.settings.get("render_threads") or 0)))
+        self.metrics.gauge("memory.rss", get_rss)
+        self.metrics.gauge("memory.max_rss", get_max_rss)
+        self.metrics.gauge("memory.request_peak",
+                           lambda: self.memory.max_peak)
+        if self.access_log:
+            self.metrics.gauge("access_log.dropped",
+                               lambda: self.access_log.dropped)
+        if self.dedup:
+            self.metrics.gauge("dedup.ratio", self.dedup.get_ratio)
+        self.metrics.gauge("byte_budget.searches",
+                           lambda: self.quality_estimator.searches)
+        self.metrics.gauge("byte_budget.hit_rate",
+                           self.quality_estimator.get_hit_rate)
+        self.metrics.gauge("byte_budget.encodes_per_search",
+                           self.quality_estimator.get_encodes_per_search)
+
+    def get_cache(self):
+        """Returns the render cache or None if caching is disabled. The
+        shared memory tier is allocated here, i.e. before the server forks,
+        so that all workers share it."""
+        caches = []
+        if self.settings.get("shm_cache_size"):
+            caches.append(SharedMemoryCache(self.settings["shm_cache_size"],
+                                            metrics=self.metrics))
+        if self.settings.get("cache_dir"):
+            caches.append(FileCache(self.settings["cache_dir"]))
+        if not caches:
+            return None
+        cache = TieredCache(caches) if len(caches) > 1 else caches[0]
+        if self.index:
+            cache = IndexedCache(cache, self.index,
+                                 self.settings.get("s3_root"))
+        return cache
+
+    def get_dedup(self):
+        """Returns the index of the content of originals renders are
+        shared by, or None if dedup is disabled or there is no cache."""
+        if not self.settings.get("dedup") or not self.cache:
+            return None
+        return ContentIndex(self.cache, self.settings.get("cache_ttl"))
+
+    def get_index(self):
+        """Returns the index of cached keys that purges are looked up in,
+        or None if there is nowhere to keep it."""
+        path = get_index_dir(self.settings.get("index_dir"),
+                             self.settings.get("cache_dir"))
+        return PurgeIndex(path) if path else None
+
+    def get_access_log(self):
+        """Returns the structured access log or None if it is disabled."""
+        if not self.settings.get("access_log"):
+            return None
+        return AccessLog(self.settings["access_log"],
+                         self.settings.get("access_log_buffer") or 10000)
+
+    def get_tracer(self):
+        """Returns the tracer of slow requests or None if it is disabled."""
+        if not self.settings.get("trace_threshold"):
+            return None
+        return Tracer(self.settings["trace_threshold"],
+                      self.settings.get("trace_buffer") or 100)
+
+    def log_request(self, handler):
+        super(PilboxApplication, self).log_request(handler)
+        if not isinstance(handler, ImageHandler):
+            return
+        if self.access_log:
+            self.access_log.write(handler.get_access_record())
+        if self.tracer and self.tracer.keeps(
+                handler.get_status(), handler.request.request_time()):
+            self.tracer.add(handler.get_trace())
+            self.metrics.incr("traces.kept")
+
+    def can_warm_up(self):
+        """Returns whether the caches are warmed up at startup. Renders
+        that are neither cached nor stored would be lost, so without a
+        cache or store the warm-up would only delay readiness."""
+        if not self.settings.get("warmup_file"):
+            return False
+        if not self.cache and not self.store:
+            logger.warn("Ignoring warmup_file without a cache or store")
+            return False
+        return True
+
+    @tornado.gen.coroutine
+    def warm_up(self, base_url):
+        """Renders the top uris of the popularity file by requesting them
+        from the server at base_url, then marks all workers ready. Run by
+        one worker only."""
+        start = time.time()
+        try:
+            with open(self.settings["warmup_file"]) as f:
+                uris = read_popular(f, self.settings.get("warmup_top"))
+            warmer = Warmer(
+                base_url, uris,
+                concurrency=self.settings.get("warmup_concurrency") or 1,
+                seconds=self.settings.get("warmup_seconds") or 0,
+                timeout=self.settings.get("timeout"), metrics=self.metrics)
+            stats = yield warmer.run()
+            logger.info("Warmed up %d of %d uris (%d errors) in %.1fs"
+                        % (stats["requests"], len(uris), stats["errors"],
+                           time.time() - start))
+        except Exception as e:
+            logger.warn("Warm-up failed: %s" % e)
+        finally:
+            self.warming.value = False
+
+    def get_store(self):
+        """Returns the object store renders are written back to or None."""
+        if not self.settings.get("store_url"):
+            return None
+        return ObjectStore(self.settings["store_url"],
+                           access_key=self.settings.get("store_access_key"),
+                           secret_key=self.settings.get("store_secret_key"),
+                           region=self.settings.get("store_region"),
+                           timeout=self.settings.get("store_timeout"),
+                           max_clients=self.settings.get("store_max_clients"),
+                           metrics=self.metrics)
+
+    def get_router(self):
+        """Returns the router to the other nodes of the cluster or None if
+        this node is not part of one."""
+        peers = self.settings.get("cluster_peers")
+        if not peers:
+            return None
+        return PeerRouter([peer.strip() for peer in peers.split(",")],
+                          self.settings.get("cluster_self") or "",
+                          max_clients=self.settings.get("max_requests"))
+
+    def get_resolver(self):
+        """Returns the resolver for origin hosts or None for Tornado's
+        default. Lookups are made from the IOLoop, so the cache is local
+        to each worker."""
+        if not self.settings.get("dns_ttl"):
+            return None
+        return CachingResolver(ttl=self.settings["dns_ttl"],
+                               grace=self.settings.get("dns_grace") or 0,
+                               metrics=self.metrics)
+
+    def get_executor(self):
+        """Returns the executor images are processed on, so that the IOLoop
+        keeps serving while Pillow, which releases the GIL, decodes and
+        encodes. Threads are only started on first use, i.e. after the
+        server forks. None processes images on the IOLoop."""
+        threads = self.settings.get("render_threads")
+        if not threads or ThreadPoolExecutor is None:
+            return None
+        return ThreadPoolExecutor(threads)
+
+    def get_origin_client(self):
+        """Returns the client originals are fetched with. It is an instance
+        of its own rather than the IOLoop's shared one, whose settings are
+        those of whoever created it first, so that max_requests and the
+        resolver always apply. It is created on first use, i.e. in the
+        worker after the server forked."""
+        if self.origin_client is None:
+            kwargs = dict(force_instance=True,
+                          max_clients=self.settings.get("max_requests"))
+            if self.resolver:
+                kwargs["resolver"] = self.resolver
+            self.origin_client = tornado.httpclient.AsyncHTTPClient(**kwargs)
+        return self.origin_client
+
+    def close(self):
+        """Closes the clients of this worker and stops its render and
+        access log threads."""
+        for client in (self.origin_client, self.batch_client):
+            if client is not None:
+                client.close()
+        self.origin_client = self.batch_client = None
+        if self.store:
+            self.store.close()
+        if self.executor:
+            # Queued renders are dropped, running ones finish on their own
+            self.executor.shutdown(wait=False)
+        if self.access_log:
+            self.access_log.close()
+
+    def get_batch_client(self):
+        """Returns the client multi-image requests fetch originals with.
+        With pycurl installed, this is curl, which keeps the connections
+        to the origin alive between the fetches of a batch; it is created
+        on first use, i.e. in the worker after the server forked.
+        Otherwise it is the origin client, which opens a connection per
+        fetch."""
+        if pycurl is None:
+            return self.get_origin_client()
+        if self.batch_client is None:
+            from tornado.curl_httpclient import CurlAsyncHTTPClient
+            self.batch_client = CurlAsyncHTTPClient(
+                force_instance=True,
+                max_clients=self.settings.get("max_requests"))
+        return self.batch_client
+
+    def get_route_params(self, external=None):
+        """Returns the distinct render parameters of the image routes, see
+        get_render_params(). If external is set, only those of the routes
+        of external originals, or only of the others."""
+        routes = []
+        for spec in self.get_handlers():
+            if len(spec) < 3 or spec[1] is not ImageHandler:
+                continue
+            kwargs = spec[2]
+            if external is not None and \
+                    bool(kwargs.get("external")) != external:
+                continue
+            params = get_render_params(**kwargs)
+            if params not in routes:
+                routes.append(params)
+        return routes
 
     def get_handlers(self):
-        return [(r"/a/([\w-]+)/(.*)", ImageHandler, dict(w=100, h=100)),
-                (r"/b/([\w-]+)/(.*)", ImageHandler, dict(w=500, h=500)),
-                (r"/c/(.*)", ImageHandler, dict(w=100, h=100, external=True)),
-                (r"/d/(.*)", ImageHandler, dict(w=500, h=500, external=True))
+        thumbnail = dict(w=100, h=100, profile="thumbnail")
+        product = dict(w=500, h=500, profile="product")
+        return [(r"/metrics", MetricsHandler),
+                (r"/health", HealthHandler),
+                (r"/ready", ReadyHandler),
+                (r"/purge", PurgeHandler),
+                (r"/debug/profile", ProfileHandler),
+                (r"/debug/memory", MemoryHandler),
+                (r"/debug/traces", TraceHandler),
+                (r"/multi/(a|b)", MultiImageHandler,
+                 dict(routes=dict(a=thumbnail, b=product))),
+                (r"/a/([\w-]+)/(.*)", ImageHandler, thumbnail),
+                (r"/b/([\w-]+)/(.*)", ImageHandler, product),
+                (r"/c/(.*)", ImageHandler,
+                 dict(w=100, h=100, external=True, profile="thumbnail")),
+                (r"/d/(.*)", ImageHandler,
+                 dict(w=500, h=500, external=True, profile="product"))
         ]
 
 
+class PeerError(Exception):
+    """Raised with the error response of the peer that owns a render."""
+
+    def __init__(self, response):
+        super(PeerError, self).__init__("status %d" % response.code)
+        self.response = response
+
+
 class ImageHandler(tornado.web.RequestHandler):
     w = None
     h = None
     external = False
+    fast_resample = False
+    profile = None
 
-    def initialize(self, w, h, external=False):
+    def initialize(self, w, h, external=False, fast_resample=False,
+                   profile=None):
         self.w = w
         self.h = h
         self.external = external
+        self.fast_resample = fast_resample
+        self.profile = profile
+        # Done once the client has gone away and the work can be dropped
+        self._abort = tornado.concurrent.Future()
+        self._deadline = Deadline(self.settings.get("deadline"))
+        self._memory = self.application.memory.begin()
+        self.application.in_flight += 1
+        # Peak bytes of traced memory while the request ran, if traced
+        self.memory_peak = None
+        # Fields of the access log record, see get_access_record()
+        self.access = dict()
+        # (stage, start, end) times of the request, see get_trace()
+        self.spans = []
+        # Message of the error the request failed with
+        self.error = None
 
     @tornado.gen.coroutine
     def get(self, arg1, arg2=None):
         if self.external:
-            url = base64.b64decode(arg1).replace(" ", "%20")
+            url = _b64decode(arg1).replace(" ", "%20")
         else:
-            filename = base64.b64decode(arg2).replace(" ", "%20")
+            filename = _b64decode(arg2).replace(" ", "%20")
             url = "%s/%s/product-pictures/%s" % (self.settings["s3_root"], arg1, filename)
+            self.access["bucket"] = arg1
 
-        client = tornado.httpclient.AsyncHTTPClient(
-            max_clients=self.settings.get("max_requests"))
+        params = get_render_params(self.w, self.h, self.fast_resample,
+                                   self.profile)
+        key = make_key(url, **params)
         try:
-            resp = yield client.fetch(
-                url,
-                request_timeout=self.settings.get("timeout"),
-                validate_cert=self.settings.get("validate_cert"))
-        except (socket.gaierror, tornado.httpclient.HTTPError) as e:
-            logger.warn("Fetch error for %s: %s"
-                        % (url, str(e)))
-            raise errors.FetchError()
+            outfile = yield self._load(url, key, self.request.uri)
+        except PeerError as e:
+            # Errors of the owner, e.g. a missing original, are final
+            self.set_status(e.response.code, e.response.reason)
+            for name in ("Content-Type", "Cache-Control"):
+                if name in e.response.headers:
+                    self.set_header(name, e.response.headers[name])
+            self.finish(e.response.body)
+            return
+        self._write_image(outfile)
 
-        outfile = self._process_response(resp)
-        self._set_headers()
+    @tornado.gen.coroutine
+    def _load(self, url, key, uri):
+        """Returns a buffer to the render of url, which is cached under key
+        and requested at uri. It is taken from the cache, the peer that
+        owns it, the store or rendered, in this order. Raises a PeerError
+        if the owner fails it."""
+        cache = self.application.cache
+        entry = cache.get(key) if cache else None
+        outfile = self._get_cached(url, key, entry) if entry else None
+        if outfile:
+            raise tornado.gen.Return(outfile)
+        if not entry:
+            outfile = self._get_alias(url, key)
+            if outfile:
+                raise tornado.gen.Return(outfile)
 
-        for block in iter(lambda: outfile.read(65536), b""):
-            self.write(block)
-        outfile.close()
+        owner = self._get_owner(key)
+        if owner:
+            outfile = yield self._forward(owner, key, uri)
+            if outfile:
+                self._log_cache("peer")
+                raise tornado.gen.Return(outfile)
 
-        self.finish()
+        client = self._get_client()
+        store = self.application.store
+        if store and not entry:
+            self._deadline.check("store")
+            start = time.time()
+            entry = yield store.get(key, timeout=self._deadline.limit(
+                self.settings.get("store_timeout")))
+            self._add_span("store", start)
+            if entry:
+                if cache:
+                    cache.set(key, entry.body, entry.created)
+                outfile = self._get_cached(url, key, entry)
+                if outfile:
+                    self._log_cache("store")
+                    raise tornado.gen.Return(outfile)
+
+        outfile = yield self._render(client, url, key, stale=entry)
+        raise tornado.gen.Return(outfile)
+
+    def _get_client(self):
+        return self.application.get_origin_client()
+
+    def finish(self, chunk=None):
+        # Before the request is logged, see get_access_record()
+        if self._memory is not None:
+            self.memory_peak = self.application.memory.end(self._memory)
+            self._memory = None
+        return super(ImageHandler, self).finish(chunk)
+
+    def on_finish(self):
+        self.application.in_flight -= 1
+
+    def on_connection_close(self):
+        # Renders that are written to the cache are still worth finishing
+        if self._abort.done() or self.application.cache:
+            return
+        self.application.metrics.incr("requests.cancelled")
+        self._abort.set_result(None)
 
     def write_error(self, status_code, **kwargs):
         err = kwargs["exc_info"][1] if "exc_info" in kwargs else None
+        if err is not None:
+            self.error = getattr(err, "log_message", None) or str(err)
+        if isinstance(err, errors.DeadlineError):
+            self.application.metrics.incr("deadline.%s" % err.stage)
         if isinstance(err, errors.PilboxError):
             # Don't cache error responses:
             self.set_header('Cache-Control', 'no-cache')
@@ -120,27 +670,565 @@ class ImageHandler(tornado.web.RequestHandler):
         else:
             super(ImageHandler, self).write_error(status_code, **kwargs)
 
-    def _process_response(self, resp):
-        image = Image(resp.buffer)
-        image.resize(self.w, self.h)
-        return image.save()
+    def _get_cached(self, url, key, entry):
+        """Returns a buffer to entry if it is fresh, or stale by less than
+        the stale-while-revalidate period, in which case it is refreshed in
+        the background. Returns None otherwise."""
+        age = self._get_age(entry)
+        ttl = self.settings.get("cache_ttl")
+        if age is None or age < ttl:
+            self._log_cache("hit")
+            return BytesIO(entry.body)
+        if age < ttl + (self.settings.get("stale_while_revalidate") or 0):
+            self.application.metrics.incr("cache.stale_while_revalidate")
+            self._log_cache("stale")
+            self._refresh(url, key, entry)
+            return BytesIO(entry.body)
+        return None
+
+    def _get_age(self, entry):
+        """Returns the seconds entry has been stale for, or None if it
+        cannot become stale."""
+        if not self.settings.get("cache_ttl") or entry.created is None:
+            return None
+        return time.time() - entry.created
+
+    def _refresh(self, url, key, entry):
+        """Renders key again in the background, unless that is already
+        being done by this worker."""
+        refreshing = self.application.refreshing
+        if key in refreshing:
+            return
+        refreshing.add(key)
+        # The request has been answered, the refresh gets its own deadline.
+        # Others, e.g. the other images of a /multi request, keep theirs.
+        deadline = Deadline(self.settings.get("deadline"))
+        client = self._get_client()
+
+        def done(future):
+            refreshing.discard(key)
+            try:
+                future.result()
+            except Exception as e:
+                logger.warn("Refresh of %s failed: %s" % (url, e))
+        tornado.ioloop.IOLoop.current().add_future(
+            self._render(client, url, key, stale=entry, deadline=deadline),
+            done)
+
+    @tornado.gen.coroutine
+    def _render(self, client, url, key, stale=None, deadline=None):
+        """Fetches and renders url, stores the output under key and returns
+        a buffer to it. A stale entry is revalidated with the origin, and
+        served if the origin fails within the stale-if-error period. The
+        deadline is that of the request unless given."""
+        if deadline is None:
+            deadline = self._deadline
+        kwargs = dict(
+            request_timeout=deadline.limit(self.settings.get("timeout")),
+            validate_cert=self.settings.get("validate_cert"))
+        if stale and stale.created:
+            kwargs["if_modified_since"] = stale.created
+        cache = self.application.cache
+        metrics = self.application.metrics
+
+        deadline.check("fetch")
+        start = time.time()
+        try:
+            resp = yield self.application.fetcher.fetch(
+                client, url, abort=self._abort, **kwargs)
+        except errors.ClientClosedError:
+            metrics.incr("cancelled.fetch")
+            raise
+        except (socket.gaierror, tornado.httpclient.HTTPError) as e:
+            code = getattr(e, "code", None)
+            self._add_span("fetch", start)
+            if stale and code == 304:
+                metrics.incr("cache.revalidated")
+                self._log_cache("revalidated")
+                if cache:
+                    cache.set(key, stale.body)
+                raise tornado.gen.Return(BytesIO(stale.body))
+            if stale and self._can_serve_stale(stale, code):
+                metrics.incr("cache.stale_if_error")
+                self._log_cache("stale_if_error")
+                logger.warn("Serving stale %s on fetch error: %s"
+                            % (url, str(e)))
+                raise tornado.gen.Return(BytesIO(stale.body))
+            deadline.check("fetch")
+            logger.warn("Fetch error for %s: %s"
+                        % (url, str(e)))
+            raise errors.FetchError()
+
+        self._add_span("fetch", start)
+        if self._abort.done():
+            raise errors.ClientClosedError()
+        dedup = self.application.dedup
+        digest = None
+        if dedup:
+            digest = yield self._hash(resp.body)
+        outfile = self._get_alias(url, key, digest) if digest else None
+        if not outfile:
+            self._log_cache("miss")
+            outfile = yield self._process_response(resp, deadline)
+            if cache:
+                cache.set(key, outfile.getvalue())
+            if digest:
+                dedup.misses += 1
+                dedup.set_url(digest, url, **get_render_params(
+                    self.w, self.h, self.fast_resample, self.profile))
+        if digest:
+            # Only once the render of url has been replaced
+            dedup.set_digest(url, digest)
+        if self.application.store:
+            self.application.store.put(key, outfile.getvalue())
+        raise tornado.gen.Return(outfile)
+
+    @tornado.gen.coroutine
+    def _hash(self, body):
+        """Returns the digest of the original body, which is hashed on the
+        executor if there is one, as SHA-1 takes a while for large
+        originals."""
+        executor = self.application.executor
+        if executor:
+            digest = yield executor.submit(hash_content, body)
+        else:
+            digest = hash_content(body)
+        raise tornado.gen.Return(digest)
+
+    def _get_alias(self, url, key, digest=None):
+        """Returns a buffer to the cached render of an alias of url, i.e.
+        an original with the same content, which is copied to key. Returns
+        None if there is none. The digest of url is looked up unless
+        given."""
+        dedup = self.application.dedup
+        if not dedup:
+            return None
+        digest = digest or dedup.get_digest(url)
+        if not digest:
+            return None
+        params = get_render_params(self.w, self.h, self.fast_resample,
+                                   self.profile)
+        alias = dedup.get_url(digest, **params)
+        if not alias or alias == url:
+            return None
+        entry = self.application.cache.get(make_key(alias, **params))
+        if not entry:
+            return None
+        age = self._get_age(entry)
+        if age is not None and age >= self.settings.get("cache_ttl"):
+            return None
+        dedup.hits += 1
+        self._log_cache("dedup")
+        self.application.cache.set(key, entry.body)
+        return BytesIO(entry.body)
+
+    def _can_serve_stale(self, entry, code):
+        """Returns whether entry may be served after a fetch error with
+        status code, which is None for connection errors. Originals that
+        are missing or forbidden are not served stale."""
+        if code is not None and code < 500:
+            return False
+        return self._get_age(entry) < self.settings.get("cache_ttl") + \
+            (self.settings.get("stale_if_error") or 0)
+
+    @tornado.gen.coroutine
+    def _process_response(self, resp, deadline):
+        params = get_render_params(self.w, self.h, self.fast_resample,
+                                   self.profile)
+        params.update(get_render_options(self.settings))
+        params["estimator"] = self.application.quality_estimator
+        image = Image(resp.buffer, get_backend(params.pop("backend")))
+        self._log_source(len(resp.body), image.get_source_size())
+        nbytes = image.get_decode_size()
+        if params["passthrough"] and image.can_passthrough(
+                self.w, self.h, params["strip_metadata"]):
+            nbytes = 0
+
+        budget = self.application.pixel_budget
+        wait = deadline.limit(self.settings.get("pixel_memory_wait"))
+        reservation = budget.reserve(nbytes, wait)
+        self._on_abort(lambda: budget.cancel(
+            reservation, errors.ClientClosedError()), "pixel_memory")
+        try:
+            yield reservation
+        except errors.PixelMemoryError:
+            deadline.check("pixel_memory")
+            raise
+        timings = params["timings"] = dict()
+        try:
+            executor = self.application.executor
+            if executor:
+                outfile = yield self._submit(executor, image, params,
+                                             deadline)
+            else:
+                outfile = render_image(image, deadline=deadline, **params)
+        finally:
+            budget.release(nbytes)
+            for stage in ("decode", "resize", "encode"):
+                if stage in timings:
+                    self._add_span(stage, *timings[stage])
+        raise tornado.gen.Return(outfile)
+
+    @tornado.gen.coroutine
+    def _submit(self, executor, image, params, deadline):
+        """Renders image on executor. The render is dropped if it is still
+        queued when the client goes away or the deadline passes."""
+        submitted = time.time()
+        profiles = self.application.render_profiles
+        if profiles is not None:
+            task = executor.submit(run_profiled, profiles, render_image,
+                                   image, deadline=deadline, **params)
+        else:
+            task = executor.submit(render_image, image, deadline=deadline,
+                                   **params)
+        self.application.renders += 1
+        self._on_abort(task.cancel, "queue")
+        io_loop = tornado.ioloop.IOLoop.current()
+        remaining = deadline.remaining()
+        timeout = None
+        if remaining is not None:
+            timeout = io_loop.add_timeout(io_loop.time() + remaining,
+                                          task.cancel)
+        try:
+            outfile = yield task
+        except CancelledError:
+            if self._abort.done():
+                raise errors.ClientClosedError()
+            raise errors.DeadlineError("Deadline exceeded in queue",
+                                       stage="queue")
+        finally:
+            self.application.renders -= 1
+            if timeout is not None:
+                io_loop.remove_timeout(timeout)
+            # Until the render started, or now if it never did
+            started = params.get("timings", dict()).get("render")
+            self._add_span("queue", submitted, started and started[0])
+        raise tornado.gen.Return(outfile)
+
+    def _get_owner(self, key):
+        """Returns the url of the peer that renders key or None if it is
+        rendered here."""
+        router = self.application.router
+        if not router or self.request.headers.get(FORWARDED_HEADER):
+            return None
+        return router.get_owner(key)
+
+    @tornado.gen.coroutine
+    def _forward(self, owner, key, uri):
+        """Returns a buffer to the render of key from owner, which is
+        requested at uri, or None if the owner cannot be reached or fails,
+        in which case it is rendered locally. Other errors of the owner
+        raise a PeerError."""
+        metrics = self.application.metrics
+        peer_cache = self.application.peer_cache
+        entry = peer_cache.get(key)
+        if entry:
+            metrics.incr("cluster.peer_cache_hits")
+            raise tornado.gen.Return(BytesIO(entry.body))
+
+        self._deadline.check("forward")
+        start = time.time()
+        try:
+            resp = yield self.application.router.forward(
+                owner, uri, request_timeout=self._deadline.limit(
+                    self.settings.get("timeout")))
+        except (socket.error, tornado.httpclient.HTTPError) as e:
+            resp = None
+            error = str(e)
+        else:
+            error = "status %d" % resp.code if resp.code >= 500 else None
+        self._add_span("forward", start)
+        if error:
+            logger.warn("Forward to %s failed: %s" % (owner, error))
+            metrics.incr("cluster.fallbacks")
+            raise tornado.gen.Return(None)
+
+        metrics.incr("cluster.forwarded")
+        if resp.code != 200:
+            raise PeerError(resp)
+        peer_cache.set(key, resp.body)
+        raise tornado.gen.Return(BytesIO(resp.body))
+
+    def _on_abort(self, cancel, stage):
+        """Runs cancel once the client has gone away and counts it as a
+        cancellation of stage if it returns True."""
+        def callback(future):
+            if cancel():
+                self.application.metrics.incr("cancelled.%s" % stage)
+        self._abort.add_done_callback(callback)
+
+    def _write_image(self, outfile):
+        start = time.time()
+        self._set_headers()
+
+        size = 0
+        for block in iter(lambda: outfile.read(65536), b""):
+            self.write(block)
+            size += len(block)
+        outfile.close()
+        self.access["bytes"] = size
+        # The request is logged by finish()
+        self._add_span("write", start)
+
+        self.finish()
+
+    def get_access_record(self):
+        """Returns the access log record of the finished request, see
+        pilbox.accesslog."""
+        record = dict(ts=self.request._start_time,
+                      method=self.request.method,
+                      uri=self.request.uri,
+                      status=self.get_status(),
+                      route=self.request.path.split("/")[1],
+                      total=self.request.request_time())
+        if self.memory_peak is not None:
+            record["memory_peak"] = self.memory_peak
+        record.update(self.access)
+        return record
+
+    def _log_cache(self, status):
+        """Records where the render came from: hit, stale, dedup, peer,
+        store, revalidated, stale_if_error or miss, i.e. rendered."""
+        self.access["cache"] = status
+
+    def _log_source(self, nbytes, size):
+        self.access["source_bytes"] = nbytes
+        self.access["source_width"], self.access["source_height"] = size
+
+    def get_trace(self):
+        """Returns the trace of the finished request, see
+        pilbox.tracing."""
+        return make_trace(self.request._start_time, self.spans,
+                          uri=self.request.uri, status=self.get_status(),
+                          total=self.request.request_time(),
+                          error=self.error)
+
+    def _add_span(self, stage, start, end=None):
+        """Records that stage ran from start to end, by default now. The
+        time spent in each stage is also logged to the access log."""
+        end = time.time() if end is None else end
+        self.spans.append((stage, start, end))
+        self.access[stage] = self.access.get(stage, 0) + end - start
 
     def _set_headers(self):
         self.set_header('Content-Type', "image/jpeg")
-        self.set_header('Cache-Control', "public, max-age=31536000") # 1 year
+        self.set_header('Cache-Control', get_cache_control(self.settings))
+
+
+class MultiImageHandler(ImageHandler):
+    """Serves the renders of several originals of one bucket route, e.g.
+    /multi/a?i=<bucket>/<base64 filename>&i=... for a category page. The
+    renders are loaded concurrently, as the route would, and returned in
+    request order as the parts of a multipart/mixed response. Each part
+    has the path of the render in its Content-Location and its status in
+    X-Pilbox-Status; parts of failed renders carry the JSON error. The
+    filenames may also be urlsafe base64. The response is never cached
+    downstream, since purges only ban the paths of the bucket routes."""
+
+    def initialize(self, routes):
+        super(MultiImageHandler, self).initialize(None, None)
+        self.routes = routes
+
+    @tornado.gen.coroutine
+    def get(self, route):
+        items = self.get_arguments("i")
+        if not items:
+            raise errors.UrlError("Missing images")
+        if len(items) > self.settings.get("max_batch_size"):
+            raise errors.UrlError("More than %d images"
+                                  % self.settings["max_batch_size"])
+        kwargs = self.routes[route]
+        self.w, self.h = kwargs["w"], kwargs["h"]
+        self.fast_resample = kwargs.get("fast_resample", False)
+        self.profile = kwargs.get("profile")
+
+        parts = yield [self._load_part(route, item) for item in items]
+        self.application.metrics.incr("multi.requests")
+        self.application.metrics.incr("multi.images", len(parts))
+        self.access["images"] = len(parts)
+        self.access["bytes"] = sum(len(body) for _, _, _, body in parts)
+
+        boundary = uuid.uuid4().hex
+        self.set_header("Content-Type",
+                        "multipart/mixed; boundary=%s" % boundary)
+        self.set_header("Cache-Control", "no-store")
+        for uri, status, content_type, body in parts:
+            head = ("--%s\r\nContent-Type: %s\r\nContent-Location: %s\r\n"
+                    "Content-Length: %d\r\nX-Pilbox-Status: %d\r\n\r\n"
+                    % (boundary, content_type, uri, len(body), status))
+            self.write(head.encode("utf-8"))
+            self.write(body)
+            self.write(b"\r\n")
+        self.finish(("--%s--\r\n" % boundary).encode("utf-8"))
+
+    @tornado.gen.coroutine
+    def _load_part(self, route, item):
+        """Returns (uri, status, content type, body) of the render of item,
+        i.e. <bucket>/<base64 filename>."""
+        # An unescaped "+" in the query string arrives as a space
+        item = item.replace(" ", "+")
+        uri = "/%s/%s" % (route, item)
+        try:
+            bucket, _, arg = item.partition("/")
+            if not re.match(r"^[\w-]+$", bucket):
+                raise errors.UrlError("Invalid bucket: %s" % bucket)
+            try:
+                name = base64.urlsafe_b64decode(arg)
+                filename = name.decode("utf-8").replace(" ", "%20")
+            except (TypeError, ValueError):
+                raise errors.UrlError("Invalid filename: %s" % arg)
+            # The path of the route, which peers and the bans of purges
+            # only know in standard base64
+            uri = "/%s/%s/%s" % (route, bucket,
+                                 base64.b64encode(name).decode("ascii"))
+            url = "%s/%s/product-pictures/%s" % (
+                self.settings["s3_root"], bucket, filename)
+            key = make_key(url, **get_render_params(
+                self.w, self.h, self.fast_resample, self.profile))
+            outfile = yield self._load(url, key, uri)
+        except PeerError as e:
+            resp = e.response
+            part = (resp.code, resp.headers.get("Content-Type"), resp.body)
+        except errors.PilboxError as e:
+            if isinstance(e, errors.DeadlineError):
+                self.application.metrics.incr("deadline.%s" % e.stage)
+            error = dict(status_code=e.status_code, error_code=e.get_code(),
+                         error=e.log_message)
+            part = (e.status_code, "application/json",
+                    tornado.escape.json_encode(error).encode("utf-8"))
+        except Exception:
+            logger.exception("Failed to render %s" % uri)
+            part = (500, "application/json",
+                    tornado.escape.json_encode(dict(status_code=500))
+                    .encode("utf-8"))
+        else:
+            part = (200, "image/jpeg", outfile.getvalue())
+        raise tornado.gen.Return((uri,) + part)
+
+    def _get_client(self):
+        return self.application.get_batch_client()
+
+    def _log_cache(self, status):
+        # Counts the renders of the parts by where they came from
+        counts = self.access.setdefault("cache", dict())
+        counts[status] = counts.get(status, 0) + 1
+
+    def _log_source(self, nbytes, size):
+        self.access["source_bytes"] = \
+            self.access.get("source_bytes", 0) + nbytes
+
+
+def get_cache_control(settings):
+    """Returns the Cache-Control header of images, which tells downstream
+    caches to apply the same stale policy as pilbox."""
+    max_age = settings.get("cache_ttl") or 31536000 # 1 year
+    value = "public, max-age=%d" % max_age
+    for name in ("stale_while_revalidate", "stale_if_error"):
+        if settings.get(name):
+            value += ", %s=%d" % (name.replace("_", "-"), settings[name])
+    return value
+
+
+def get_render_params(w, h, fast_resample=False, profile=None, **kwargs):
+    """Returns the arguments to render() for an image route. These are
+    also what the route's cache keys are made of, so options left at their
+    defaults are omitted to keep existing keys stable. The profile is the
+    name of one of PROFILES or a dict of encoder settings."""
+    params = dict(w=w, h=h)
+    if fast_resample:
+        params["fast_resample"] = True
+    if profile is not None and not isinstance(profile, dict):
+        profile = PROFILES[profile]
+    for name, value in (profile or dict()).items():
+        if name not in ENCODER_DEFAULTS:
+            raise ValueError("Unknown encoder setting: %s" % name)
+        if value != ENCODER_DEFAULTS[name]:
+            params[name] = value
+    return params
+
+
+def get_render_options(settings):
+    """Returns the deployment wide arguments to render() from the
+    application settings or the options."""
+    return dict(backend=settings.get("backend"),
+                passthrough=settings.get("passthrough"),
+                strip_metadata=settings.get("strip_metadata"))
+
+
+def render(stream, w, h, fast_resample=False, backend=None,
+           passthrough=False, strip_metadata=False, **encoder):
+    """Resizes the image in stream to fit w x h, returns a buffer to the
+    encoded output. Shared by the server and the offline tools. With
+    passthrough, JPEGs that already fit are returned without re-encoding,
+    optionally stripped of metadata. Other keyword arguments are encoder
+    settings, see pilbox.image.Image.save."""
+    return render_image(Image(stream, get_backend(backend)), w, h,
+                        fast_resample=fast_resample, passthrough=passthrough,
+                        strip_metadata=strip_metadata, **encoder)
+
+
+def render_image(image, w, h, fast_resample=False, passthrough=False,
+                 strip_metadata=False, deadline=None, timings=None,
+                 **encoder):
+    """Renders an opened pilbox.image.Image, see render(). If a deadline
+    is given, it is checked before decoding and before encoding. Byte
+    budgets are searched with the QualityEstimator given as estimator.
+    If timings is a dict, the start and end times of the decode, resize
+    and encode stages are stored in it by stage, as is the start of the
+    render under "render". Backends that decode lazily, i.e. Pillow,
+    decode while resizing, so there is no decode stage."""
+    if timings is not None:
+        timings["render"] = (time.time(), None)
+    if deadline:
+        deadline.check("decode")
+    if passthrough and image.can_passthrough(w, h, strip_metadata):
+        return image.passthrough(strip_metadata)
+    start = time.time()
+    image.decode(w, h, fast=fast_resample)
+    if image.backend.decodes_lazily:
+        decoded = start
+    else:
+        decoded = _time_stage(timings, "decode", start)
+    image.resize(w, h, fast=fast_resample)
+    resized = _time_stage(timings, "resize", decoded)
+    if deadline:
+        deadline.check("encode")
+    outfile = image.save(**encoder)
+    _time_stage(timings, "encode", resized)
+    return outfile
+
+
+def _time_stage(timings, stage, start):
+    """Stores the start and end, i.e. now, of stage in timings if it is a
+    dict, returns the end."""
+    end = time.time()
+    if timings is not None:
+        timings[stage] = (start, end)
+    return end
+
+
+def _b64decode(s):
+    return base64.b64decode(s).decode("utf-8")
+
 
 def main():
     tornado.options.parse_command_line()
     if options.debug:
         logger.setLevel(logging.DEBUG)
-    server = tornado.httpserver.HTTPServer(PilboxApplication())
+    app = PilboxApplication()
+    server = tornado.httpserver.HTTPServer(app)
     logger.info("Starting server...")
     try:
         server.bind(options.port)
         server.start(1 if options.debug else 0)
+        if app.warming.value and tornado.process.task_id() in (None, 0):
+            tornado.ioloop.IOLoop.instance().add_callback(
+                app.warm_up, "http://127.0.0.1:%d" % options.port)
         tornado.ioloop.IOLoop.instance().start()
     except KeyboardInterrupt:
         tornado.ioloop.IOLoop.instance().stop()
+    finally:
+        app.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,302 @@
+#!/usr/bin/env python
+#
+# Copyright 2013 Adam Gschwender
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Image backends decode, resize and encode pixels for pilbox.image.Image.
+
+Every backend works on an opaque handle returned by open(). Images are
+always identified by Pillow, which only reads the header, so format checks
+do not depend on the backend.
+"""
+
+from __future__ import absolute_import, division, print_function, \
+    with_statement
+
+import PIL.Image
+
+try:
+    from io import BytesIO
+except ImportError:
+    from cStringIO import StringIO as BytesIO
+
+try:
+    import cv2
+    import numpy
+except ImportError:
+    cv2 = None
+
+
+# Transparent images are composited onto this color when saved as JPEG
+BACKGROUND = (255, 255, 255)
+
+
+class PillowBackend(object):
+    """Converts color modes at the cheapest point that is still correct.
+    CMYK is resized as is and only converted to RGB at the target size;
+    JPEGs are additionally scaled down while decoding. Transparent images
+    are reduced with their alpha channel and composited onto the
+    background before the final filter, which then only has to resample
+    three opaque channels. Palette indices cannot be resampled, so palette
+    images are converted before resizing; in fast mode they are first
+    reduced with nearest neighbour sampling, so that only about twice the
+    target size is converted."""
+
+    name = "pillow"
+
+    # Pixels are decoded within thumbnail(), not by decode()
+    decodes_lazily = True
+
+    # In fast mode, the image is first shrunk by an integer factor to no
+    # less than this multiple of the target size before the final filter
+    REDUCING_GAP = 2
+
+    # Modes that can be resized directly
+    RESIZE_MODES = ("L", "LA", "RGB", "RGBA", "CMYK")
+
+    def open(self, img, stream):
+        """Returns the handle for img, the Pillow image opened from
+        stream. Pixels are decoded lazily."""
+        return img
+
+    def get_size(self, img):
+        return img.size
+
+    def decode(self, img, size, fast=False):
+        """Returns img, whose pixels are decoded lazily within thumbnail(),
+        where JPEGs are scaled down while decoding, see PIL's draft()."""
+        return img
+
+    def thumbnail(self, img, size, fast=False):
+        """Returns img resized to fit within size, keeping aspect ratio."""
+        if img.mode not in self.RESIZE_MODES:
+            if fast and img.mode == "P":
+                img = self._reduce_palette(img, size)
+            img = self._convert_for_resize(img)
+        if img.mode in ("LA", "RGBA"):
+            # Pillow >= 7 would resample images with alpha at full size
+            # within thumbnail(), unlike opaque ones
+            if fast or hasattr(img, "reduce"):
+                img = self._reduce(img, size)
+            img = self._flatten(img)
+        elif fast:
+            img = self._reduce(img, size)
+        img.thumbnail(size, PIL.Image.ANTIALIAS)
+        return img
+
+    def encode(self, img, format, quality, subsampling=None,
+               progressive=False, optimize=False, icc_profile=None,
+               exif=None):
+        """Returns a buffer to img encoded in format. Subsampling is one of
+        "4:4:4", "4:2:2" or "4:2:0", None leaves it to the encoder. The ICC
+        profile and EXIF data, if given, are embedded in the output."""
+        if format == "JPEG":
+            img = self._flatten(img)
+        kwargs = dict(quality=quality)
+        if subsampling is not None:
+            kwargs["subsampling"] = subsampling
+        if progressive:
+            kwargs["progressive"] = True
+        if optimize:
+            kwargs["optimize"] = True
+        if icc_profile:
+            kwargs["icc_profile"] = icc_profile
+        if exif:
+            kwargs["exif"] = exif
+        outfile = BytesIO()
+        img.save(outfile, format, **kwargs)
+        outfile.seek(0)
+        return outfile
+
+    def _convert_for_resize(self, img):
+        if img.mode == "P":
+            transparent = "transparency" in img.info
+            return img.convert("RGBA" if transparent else "RGB")
+        if img.mode == "1":
+            return img.convert("L")
+        if img.mode == "PA":
+            return img.convert("RGBA")
+        return img.convert("RGB")
+
+    def _flatten(self, img):
+        """Returns img in a mode JPEG supports, i.e. L or RGB."""
+        if img.mode in ("L", "RGB"):
+            return img
+        if img.mode not in ("LA", "RGBA", "CMYK"):
+            img = self._convert_for_resize(img)
+        if img.mode in ("LA", "RGBA"):
+            mode = "L" if img.mode == "LA" else "RGB"
+            color = BACKGROUND[0] if mode == "L" else BACKGROUND
+            background = PIL.Image.new(mode, img.size, color)
+            background.paste(img.convert(mode), mask=img.split()[-1])
+            return background
+        return img.convert("RGB")
+
+    def _reduce_palette(self, img, size):
+        ratio = min(img.size[0] / size[0], img.size[1] / size[1])
+        factor = int(ratio / self.REDUCING_GAP)
+        if factor < 2:
+            return img
+        reduced = (img.size[0] // factor, img.size[1] // factor)
+        return img.resize(reduced, PIL.Image.NEAREST)
+
+    def _reduce(self, img, size):
+        # JPEGs are already scaled down while decoding, see PIL's draft(),
+        # and palette indices cannot be averaged
+        if img.format == "JPEG" or img.mode in ("1", "P"):
+            return img
+        ratio = min(img.size[0] / size[0], img.size[1] / size[1])
+        factor = int(ratio / self.REDUCING_GAP)
+        if factor < 2:
+            return img
+
+        if hasattr(img, "reduce"):
+            return img.reduce(factor)
+        # Pillow < 7 has no box reduction, bilinear ignores all but a 2x2
+        # neighbourhood when downscaling, which is just as cheap
+        reduced = (img.size[0] // factor, img.size[1] // factor)
+        return img.resize(reduced, PIL.Image.BILINEAR)
+
+
+class _Undecoded(object):
+    def __init__(self, img, stream):
+        self.img = img
+        self.stream = stream
+
+
+class OpenCVBackend(object):
+    """Decodes and encodes with OpenCV, which links libjpeg-turbo, and
+    resizes with its SIMD-optimized area interpolation. Formats OpenCV
+    cannot decode, e.g. GIF, and transparent images are decoded by Pillow
+    and handed over. OpenCV converts palette and CMYK sources to BGR
+    while decoding, which for JPEGs in fast mode happens at the reduced
+    decode size; transparent images keep their alpha channel until they
+    are composited onto the background at the target size."""
+
+    name = "opencv"
+
+    decodes_lazily = False
+
+    REDUCING_GAP = 2
+
+    ENCODE_EXTENSIONS = dict(JPEG=".jpg", WEBP=".webp", PNG=".png")
+
+    SAMPLING_FACTORS = {"4:4:4": "IMWRITE_JPEG_SAMPLING_FACTOR_444",
+                        "4:2:2": "IMWRITE_JPEG_SAMPLING_FACTOR_422",
+                        "4:2:0": "IMWRITE_JPEG_SAMPLING_FACTOR_420"}
+
+    def __init__(self):
+        if cv2 is None:
+            raise RuntimeError("OpenCV (cv2) and numpy are required for "
+                               "the opencv backend")
+
+    def open(self, img, stream):
+        return _Undecoded(img, stream)
+
+    def get_size(self, img):
+        if isinstance(img, _Undecoded):
+            return img.img.size
+        return (img.shape[1], img.shape[0])
+
+    def decode(self, img, size, fast=False):
+        """Returns the pixels of img, decoded for thumbnail(img, size,
+        fast)."""
+        return self._decode(img, size if fast else None)
+
+    def thumbnail(self, img, size, fast=False):
+        pixels = self._decode(img, size if fast else None)
+        h, w = pixels.shape[:2]
+        scale = min(size[0] / w, size[1] / h)
+        if scale >= 1:
+            return pixels
+        resized = (max(1, int(round(w * scale))),
+                   max(1, int(round(h * scale))))
+        return cv2.resize(pixels, resized, interpolation=cv2.INTER_AREA)
+
+    def encode(self, img, format, quality, subsampling=None,
+               progressive=False, optimize=False, icc_profile=None,
+               exif=None):
+        """See PillowBackend.encode. OpenCV cannot embed metadata, so the
+        ICC profile and EXIF data are dropped, as is the subsampling on
+        OpenCV < 4.5.5."""
+        pixels = self._decode(img)
+        if format == "JPEG" and pixels.shape[2] == 4:
+            pixels = self._flatten(pixels)
+        params = []
+        if format == "JPEG":
+            params = [cv2.IMWRITE_JPEG_QUALITY, int(quality)]
+            if progressive:
+                params += [cv2.IMWRITE_JPEG_PROGRESSIVE, 1]
+            if optimize:
+                params += [cv2.IMWRITE_JPEG_OPTIMIZE, 1]
+            factor = self.SAMPLING_FACTORS.get(subsampling)
+            if factor and hasattr(cv2, "IMWRITE_JPEG_SAMPLING_FACTOR"):
+                params += [cv2.IMWRITE_JPEG_SAMPLING_FACTOR,
+                           getattr(cv2, factor)]
+        elif format == "WEBP":
+            params = [cv2.IMWRITE_WEBP_QUALITY, int(quality)]
+        ok, buf = cv2.imencode(self.ENCODE_EXTENSIONS[format], pixels, params)
+        if not ok:
+            raise IOError("OpenCV failed to encode %s" % format)
+        return BytesIO(buf.tobytes())
+
+    def _decode(self, img, size=None):
+        """Returns the BGR pixels of img. If a target size is given, JPEGs
+        are scaled down while decoding to no less than REDUCING_GAP times
+        that size."""
+        if not isinstance(img, _Undecoded):
+            return img
+
+        if img.img.mode in ("LA", "PA", "RGBA") or \
+                "transparency" in img.img.info:
+            rgba = numpy.asarray(img.img.convert("RGBA"))
+            return numpy.ascontiguousarray(rgba[:, :, [2, 1, 0, 3]])
+
+        flags = cv2.IMREAD_COLOR
+        if size and img.img.format == "JPEG":
+            ratio = min(img.img.size[0] / size[0], img.img.size[1] / size[1])
+            for factor, reduced in ((8, cv2.IMREAD_REDUCED_COLOR_8),
+                                    (4, cv2.IMREAD_REDUCED_COLOR_4),
+                                    (2, cv2.IMREAD_REDUCED_COLOR_2)):
+                if ratio / factor >= self.REDUCING_GAP:
+                    flags = reduced
+                    break
+
+        # Pillow keeps the pixels as stored, so must OpenCV
+        flags |= getattr(cv2, "IMREAD_IGNORE_ORIENTATION", 0)
+        img.stream.seek(0)
+        data = numpy.frombuffer(img.stream.read(), numpy.uint8)
+        pixels = cv2.imdecode(data, flags)
+        if pixels is None:
+            rgb = numpy.asarray(img.img.convert("RGB"))
+            pixels = numpy.ascontiguousarray(rgb[:, :, ::-1])
+        return pixels
+
+    def _flatten(self, pixels):
+        """Composites BGRA pixels onto the background, returns BGR."""
+        alpha = pixels[:, :, 3:].astype(numpy.float32) / 255
+        background = numpy.array(BACKGROUND[::-1], numpy.float32)
+        bgr = pixels[:, :, :3] * alpha + background * (1 - alpha)
+        return numpy.clip(bgr + 0.5, 0, 255).astype(numpy.uint8)
+
+
+BACKENDS = dict(pillow=PillowBackend, opencv=OpenCVBackend)
+
+
+def get_backend(name=None):
+    """Returns an instance of the named backend, Pillow by default."""
+    name = name or PillowBackend.name
+    if name not in BACKENDS:
+        raise ValueError("Unknown backend: %s" % name)
+    return BACKENDS[name]()
@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+#
+# Copyright 2013 Adam Gschwender
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Pre-renders originals into the render cache.
+
+The originals directory mirrors the S3 root, i.e. it contains files such as
+<bucket>/product-pictures/<filename>. Every file is rendered for each
+configured route and written to the cache at the key the server would use,
+so that the server can serve it without fetching the original.
+
+    $ python -m pilbox.batch --s3_root=https://s3.amazonaws.com \\
+        --cache_dir=/var/cache/pilbox --source_dir=/mnt/originals
+"""
+
+from __future__ import absolute_import, division, print_function, \
+    with_statement
+
+import logging
+import multiprocessing
+import os
+import os.path
+import time
+
+import tornado.options
+from tornado.options import define, options
+
+from pilbox.app import PilboxApplication, get_render_options, render
+from pilbox.cache import FileCache, make_key
+from pilbox.purge import IndexedCache, PurgeIndex, get_index_dir
+
+try:
+    from io import BytesIO
+except ImportError:
+    from cStringIO import StringIO as BytesIO
+
+define("source_dir", help="directory of originals, laid out as the S3 root")
+define("manifest", help="file listing paths relative to source_dir")
+define("processes", help="number of processes, defaults to the cpu count",
+       type=int, default=0)
+
+logger = logging.getLogger("tornado.application")
+
+
+def get_routes(app):
+    """Returns the render parameters of every non-external image route of
+    app, see pilbox.app.get_render_params."""
+    return app.get_route_params(external=False)
+
+
+def iter_paths(source_dir, manifest=None):
+    """Yields the paths of the originals relative to source_dir, either as
+    listed in the manifest or by walking source_dir."""
+    if manifest:
+        with open(manifest) as f:
+            for line in f:
+                path = line.strip().lstrip("/")
+                if path and not path.startswith("#"):
+                    yield path
+        return
+
+    for dirpath, dirnames, filenames in os.walk(source_dir):
+        dirnames.sort()
+        for filename in sorted(filenames):
+            if filename.startswith("."):
+                continue
+            yield os.path.relpath(os.path.join(dirpath, filename), source_dir)
+
+
+def get_url(s3_root, path):
+    """Returns the origin url the server would fetch for path."""
+    path = path.replace(os.sep, "/").replace(" ", "%20")
+    return "%s/%s" % (s3_root, path)
+
+
+def render_file(task):
+    """Renders one original for every route. Returns a tuple of
+    (path, outputs written, bytes written, error message or None)."""
+    path, source_dir, s3_root, cache_dir, index_dir, routes, \
+        render_options = task
+    # The same index the server looks purges up in
+    index = PurgeIndex(get_index_dir(index_dir, cache_dir))
+    cache = IndexedCache(FileCache(cache_dir), index, s3_root)
+    url = get_url(s3_root, path)
+    written = total = 0
+    try:
+        with open(os.path.join(source_dir, path), "rb") as f:
+            data = f.read()
+        for params in routes:
+            kwargs = dict(params, **render_options)
+            body = render(BytesIO(data), **kwargs).getvalue()
+            cache.set(make_key(url, **params), body)
+            written += 1
+            total += len(body)
+    except Exception as e:
+        return (path, written, total, str(e) or e.__class__.__name__)
+    return (path, written, total, None)
+
+
+def run(source_dir, cache_dir, s3_root, routes, manifest=None, processes=0,
+        render_options=None, index_dir=None):
+    """Renders all originals with a process pool, returns a dict of
+    statistics about the run. The purge index is kept in index_dir, by
+    default in cache_dir like the server's, see
+    pilbox.purge.get_index_dir."""
+    render_options = render_options or dict()
+    tasks = ((path, source_dir, s3_root, cache_dir, index_dir, routes,
+              render_options)
+             for path in iter_paths(source_dir, manifest))
+    stats = dict(files=0, outputs=0, bytes=0, errors=0)
+    start = time.time()
+    pool = multiprocessing.Pool(processes or None)
+    try:
+        for path, written, total, error in \
+                pool.imap_unordered(render_file, tasks, chunksize=8):
+            stats["files"] += 1
+            stats["outputs"] += written
+            stats["bytes"] += total
+            if error:
+                stats["errors"] += 1
+                logger.warn("Failed to render %s: %s" % (path, error))
+        pool.close()
+    except KeyboardInterrupt:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+    stats["seconds"] = time.time() - start
+    return stats
+
+
+def main():
+    import sys
+    tornado.options.parse_command_line()
+    if not options.source_dir or not options.cache_dir or not options.s3_root:
+        tornado.options.print_help()
+        sys.exit(1)
+
+    routes = get_routes(PilboxApplication())
+    stats = run(options.source_dir, options.cache_dir, options.s3_root,
+                routes, manifest=options.manifest,
+                processes=options.processes,
+                render_options=get_render_options(options.as_dict()),
+                index_dir=options.index_dir)
+    rate = stats["files"] / stats["seconds"] if stats["seconds"] else 0
+    print("Rendered %d files into %d outputs (%d errors) in %.1fs"
+          % (stats["files"], stats["outputs"], stats["errors"],
+             stats["seconds"]))
+    print("%.1f files/s, %d bytes written" % (rate, stats["bytes"]))
+    if stats["errors"]:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,338 @@
+#!/usr/bin/env python
+#
+# Copyright 2013 Adam Gschwender
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+from __future__ import absolute_import, division, print_function, \
+    with_statement
+
+import collections
+import errno
+import hashlib
+import logging
+import mmap
+import multiprocessing
+import os
+import os.path
+import struct
+import tempfile
+import time
+
+try:
+    from urllib import urlencode
+except ImportError:
+    from urllib.parse import urlencode
+
+
+logger = logging.getLogger("tornado.application")
+
+
+CacheEntry = collections.namedtuple("CacheEntry", ["body", "created"])
+
+
+def make_key(url, **params):
+    """Returns the cache key of the rendering of url with the supplied
+    output parameters, e.g. make_key(url, w=100, h=100)."""
+    return urlencode(sorted(params.items()) + [("url", url)])
+
+
+class FileCache(object):
+    """Stores rendered images on disk. Each entry is written to
+    <path>/<xx>/<yy>/<sha1 of key>, where xx and yy are the first two
+    byte pairs of the digest, so that no directory grows too large."""
+
+    def __init__(self, path):
+        self.path = path
+
+    def get(self, key):
+        """Returns the CacheEntry for key or None if it is not cached."""
+        path = self.get_path(key)
+        try:
+            with open(path, "rb") as f:
+                body = f.read()
+                created = os.fstat(f.fileno()).st_mtime
+        except (IOError, OSError) as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return None
+        return CacheEntry(body, created)
+
+    def set(self, key, body, created=None):
+        """Stores body under key. The file is written to a temporary name
+        and renamed into place, so readers never see a partial entry."""
+        path = self.get_path(key)
+        dirname = os.path.dirname(path)
+        try:
+            os.makedirs(dirname)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        fd, tmp_path = tempfile.mkstemp(dir=dirname, prefix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(body)
+            if created is not None:
+                os.utime(tmp_path, (created, created))
+            os.rename(tmp_path, path)
+        except Exception:
+            os.unlink(tmp_path)
+            raise
+
+    def delete(self, key):
+        """Removes key from the cache, returns whether it was present."""
+        try:
+            os.unlink(self.get_path(key))
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return False
+        return True
+
+    def get_path(self, key):
+        digest = hashlib.sha1(key.encode("utf-8")).hexdigest()
+        return os.path.join(self.path, digest[0:2], digest[2:4], digest)
+
+
+class SharedMemoryCache(object):
+    """Stores rendered images in an anonymous shared memory segment.
+
+    The segment must be created before the server forks its workers, so
+    that every child maps the same memory: a render cached by one worker
+    is a hit in all of them and the memory used does not depend on the
+    number of workers.
+
+    The segment is split evenly between size classes. Each class is a
+    set-associative table of fixed-size slots; a key hashes to one set
+    and may occupy any of its ways, the oldest way is replaced when the
+    set is full. Sets are guarded by a fixed number of striped locks,
+    so concurrent workers only contend when they touch the same stripe.
+    Entries larger than the largest slot are not cached.
+
+    A lock is only held to copy one entry, but a worker that dies holding
+    it never releases it. Locks are therefore waited on for at most
+    lock_timeout seconds: a get that times out is a miss, a set is
+    skipped and a delete leaves the entry. Timeouts are counted as
+    cache.lock_timeouts. After MAX_LOCK_TIMEOUTS timeouts in a row, a
+    stripe is disabled in this process: its lock is only tried without
+    waiting, so that its keys are misses without delay, until the lock is
+    free again. The lock cannot be replaced, as the other workers would
+    keep using the old one.
+    """
+
+    SLOT_SIZES = (8 * 1024, 32 * 1024, 128 * 1024, 512 * 1024)
+    WAYS = 4
+    STRIPES = 64
+    LOCK_TIMEOUT = 0.1
+    MAX_LOCK_TIMEOUTS = 3
+
+    # key digest, body length, created timestamp
+    _HEADER = struct.Struct("<20sId")
+
+    def __init__(self, size, slot_sizes=None, lock_timeout=None,
+                 metrics=None):
+        self.size = size
+        self.slot_sizes = tuple(slot_sizes or self.SLOT_SIZES)
+        self.lock_timeout = lock_timeout or self.LOCK_TIMEOUT
+        self.metrics = metrics
+        self.mm = mmap.mmap(-1, size)
+        self.locks = [multiprocessing.Lock() for _ in range(self.STRIPES)]
+        # Consecutive lock timeouts of each stripe in this process
+        self.lock_timeouts = [0] * self.STRIPES
+
+        # (offset, slot size, number of sets) of each size class
+        self.classes = []
+        share = size // len(self.slot_sizes)
+        for i, slot_size in enumerate(self.slot_sizes):
+            num_sets = share // (slot_size * self.WAYS)
+            if num_sets:
+                self.classes.append((i * share, slot_size, num_sets))
+
+    def get(self, key):
+        """Returns the CacheEntry for key or None if it is not cached."""
+        digest = self._digest(key)
+        for offset, slot_size, num_sets in self.classes:
+            set_index, stripe = self._locate(digest, num_sets)
+            if not self._acquire(stripe):
+                return None
+            try:
+                for slot in self._iter_slots(offset, slot_size, set_index):
+                    slot_digest, length, created = \
+                        self._HEADER.unpack_from(self.mm, slot)
+                    if slot_digest == digest and length:
+                        start = slot + self._HEADER.size
+                        return CacheEntry(self.mm[start:start + length],
+                                          created)
+            finally:
+                self.locks[stripe].release()
+        return None
+
+    def set(self, key, body, created=None):
+        """Stores body under key in the smallest class it fits in."""
+        digest = self._digest(key)
+        length = len(body)
+        # An old entry left in another class could be returned instead
+        if self._delete(digest) is None:
+            return
+        for offset, slot_size, num_sets in self.classes:
+            if length + self._HEADER.size > slot_size:
+                continue
+            set_index, stripe = self._locate(digest, num_sets)
+            if not self._acquire(stripe):
+                return
+            try:
+                victim = None
+                oldest = None
+                for slot in self._iter_slots(offset, slot_size, set_index):
+                    _, slot_length, slot_created = \
+                        self._HEADER.unpack_from(self.mm, slot)
+                    if not slot_length:
+                        victim = slot
+                        break
+                    if oldest is None or slot_created < oldest:
+                        victim, oldest = slot, slot_created
+                start = victim + self._HEADER.size
+                self.mm[start:start + length] = body
+                self._HEADER.pack_into(self.mm, victim, digest, length,
+                                       created or time.time())
+            finally:
+                self.locks[stripe].release()
+            return
+
+    def delete(self, key):
+        """Removes key from the cache, returns whether it was present."""
+        return bool(self._delete(self._digest(key)))
+
+    def _delete(self, digest):
+        """Removes digest from every class, returns whether it was present
+        or None if a lock timed out."""
+        found = False
+        for offset, slot_size, num_sets in self.classes:
+            set_index, stripe = self._locate(digest, num_sets)
+            if not self._acquire(stripe):
+                return None
+            try:
+                for slot in self._iter_slots(offset, slot_size, set_index):
+                    slot_digest, length, _ = \
+                        self._HEADER.unpack_from(self.mm, slot)
+                    if slot_digest == digest and length:
+                        self._HEADER.pack_into(self.mm, slot, b"", 0, 0)
+                        found = True
+            finally:
+                self.locks[stripe].release()
+        return found
+
+    def _acquire(self, stripe):
+        """Returns whether the lock of stripe was acquired within
+        lock_timeout, or at once if the stripe is disabled."""
+        timeouts = self.lock_timeouts[stripe]
+        if timeouts >= self.MAX_LOCK_TIMEOUTS:
+            acquired = self.locks[stripe].acquire(False)
+        else:
+            acquired = self.locks[stripe].acquire(True, self.lock_timeout)
+        if acquired:
+            if timeouts >= self.MAX_LOCK_TIMEOUTS:
+                logger.warn("Shared memory cache lock %d is free again, "
+                            "enabling its stripe" % stripe)
+            self.lock_timeouts[stripe] = 0
+            return True
+        if timeouts >= self.MAX_LOCK_TIMEOUTS:
+            return False
+        self.lock_timeouts[stripe] = timeouts + 1
+        if self.metrics:
+            self.metrics.incr("cache.lock_timeouts")
+        if timeouts + 1 == self.MAX_LOCK_TIMEOUTS:
+            logger.warn("Shared memory cache lock %d timed out %d times in "
+                        "a row, disabling its stripe until it is free"
+                        % (stripe, self.MAX_LOCK_TIMEOUTS))
+            if self.metrics:
+                self.metrics.incr("cache.stripes_disabled")
+        return False
+
+    def _digest(self, key):
+        return hashlib.sha1(key.encode("utf-8")).digest()
+
+    def _locate(self, digest, num_sets):
+        h = struct.unpack_from("<Q", digest)[0]
+        set_index = h % num_sets
+        return set_index, set_index % len(self.locks)
+
+    def _iter_slots(self, offset, slot_size, set_index):
+        base = offset + set_index * self.WAYS * slot_size
+        for way in range(self.WAYS):
+            yield base + way * slot_size
+
+
+class MemoryCache(object):
+    """Keeps entries in the memory of one process for at most ttl seconds,
+    dropping the least recently used once they exceed size bytes."""
+
+    def __init__(self, size, ttl=None):
+        self.size = size
+        self.ttl = ttl
+        self.used = 0
+        self.entries = collections.OrderedDict()
+
+    def get(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return None
+        if self.ttl and time.time() - entry.created >= self.ttl:
+            self.used -= len(entry.body)
+            return None
+        self.entries[key] = entry
+        return entry
+
+    def set(self, key, body, created=None):
+        self.delete(key)
+        if len(body) > self.size:
+            return
+        self.entries[key] = CacheEntry(body, created or time.time())
+        self.used += len(body)
+        while self.used > self.size:
+            _, entry = self.entries.popitem(last=False)
+            self.used -= len(entry.body)
+
+    def delete(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return False
+        self.used -= len(entry.body)
+        return True
+
+
+class TieredCache(object):
+    """Looks up keys in each cache in turn, e.g. shared memory before
+    disk. A hit in a later tier is copied into the earlier ones."""
+
+    def __init__(self, caches):
+        self.caches = list(caches)
+
+    def get(self, key):
+        for i, cache in enumerate(self.caches):
+            entry = cache.get(key)
+            if entry:
+                for earlier in self.caches[:i]:
+                    earlier.set(key, entry.body, entry.created)
+                return entry
+        return None
+
+    def set(self, key, body, created=None):
+        for cache in self.caches:
+            cache.set(key, body, created)
+
+    def delete(self, key):
+        found = False
+        for cache in self.caches:
+            found = cache.delete(key) or found
+        return found
@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+#
+# Copyright 2013 Adam Gschwender
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Routes renders to the node of a cluster that owns them.
+
+Every node is configured with the same list of peers, including itself.
+The cache key of a render is hashed onto a consistent hash ring of the
+peers; the owning node renders and caches it, all others forward the
+request to the owner and only keep the response for a short while. Each
+render is thus done once per cluster, and adding or removing a node only
+moves the keys of its neighbours on the ring.
+"""
+
+from __future__ import absolute_import, division, print_function, \
+    with_statement
+
+import bisect
+import hashlib
+
+import tornado.gen
+import tornado.httpclient
+
+try:
+    import pycurl
+except ImportError:
+    pycurl = None
+
+
+# Set on requests forwarded to the owner, which must not forward them again
+FORWARDED_HEADER = "X-Pilbox-Forwarded"
+
+
+def _hash(s):
+    return int(hashlib.md5(s.encode("utf-8")).hexdigest()[:16], 16)
+
+
+class HashRing(object):
+    """Consistent hash ring, every node is placed at replicas points so
+    that keys are spread evenly."""
+
+    REPLICAS = 160
+
+    def __init__(self, nodes, replicas=None):
+        self.nodes = list(nodes)
+        self.replicas = replicas or self.REPLICAS
+        points = []
+        for node in self.nodes:
+            for i in range(self.replicas):
+                points.append((_hash("%s-%d" % (node, i)), node))
+        points.sort()
+        self._hashes = [h for h, _ in points]
+        self._nodes = [node for _, node in points]
+
+    def get_node(self, key):
+        """Returns the node that owns key or None if there are no nodes."""
+        if not self._nodes:
+            return None
+        index = bisect.bisect(self._hashes, _hash(key))
+        return self._nodes[index % len(self._nodes)]
+
+
+class PeerRouter(object):
+    """Decides which peer owns a render and forwards requests to it.
+    Forwarded requests go over curl when pycurl is installed, which keeps
+    connections to the peers alive; Tornado's simple client opens a new
+    connection per request."""
+
+    def __init__(self, peers, self_url, max_clients=None):
+        self.peers = [peer.rstrip("/") for peer in peers]
+        self.self_url = self_url.rstrip("/")
+        if self.self_url not in self.peers:
+            raise ValueError("%s is not one of the peers" % self_url)
+        self.ring = HashRing(self.peers)
+        self.max_clients = max_clients
+        self._client = None
+
+    def get_owner(self, key):
+        """Returns the url of the peer that owns key, or None if it is this
+        node."""
+        owner = self.ring.get_node(key)
+        return None if owner == self.self_url else owner
+
+    def get_client(self):
+        # Created on first use, i.e. in the worker after the server forked
+        if self._client is None:
+            kwargs = dict(force_instance=True, max_clients=self.max_clients)
+            if pycurl is not None:
+                from tornado.curl_httpclient import CurlAsyncHTTPClient
+                self._client = CurlAsyncHTTPClient(**kwargs)
+            else:
+                self._client = tornado.httpclient.AsyncHTTPClient(**kwargs)
+        return self._client
+
+    @tornado.gen.coroutine
+    def forward(self, owner, uri, **kwargs):
+        """Requests uri from owner. Returns the response, also if it is an
+        error; connection errors are raised."""
+        request = tornado.httpclient.HTTPRequest(
+            owner + uri, headers={FORWARDED_HEADER: "1"}, **kwargs)
+        try:
+            resp = yield self.get_client().fetch(request)
+        except tornado.httpclient.HTTPError as e:
+            if e.response is None:
+                raise
+            resp = e.response
+        raise tornado.gen.Return(resp)
@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+#
+# Copyright 2013 Adam Gschwender
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+from __future__ import absolute_import, division, print_function, \
+    with_statement
+
+import time
+
+from pilbox import errors
+
+
+class Deadline(object):
+    """The time by which a request must be answered. It starts when the
+    request arrives and is passed to every stage, which only gets the
+    remaining time. A deadline of None or 0 seconds never expires. Safe
+    to check from the processing threads."""
+
+    def __init__(self, seconds=None, start=None):
+        start = time.time() if start is None else start
+        self.expires = start + seconds if seconds else None
+
+    def remaining(self):
+        """Returns the seconds left or None if there is no deadline."""
+        if self.expires is None:
+            return None
+        return max(0, self.expires - time.time())
+
+    def expired(self):
+        return self.remaining() == 0
+
+    def limit(self, seconds):
+        """Returns seconds, or the time left if that is less. Either may
+        be None for no limit."""
+        remaining = self.remaining()
+        if remaining is None:
+            return seconds
+        if seconds is None:
+            return remaining
+        return min(seconds, remaining)
+
+    def check(self, stage):
+        """Raises a DeadlineError if the deadline has passed before
+        stage."""
+        if self.expired():
+            raise errors.DeadlineError(
+                "Deadline exceeded before %s" % stage, stage=stage)
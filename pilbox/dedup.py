@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+#
+# Copyright 2013 Adam Gschwender
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Renders identical originals only once.
+
+The same photo is often uploaded under several names, buckets or hosts.
+Each fetched original is hashed and two kinds of small entries are kept
+in the render cache:
+
+    make_key(url, content="digest")     -> digest of the original at url
+    make_content_key(digest, **params)  -> url the render of params of
+                                           that content is cached for
+
+so that the render of an alias is copied from the cache instead of being
+decoded and encoded again. The copy is cached under the alias's own key,
+so dedup saves processing but not cache space. An alias whose digest is
+already known, i.e. that was fetched before, is served without even
+fetching it. Digests are as fresh as renders, see cache_ttl, and are
+purged with the renders of their url. Originals are hashed with xxHash
+if it is installed, else with SHA-1.
+"""
+
+from __future__ import absolute_import, division, print_function, \
+    with_statement
+
+import hashlib
+import time
+
+from pilbox.cache import make_key
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+try:
+    from urllib import urlencode
+except ImportError:
+    from urllib.parse import urlencode
+
+
+def hash_content(data):
+    """Returns the digest of data, prefixed with the name of the hash."""
+    if xxhash is not None:
+        if hasattr(xxhash, "xxh3_128"):
+            return "xxh128:" + xxhash.xxh3_128(data).hexdigest()
+        return "xxh64:" + xxhash.xxh64(data).hexdigest()
+    return "sha1:" + hashlib.sha1(data).hexdigest()
+
+
+def make_content_key(digest, **params):
+    """Returns the key of the url rendered with params whose original has
+    digest, see make_key()."""
+    return urlencode(sorted(params.items()) + [("content", digest)])
+
+
+class ContentIndex(object):
+    """Keeps the digests of originals and the urls their renders are cached
+    for in cache. Entries older than ttl seconds are ignored, unless ttl
+    is 0."""
+
+    def __init__(self, cache, ttl=0):
+        self.cache = cache
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+
+    def get_digest(self, url):
+        """Returns the digest of the original at url or None."""
+        return self._get(make_key(url, content="digest"))
+
+    def set_digest(self, url, digest):
+        self.cache.set(make_key(url, content="digest"),
+                       digest.encode("utf-8"))
+
+    def get_url(self, digest, **params):
+        """Returns the url the render of params of the original with digest
+        is cached for, if it still has that digest, or None."""
+        url = self._get(make_content_key(digest, **params))
+        if url and self.get_digest(url) == digest:
+            return url
+        return None
+
+    def set_url(self, digest, url, **params):
+        self.cache.set(make_content_key(digest, **params),
+                       url.encode("utf-8"))
+
+    def get_ratio(self):
+        """Returns the fraction of renders that were copied from an alias."""
+        total = self.hits + self.misses
+        return self.hits / total if total else None
+
+    def _get(self, key):
+        entry = self.cache.get(key)
+        if entry is None:
+            return None
+        if self.ttl and entry.created is not None and \
+                time.time() - entry.created >= self.ttl:
+            return None
+        return bytes(entry.body).decode("utf-8")
@@ -143,3 +143,56 @@ class ImageFormatError(UnsupportedError):
     @staticmethod
     def get_code():
         return 201
+
+
+class NotFoundError(PilboxError):
+    def __init__(self, msg=None, *args, **kwargs):
+        super(NotFoundError, self).__init__(404, msg, *args, **kwargs)
+
+
+# A route of a feature that is disabled or not available in this process
+class DisabledError(NotFoundError):
+    @staticmethod
+    def get_code():
+        return 701
+
+
+class ServiceUnavailableError(PilboxError):
+    def __init__(self, msg=None, *args, **kwargs):
+        super(ServiceUnavailableError, self).__init__(
+            503, msg, *args, **kwargs)
+
+
+class PixelMemoryError(ServiceUnavailableError):
+    @staticmethod
+    def get_code():
+        return 401
+
+
+class ProfilerBusyError(ServiceUnavailableError):
+    @staticmethod
+    def get_code():
+        return 402
+
+
+# The client went away before the response was ready, nginx logs this as 499
+class ClientClosedError(PilboxError):
+    def __init__(self, msg=None, *args, **kwargs):
+        kwargs.setdefault("reason", "Client Closed Request")
+        super(ClientClosedError, self).__init__(499, msg, *args, **kwargs)
+
+    @staticmethod
+    def get_code():
+        return 501
+
+
+class GatewayTimeoutError(PilboxError):
+    def __init__(self, msg=None, *args, **kwargs):
+        self.stage = kwargs.pop("stage", None)
+        super(GatewayTimeoutError, self).__init__(504, msg, *args, **kwargs)
+
+
+class DeadlineError(GatewayTimeoutError):
+    @staticmethod
+    def get_code():
+        return 601
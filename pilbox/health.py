@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+#
+# Copyright 2013 Adam Gschwender
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Health checks for the load balancers in front of pilbox.
+
+/health answers as long as the worker's IOLoop does. /ready also reports
+the load of the worker and answers 503 while it is saturated, i.e. it
+has as many image requests in flight as max_requests, more renders
+waiting for a thread than max_render_queue, or requests waiting for pixel
+memory, so that upstreams route around it until it catches up. Workers
+are also not ready while the caches are warmed up, see pilbox.warmup.
+Both are answered on the IOLoop from counters, never waiting on the
+render threads. Each request is answered by one worker, so the load
+reported is that of the worker that answered.
+"""
+
+from __future__ import absolute_import, division, print_function, \
+    with_statement
+
+import os
+
+import tornado.escape
+import tornado.web
+
+
+def get_load(app):
+    """Returns the load of the worker of app."""
+    budget = app.pixel_budget
+    threads = app.settings.get("render_threads") or 0
+    return dict(warming=bool(app.warming.value),
+                in_flight=app.in_flight,
+                render_queue=max(0, app.renders - threads),
+                pixel_memory=budget.current,
+                pixel_memory_limit=budget.limit,
+                pixel_memory_waiting=len(budget.waiters))
+
+
+def get_saturation(app, load):
+    """Returns the reasons the worker of app is not ready under load, an
+    empty list if it is ready."""
+    reasons = []
+    if load["warming"]:
+        reasons.append("warming")
+    max_requests = app.settings.get("max_requests")
+    if max_requests and load["in_flight"] >= max_requests:
+        reasons.append("in_flight")
+    max_queue = app.settings.get("max_render_queue")
+    if max_queue and load["render_queue"] > max_queue:
+        reasons.append("render_queue")
+    if load["pixel_memory_waiting"]:
+        reasons.append("pixel_memory")
+    return reasons
+
+
+class _CheckHandler(tornado.web.RequestHandler):
+    def write_json(self, value):
+        self.set_header("Cache-Control", "no-cache")
+        self.set_header("Content-Type", "application/json")
+        self.finish(tornado.escape.json_encode(value))
+
+
+class HealthHandler(_CheckHandler):
+    def get(self):
+        self.write_json(dict(status="ok", pid=os.getpid()))
+
+
+class ReadyHandler(_CheckHandler):
+    def get(self):
+        load = get_load(self.application)
+        reasons = get_saturation(self.application, load)
+        status = "ready"
+        if reasons == ["warming"]:
+            status = "warming"
+        elif reasons:
+            status = "saturated"
+            self.application.metrics.incr("ready.saturated")
+        if reasons:
+            self.set_status(503)
+        self.write_json(dict(load, pid=os.getpid(), status=status,
+                             reasons=reasons))
@@ -17,13 +17,20 @@
 from __future__ import absolute_import, division, print_function, \
     with_statement
 
+import collections
 import logging
+import math
 import re
 import os.path
+import struct
+import threading
 
 import PIL.Image
+import tornado.concurrent
+import tornado.ioloop
 
 from pilbox import errors
+from pilbox.backend import get_backend
 
 try:
     from io import BytesIO
@@ -32,42 +39,360 @@ except ImportError:
 
 logger = logging.getLogger("tornado.application")
 
+# Settings of Image.save that an encoder profile may override
+ENCODER_DEFAULTS = dict(quality=85, subsampling=None, progressive=False,
+                        optimize=False, strip=True, max_bytes=None)
+
 class Image(object):
     FORMATS = ("gif", "jpg", "jpeg", "png", "webp")
 
-    def __init__(self, stream):
+    def __init__(self, stream, backend=None):
         self.stream = stream
+        self.backend = backend or get_backend()
 
-        self.img = PIL.Image.open(self.stream)
-        if self.img.format.lower() not in self.FORMATS:
+        img = PIL.Image.open(self.stream)
+        if img.format.lower() not in self.FORMATS:
             raise errors.ImageFormatError(
-                "Unknown format: %s" % self.img.format)
+                "Unknown format: %s" % img.format)
+        self.format = img.format
+        self.mode = img.mode
+        self._header = img
+        self.img = self.backend.open(img, self.stream)
+
+    def get_decode_size(self):
+        """Returns the estimated number of bytes the decoded pixels take,
+        computed from the header. Pillow stores every pixel of a multi-band
+        image in four bytes."""
+        width, height = self._header.size
+        bands = len(self._header.getbands())
+        return width * height * (1 if bands == 1 else 4)
+
+    def get_source_size(self):
+        """Returns the width and height of the source."""
+        return self._header.size
+
+    def can_passthrough(self, width, height, strip=False):
+        """Returns whether the source can be served as is, i.e. it is a
+        JPEG that resize(width, height) would not change. Only the header
+        is read, so this must be called before resize()."""
+        if self.format != "JPEG" or self.mode not in ("L", "RGB"):
+            return False
+        size = self._get_size(width, height)
+        if self._header.size[0] > size[0] or self._header.size[1] > size[1]:
+            return False
+        # Renders drop the EXIF orientation, so must the original
+        return strip or _get_orientation(self._header) in (None, 1)
+
+    def passthrough(self, strip=False):
+        """Returns a buffer to the source bytes, without metadata if strip
+        is set. The image is neither decoded nor encoded."""
+        self.stream.seek(0)
+        data = self.stream.read()
+        if strip:
+            data = strip_jpeg_metadata(data)
+        return BytesIO(data)
 
-    def resize(self, width, height):
+    def decode(self, width, height, fast=False):
+        """Decodes the pixels for resize(width, height, fast), so that
+        decoding can be timed on its own. Backends that decode lazily,
+        like Pillow, still decode within resize(). Returns the
+        instance."""
+        self.img = self.backend.decode(
+            self.img, self._get_size(width, height), fast)
+        return self
+
+    def resize(self, width, height, fast=False):
         """Resizes the image to the supplied width/height. Returns the
-        instance. """
+        instance. If fast is set, most of a large reduction is done with a
+        cheap box filter and only the final step uses the antialias
+        filter. """
 
         size = self._get_size(width, height)
-        self._clip(size)
+        self._clip(size, fast)
         return self
 
-    def save(self):
-        """Returns a buffer to the image for saving. """
+    def save(self, quality=85, subsampling=None, progressive=False,
+             optimize=False, strip=True, max_bytes=None, estimator=None,
+             format="JPEG"):
+        """Returns a buffer to the image for saving. The encoder settings
+        are those of an encoder profile, see ENCODER_DEFAULTS. Unless
+        strip is set, the ICC profile and EXIF data of the source are
+        kept. With max_bytes, the image is saved at the highest quality
+        up to quality whose output fits, see save_within(). """
+
+        kwargs = dict(subsampling=subsampling, progressive=progressive,
+                      optimize=optimize, format=format)
+        if max_bytes:
+            return self.save_within(max_bytes, estimator=estimator,
+                                    max_quality=quality, strip=strip,
+                                    **kwargs)
+        if not strip:
+            kwargs.update(icc_profile=self._header.info.get("icc_profile"),
+                          exif=self._header.info.get("exif"))
+        return self.backend.encode(self.img, kwargs.pop("format"),
+                                   quality=quality, **kwargs)
 
-        outfile = BytesIO()
-        self.img.save(outfile, "JPEG", quality=85)
-        outfile.seek(0)
+    def save_within(self, max_bytes, estimator=None, min_quality=30,
+                    max_quality=95, **kwargs):
+        """Returns a buffer to the image saved at the highest quality
+        between min_quality and max_quality whose output is at most
+        max_bytes. Only the resized image is re-encoded. The first quality
+        tried and the change in size per quality step are taken from the
+        QualityEstimator, which learns them from previous saves of images
+        of a similar size; outputs within its tolerance of the budget are
+        accepted. If even min_quality does not fit, its output is
+        returned."""
+        estimator = estimator or QualityEstimator()
+        group = estimator.get_group(max_bytes, self.backend.get_size(self.img),
+                                    kwargs.get("format", "JPEG"))
+        quality = max(min_quality, min(
+            max_quality, estimator.get_quality(group, max_quality)))
+        slope = estimator.get_slope(group)
+        target = math.log(max_bytes * (1 - estimator.tolerance / 2))
+        fit = over = None
+        encodes = 0
+        while True:
+            outfile = self.save(quality=quality, **kwargs)
+            size = len(outfile.getvalue())
+            encodes += 1
+            if size <= max_bytes:
+                fit = (quality, size, outfile)
+                if size >= max_bytes * (1 - estimator.tolerance):
+                    break
+            else:
+                over = (quality, size)
+            lo = fit[0] if fit else min_quality - 1
+            hi = over[0] if over else max_quality + 1
+            if hi - lo <= 1 or encodes >= estimator.max_encodes:
+                break
+            if fit and over:
+                # Interpolate between the closest samples on either side
+                slope = (math.log(over[1]) - math.log(fit[1])) / \
+                    (over[0] - fit[0])
+                estimator.add_slope(group, slope)
+            step = (target - math.log(size)) / slope
+            step = int(math.floor(step)) if step < 0 else int(step)
+            quality = max(lo + 1, min(hi - 1, quality + step))
 
-        return outfile
+        if fit is None and over[0] > min_quality:
+            outfile = self.save(quality=min_quality, **kwargs)
+            encodes += 1
+            if len(outfile.getvalue()) <= max_bytes:
+                fit = (min_quality, len(outfile.getvalue()), outfile)
+        estimator.add(group, fit[0] if fit else min_quality, encodes,
+                      fit is not None)
+        return fit[2] if fit else outfile
 
-    def _clip(self, size):
-        self.img.thumbnail(size, PIL.Image.ANTIALIAS)
+    def _clip(self, size, fast=False):
+        self.img = self.backend.thumbnail(self.img, size, fast)
 
     def _get_size(self, width, height):
-        aspect_ratio = self.img.size[0] / self.img.size[1]
+        img_size = self.backend.get_size(self.img)
+        aspect_ratio = img_size[0] / img_size[1]
         if not width:
-            width = int((int(height) or self.img.size[1]) * aspect_ratio)
+            width = int((int(height) or img_size[1]) * aspect_ratio)
         if not height:
-            height = int((int(width) or self.img.size[0]) / aspect_ratio)
+            height = int((int(width) or img_size[0]) / aspect_ratio)
         return (int(width), int(height))
 
+
+class QualityEstimator(object):
+    """Remembers the qualities Image.save_within() chose for images of
+    similar size, grouped by byte budget, format and the power of two of
+    the pixel count, to seed the next search. Also keeps the number of
+    searches, how many met their budget and the encodes they took. Shared
+    by the render threads, but only updated under a lock."""
+
+    # Change of the log of the output size per quality step, until one
+    # has been observed
+    SLOPE = 0.025
+
+    def __init__(self, tolerance=0.1, max_encodes=4, weight=0.2):
+        self.tolerance = tolerance
+        self.max_encodes = max_encodes
+        self.weight = weight
+        self.qualities = dict()
+        self.slopes = dict()
+        self.searches = 0
+        self.hits = 0
+        self.encodes = 0
+        self._lock = threading.Lock()
+
+    def get_group(self, max_bytes, size, format):
+        pixels = max(1, size[0] * size[1])
+        return (max_bytes, format, int(round(math.log(pixels, 2))))
+
+    def get_quality(self, group, default):
+        return int(round(self.qualities.get(group, default)))
+
+    def get_slope(self, group):
+        return self.slopes.get(group, self.SLOPE)
+
+    def add_slope(self, group, slope):
+        if slope <= 0:
+            return
+        with self._lock:
+            self.slopes[group] = self._average(self.slopes, group, slope)
+
+    def add(self, group, quality, encodes, hit):
+        with self._lock:
+            self.qualities[group] = self._average(self.qualities, group,
+                                                  quality)
+            self.searches += 1
+            self.hits += 1 if hit else 0
+            self.encodes += encodes
+
+    def get_hit_rate(self):
+        return self.hits / self.searches if self.searches else None
+
+    def get_encodes_per_search(self):
+        return self.encodes / self.searches if self.searches else None
+
+    def _average(self, values, group, value):
+        if group not in values:
+            return value
+        return values[group] + self.weight * (value - values[group])
+
+
+class PixelBudget(object):
+    """Limits the bytes of decoded pixels a process holds at once. Each
+    render reserves Image.get_decode_size() before decoding and releases
+    it once encoded. Reservations are granted in order; one that does not
+    fit waits until enough is released. A reservation larger than the
+    whole budget is granted once nothing else is reserved, so that large
+    images are rendered alone rather than refused. A limit of 0 disables
+    the budget, but reservations are still counted.
+
+    Must only be used from the IOLoop thread."""
+
+    def __init__(self, limit=0):
+        self.limit = limit
+        self.current = 0
+        self.peak = 0
+        self.waiters = collections.deque()
+
+    def reserve(self, nbytes, timeout=None):
+        """Returns a Future that resolves once nbytes are reserved. If
+        they cannot be reserved within timeout seconds, the Future fails
+        with a PixelMemoryError; a timeout of 0 fails immediately."""
+        future = tornado.concurrent.Future()
+        if not self.waiters and self._fits(nbytes):
+            self._acquire(nbytes)
+            future.set_result(None)
+            return future
+        if timeout is not None and timeout <= 0:
+            future.set_exception(self._error(nbytes))
+            return future
+
+        waiter = [nbytes, future, None]
+        if timeout is not None:
+            io_loop = tornado.ioloop.IOLoop.current()
+            waiter[2] = io_loop.add_timeout(
+                io_loop.time() + timeout, lambda: self._expire(waiter))
+        self.waiters.append(waiter)
+        return future
+
+    def release(self, nbytes):
+        self.current -= nbytes
+        self._wake()
+
+    def cancel(self, future, error):
+        """Stops waiting for the reservation of future, which then fails
+        with error. Returns False if it was already granted or failed."""
+        for waiter in self.waiters:
+            if waiter[1] is future:
+                self._discard(waiter, error)
+                return True
+        return False
+
+    def _fits(self, nbytes):
+        return not self.limit or not self.current or \
+            self.current + nbytes <= self.limit
+
+    def _acquire(self, nbytes):
+        self.current += nbytes
+        self.peak = max(self.peak, self.current)
+
+    def _wake(self):
+        while self.waiters:
+            nbytes, future, timeout = self.waiters[0]
+            if future.done():
+                # Cancelled by the caller
+                self.waiters.popleft()
+                continue
+            if not self._fits(nbytes):
+                break
+            self.waiters.popleft()
+            if timeout is not None:
+                tornado.ioloop.IOLoop.current().remove_timeout(timeout)
+            self._acquire(nbytes)
+            future.set_result(None)
+
+    def _expire(self, waiter):
+        if waiter in self.waiters:
+            self._discard(waiter, self._error(waiter[0]))
+
+    def _discard(self, waiter, error):
+        self.waiters.remove(waiter)
+        if waiter[2] is not None:
+            tornado.ioloop.IOLoop.current().remove_timeout(waiter[2])
+        waiter[1].set_exception(error)
+        # Those queued behind it may fit now
+        self._wake()
+
+    def _error(self, nbytes):
+        return errors.PixelMemoryError(
+            "Pixel memory exhausted: %d of %d bytes reserved, %d requested"
+            % (self.current, self.limit, nbytes))
+
+
+def strip_jpeg_metadata(data):
+    """Returns the JPEG data without EXIF, XMP, IPTC, thumbnail and comment
+    segments, keeping those needed to display it correctly: JFIF, ICC
+    profiles and the Adobe color transform. Only the segment headers are
+    parsed, the compressed image data is copied as is. Data that cannot be
+    parsed is returned unchanged."""
+    if data[:2] != b"\xff\xd8":
+        return data
+
+    segments = [data[:2]]
+    pos = 2
+    while pos + 4 <= len(data):
+        prefix, marker = struct.unpack_from(">BB", data, pos)
+        if prefix != 0xFF:
+            return data
+        if marker == 0xFF:
+            # Fill byte
+            pos += 1
+            continue
+        if marker == 0xDA:
+            # Start of scan, the remainder is image data
+            segments.append(data[pos:])
+            return b"".join(segments)
+        length = struct.unpack_from(">H", data, pos + 2)[0]
+        end = pos + 2 + length
+        if end > len(data):
+            return data
+        if _keep_jpeg_segment(marker, data[pos + 4:end]):
+            segments.append(data[pos:end])
+        pos = end
+    return data
+
+
+def _keep_jpeg_segment(marker, payload):
+    if marker == 0xFE:
+        return False
+    if marker == 0xE2:
+        return payload.startswith(b"ICC_PROFILE\x00")
+    if marker == 0xEE:
+        return payload.startswith(b"Adobe")
+    return not 0xE1 <= marker <= 0xEF
+
+
+def _get_orientation(img):
+    try:
+        exif = img._getexif() if hasattr(img, "_getexif") else None
+    except Exception:
+        # Corrupt EXIF data is not worth failing the request for
+        return None
+    return (exif or {}).get(0x0112)
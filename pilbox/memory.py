@@ -0,0 +1,179 @@
+#!/usr/bin/env python
+#
+# Copyright 2013 Adam Gschwender
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Accounts for the memory of a worker.
+
+The RSS of every worker is reported by the metrics route. Python's
+allocations are traced with tracemalloc, which is off unless started with
+the tracemalloc option or by the memory route, as it slows allocations
+down and needs memory of its own. While it traces, the peak of traced
+memory of every image request is recorded, and snapshots of the
+allocation sites can be taken and compared with the memory route.
+Pillow's pixel buffers are allocated outside of Python and only show up
+in the RSS.
+"""
+
+from __future__ import absolute_import, division, print_function, \
+    with_statement
+
+import os
+
+from pilbox import errors
+from pilbox.admin import AdminHandler
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+
+def get_rss():
+    """Returns the resident set size of this process in bytes, or None if
+    it cannot be read."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def get_max_rss():
+    """Returns the peak resident set size of this process in bytes."""
+    if resource is None:
+        return None
+    # Reported in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def is_tracing():
+    return tracemalloc is not None and tracemalloc.is_tracing()
+
+
+class PeakTracker(object):
+    """Measures the peak of traced memory while each request runs.
+    tracemalloc only keeps one peak per process, so it is reset when a
+    request starts while no other one runs; peaks of overlapping requests
+    include each other's allocations."""
+
+    def __init__(self):
+        self.active = 0
+        self.max_peak = 0
+
+    def begin(self):
+        """Returns the token of a request that starts now, or None if
+        memory is not traced."""
+        if not is_tracing():
+            return None
+        if not self.active and hasattr(tracemalloc, "reset_peak"):
+            tracemalloc.reset_peak()
+        self.active += 1
+        return tracemalloc.get_traced_memory()[0]
+
+    def end(self, token):
+        """Returns the peak bytes traced above the start of the request of
+        token, or None."""
+        if token is None:
+            return None
+        self.active -= 1
+        if not is_tracing():
+            return None
+        peak = max(0, tracemalloc.get_traced_memory()[1] - token)
+        self.max_peak = max(self.max_peak, peak)
+        return peak
+
+
+def _filter(snapshot):
+    return snapshot.filter_traces((
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+        tracemalloc.Filter(False, "<unknown>")))
+
+
+def _format_stat(stat, diff=False):
+    value = dict(size=stat.size, count=stat.count,
+                 traceback=[str(frame) for frame in stat.traceback])
+    if diff:
+        value.update(size_diff=stat.size_diff, count_diff=stat.count_diff)
+    return value
+
+
+class MemoryHandler(AdminHandler):
+    """Controls tracemalloc in this worker. The action is one of
+
+    - status: the RSS and traced memory of the worker
+    - start: starts tracing with frames frames per allocation
+    - stop: stops tracing and drops the snapshot
+    - snapshot: takes a snapshot, which later diffs compare to, and
+      returns the limit largest allocation sites
+    - diff: takes a snapshot and returns the limit allocation sites that
+      grew most since the last snapshot, or acts as snapshot if there is
+      none
+
+    Sites are grouped by group, i.e. lineno, filename or traceback."""
+
+    ACTIONS = ("status", "start", "stop", "snapshot", "diff")
+    GROUPS = ("lineno", "filename", "traceback")
+
+    def get(self):
+        if tracemalloc is None:
+            raise errors.DisabledError("tracemalloc is not available")
+        action = self.get_query_argument("action", "status")
+        group = self.get_query_argument("group", "lineno")
+        if action not in self.ACTIONS:
+            raise errors.UrlError("Unknown action: %s" % action)
+        if group not in self.GROUPS:
+            raise errors.UrlError("Unknown group: %s" % group)
+        try:
+            limit = int(self.get_query_argument("limit", 20))
+            frames = int(self.get_query_argument("frames", 1))
+        except ValueError:
+            raise errors.UrlError("Invalid limit or frames")
+
+        app = self.application
+        result = dict()
+        if action == "start" and not tracemalloc.is_tracing():
+            tracemalloc.start(frames)
+        elif action == "stop":
+            tracemalloc.stop()
+            app.memory_snapshot = None
+        elif action in ("snapshot", "diff"):
+            if not tracemalloc.is_tracing():
+                raise errors.UrlError("Memory is not traced")
+            # Takes a while and blocks the IOLoop, as it must not race
+            # with allocations of the request handlers
+            snapshot = _filter(tracemalloc.take_snapshot())
+            if action == "diff" and app.memory_snapshot is not None:
+                stats = snapshot.compare_to(app.memory_snapshot, group)
+                result["sites"] = [_format_stat(stat, True)
+                                   for stat in stats[:limit]]
+            else:
+                stats = snapshot.statistics(group)
+                result["sites"] = [_format_stat(stat)
+                                   for stat in stats[:limit]]
+                app.memory_snapshot = snapshot
+
+        result.update(pid=os.getpid(), rss=get_rss(),
+                      max_rss=get_max_rss(), tracing=is_tracing())
+        if is_tracing():
+            result["traced"], result["traced_peak"] = \
+                tracemalloc.get_traced_memory()
+            result["request_peak"] = app.memory.max_peak
+        self.write_json(result)
@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+#
+# Copyright 2013 Adam Gschwender
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Process local metrics. Every worker forked by the server keeps its own
+values, the metrics route reports those of the worker that serves it."""
+
+from __future__ import absolute_import, division, print_function, \
+    with_statement
+
+import collections
+import os
+
+import tornado.escape
+import tornado.web
+
+
+class Metrics(object):
+    """Counters are incremented by the code that observes an event, gauges
+    are callables that are only evaluated when a snapshot is taken."""
+
+    def __init__(self):
+        self.counters = collections.defaultdict(int)
+        self.gauges = dict()
+
+    def incr(self, name, value=1):
+        self.counters[name] += value
+
+    def gauge(self, name, fn):
+        """Registers fn, which returns the current value of name."""
+        self.gauges[name] = fn
+
+    def snapshot(self):
+        """Returns a dict of the current value of every metric."""
+        values = dict(self.counters)
+        for name, fn in self.gauges.items():
+            values[name] = fn()
+        return values
+
+
+class MetricsHandler(tornado.web.RequestHandler):
+    def get(self):
+        values = self.application.metrics.snapshot()
+        values["pid"] = os.getpid()
+        self.set_header("Cache-Control", "no-cache")
+        self.set_header("Content-Type", "application/json")
+        self.finish(tornado.escape.json_encode(values))
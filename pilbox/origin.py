@@ -0,0 +1,236 @@
+#!/usr/bin/env python
+#
+# Copyright 2013 Adam Gschwender
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Fetches originals, optionally hedging slow requests.
+
+A hedged fetch issues a second, identical request when the first has not
+received its response headers within a delay, uses whichever succeeds
+first and cancels the other, which is aborted as soon as it receives
+data. It only fails once every request it started has failed. The delay
+is either fixed or the rolling 95th percentile of the time to headers, so
+that only the slowest requests are hedged. A token bucket caps the extra
+requests at a fraction of all fetches.
+"""
+
+from __future__ import absolute_import, division, print_function, \
+    with_statement
+
+import collections
+import logging
+
+import tornado.concurrent
+import tornado.gen
+import tornado.httpclient
+import tornado.ioloop
+
+from pilbox import errors
+
+try:
+    from io import BytesIO
+except ImportError:
+    from cStringIO import StringIO as BytesIO
+
+
+class LatencyTracker(object):
+    """Keeps the most recent samples and their percentiles, which are only
+    recomputed every so often."""
+
+    def __init__(self, size=1000, min_samples=20, refresh=50):
+        self.samples = collections.deque(maxlen=size)
+        self.min_samples = min_samples
+        self.refresh = refresh
+        self._sorted = None
+        self._added = 0
+
+    def add(self, value):
+        self.samples.append(value)
+        self._added += 1
+        if self._added >= self.refresh:
+            self._sorted = None
+
+    def percentile(self, p):
+        """Returns the p-th percentile of the samples or None if there are
+        too few of them."""
+        if len(self.samples) < self.min_samples:
+            return None
+        if self._sorted is None:
+            self._sorted = sorted(self.samples)
+            self._added = 0
+        index = min(len(self._sorted) - 1, int(len(self._sorted) * p / 100))
+        return self._sorted[index]
+
+
+class HedgeBudget(object):
+    """Token bucket that earns ratio tokens per fetch, a hedge costs one.
+    At most burst tokens are saved up."""
+
+    def __init__(self, ratio, burst=10):
+        self.ratio = ratio
+        self.burst = burst
+        self.tokens = 0.0
+
+    def deposit(self):
+        self.tokens = min(self.burst, self.tokens + self.ratio)
+
+    def withdraw(self):
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+
+class _Cancelled(Exception):
+    pass
+
+
+class _CancelledFilter(logging.Filter):
+    """Drops the error Tornado logs when a callback aborts a transfer, as
+    that is how the losing request of a hedge is cancelled."""
+
+    def filter(self, record):
+        error = record.exc_info[1] if record.exc_info else None
+        while error is not None:
+            if isinstance(error, _Cancelled):
+                return False
+            error = getattr(error, "__context__", None)
+        return True
+
+
+logging.getLogger("tornado.application").addFilter(_CancelledFilter())
+
+
+class _Attempt(object):
+    def __init__(self, start):
+        self.start = start
+        self.headers_at = None
+        self.cancelled = False
+        self.failed = False
+        self.buffer = BytesIO()
+
+    def on_header(self, line):
+        if self.cancelled:
+            raise _Cancelled()
+        if self.headers_at is None:
+            self.headers_at = tornado.ioloop.IOLoop.current().time()
+
+    def on_chunk(self, chunk):
+        if self.cancelled:
+            raise _Cancelled()
+        self.buffer.write(chunk)
+
+
+class OriginFetcher(object):
+    """Fetches urls with an AsyncHTTPClient. Without hedging or an abort
+    Future, this is the same as calling client.fetch directly. A delay of
+    0 hedges after the rolling 95th percentile of the time to headers,
+    once enough fetches have been seen."""
+
+    def __init__(self, hedge=False, delay=0, ratio=0.05, metrics=None):
+        self.hedge = hedge
+        self.delay = delay
+        self.budget = HedgeBudget(ratio)
+        self.latency = LatencyTracker()
+        self.metrics = metrics
+
+    def get_delay(self):
+        """Returns the seconds to wait for headers before hedging, or None
+        if there is no delay yet."""
+        if self.delay:
+            return self.delay
+        return self.latency.percentile(95)
+
+    @tornado.gen.coroutine
+    def fetch(self, client, url, abort=None, **kwargs):
+        """Returns a Future to the response. Once abort, a Future, is done,
+        the requests are cancelled and the fetch fails with a
+        ClientClosedError."""
+        if not self.hedge and abort is None:
+            resp = yield client.fetch(url, **kwargs)
+            raise tornado.gen.Return(resp)
+
+        io_loop = tornado.ioloop.IOLoop.current()
+        done = tornado.concurrent.Future()
+        attempts = []
+
+        def start():
+            attempt = _Attempt(io_loop.time())
+            attempts.append(attempt)
+            request = tornado.httpclient.HTTPRequest(
+                url, header_callback=attempt.on_header,
+                streaming_callback=attempt.on_chunk, **kwargs)
+            client.fetch(request).add_done_callback(
+                lambda future: finish(attempt, future))
+
+        def finish(attempt, future):
+            error = future.exception()
+            if attempt.headers_at is not None:
+                self.latency.add(attempt.headers_at - attempt.start)
+            if done.done() or attempt.cancelled:
+                return
+            if error is not None:
+                # The other attempt may still succeed
+                attempt.failed = True
+                if all(other.failed for other in attempts):
+                    done.set_exception(error)
+                return
+            for other in attempts:
+                other.cancelled = other is not attempt
+            if attempt is not attempts[0]:
+                self._incr("origin.hedge_wins")
+            resp = future.result()
+            attempt.buffer.seek(0)
+            done.set_result(tornado.httpclient.HTTPResponse(
+                resp.request, resp.code, headers=resp.headers,
+                buffer=attempt.buffer, effective_url=resp.effective_url,
+                request_time=resp.request_time, reason=resp.reason))
+
+        def hedge():
+            if done.done() or attempts[0].failed or \
+                    attempts[0].headers_at is not None:
+                return
+            if not self.budget.withdraw():
+                self._incr("origin.hedges_denied")
+                return
+            self._incr("origin.hedges")
+            start()
+
+        def cancel(future):
+            if done.done():
+                return
+            for attempt in attempts:
+                attempt.cancelled = True
+            done.set_exception(errors.ClientClosedError())
+
+        self._incr("origin.fetches")
+        start()
+        if abort is not None:
+            abort.add_done_callback(cancel)
+        delay = self.get_delay() if self.hedge else None
+        if self.hedge:
+            self.budget.deposit()
+        timeout = None
+        if delay is not None:
+            timeout = io_loop.add_timeout(io_loop.time() + delay, hedge)
+        try:
+            resp = yield done
+        finally:
+            if timeout is not None:
+                io_loop.remove_timeout(timeout)
+        raise tornado.gen.Return(resp)
+
+    def _incr(self, name):
+        if self.metrics:
+            self.metrics.incr(name)
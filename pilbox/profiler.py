@@ -0,0 +1,190 @@
+#!/usr/bin/env python
+#
+# Copyright 2013 Adam Gschwender
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Profiles a worker under live load.
+
+Nothing is installed until a profile is requested, so there is no cost
+when profiling is off. A profile covers the worker that serves the
+request only; with several workers, repeat the request until each pid has
+been seen. Two profilers are available:
+
+- sample: a thread records the stack of every thread, i.e. the IOLoop and
+  the render threads, at a fixed interval. The result is in the collapsed
+  stack format of flamegraph.pl and speedscope, one line per stack with
+  the number of samples it was seen in.
+- cprofile: cProfile traces the IOLoop thread and every render submitted
+  to the render threads, each under a profile of its own as cProfile
+  only traces the thread it is enabled in. Renders that have not
+  finished when the profile ends are left out. The result is the merged
+  pstats text report or, with format=pstats, a file for pstats.Stats.
+"""
+
+from __future__ import absolute_import, division, print_function, \
+    with_statement
+
+import cProfile
+import collections
+import marshal
+import os.path
+import pstats
+import re
+import sys
+import threading
+import time
+
+import tornado.concurrent
+import tornado.gen
+import tornado.ioloop
+
+from pilbox import errors
+from pilbox.admin import AdminHandler
+
+try:
+    from io import StringIO
+except ImportError:
+    from cStringIO import StringIO
+
+
+class StackSampler(threading.Thread):
+    """Counts the stacks of all other threads every interval seconds until
+    stopped. Stacks are rooted at the thread's name, without the number
+    of pool threads, so that threads of one pool are merged."""
+
+    def __init__(self, interval=0.005):
+        super(StackSampler, self).__init__(name="pilbox-profiler")
+        self.daemon = True
+        self.interval = interval
+        self.counts = collections.defaultdict(int)
+        self.samples = 0
+        self._stopped = threading.Event()
+
+    def run(self):
+        while not self._stopped.is_set():
+            self.sample()
+            self._stopped.wait(self.interval)
+
+    def stop(self):
+        self._stopped.set()
+        self.join()
+
+    def sample(self):
+        names = dict((t.ident, t.name) for t in threading.enumerate())
+        for ident, frame in sys._current_frames().items():
+            if ident == threading.current_thread().ident:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append("%s:%s" % (
+                    os.path.basename(code.co_filename), code.co_name))
+                frame = frame.f_back
+            stack.append(re.sub(r"[-_]\d+$", "",
+                                names.get(ident, "thread-%d" % ident)))
+            self.counts[";".join(reversed(stack))] += 1
+        self.samples += 1
+
+    def get_collapsed(self):
+        """Returns the stacks in the collapsed format, most common first."""
+        return "".join("%s %d\n" % (stack, count) for stack, count in
+                       sorted(self.counts.items(), key=lambda i: -i[1]))
+
+
+def run_profiled(profiles, fn, *args, **kwargs):
+    """Calls fn under a new profile, which is appended to profiles once fn
+    returns. Used to profile the renders on the render threads."""
+    profile = cProfile.Profile()
+    try:
+        return profile.runcall(fn, *args, **kwargs)
+    finally:
+        profiles.append(profile)
+
+
+def get_pstats_report(stats, limit=100):
+    """Returns the text report of stats sorted by cumulative time."""
+    stream = StringIO()
+    stats.stream = stream
+    stats.sort_stats("cumulative").print_stats(limit)
+    return stream.getvalue()
+
+
+def _sleep(seconds):
+    future = tornado.concurrent.Future()
+    io_loop = tornado.ioloop.IOLoop.current()
+    io_loop.add_timeout(io_loop.time() + seconds,
+                        lambda: future.set_result(None))
+    return future
+
+
+class ProfileHandler(AdminHandler):
+    """Profiles this worker for seconds, at most max_profile_seconds, and
+    returns the result, see above. One profile runs per worker at a
+    time."""
+
+    MODES = ("sample", "cprofile")
+
+    @tornado.gen.coroutine
+    def get(self):
+        mode = self.get_query_argument("mode", "sample")
+        if mode not in self.MODES:
+            raise errors.UrlError("Unknown mode: %s" % mode)
+        try:
+            seconds = float(self.get_query_argument("seconds", 10))
+        except ValueError:
+            raise errors.UrlError("Invalid seconds")
+        if not 0 < seconds <= self.settings.get("max_profile_seconds"):
+            raise errors.UrlError("Seconds must be within 0 and %s" %
+                                  self.settings.get("max_profile_seconds"))
+        app = self.application
+        if app.profiling:
+            raise errors.ProfilerBusyError("A profile is already running")
+
+        app.profiling = True
+        start = time.time()
+        try:
+            if mode == "sample":
+                sampler = StackSampler()
+                sampler.start()
+                try:
+                    yield _sleep(seconds)
+                finally:
+                    sampler.stop()
+            else:
+                app.render_profiles = render_profiles = []
+                profile = cProfile.Profile()
+                profile.enable()
+                try:
+                    yield _sleep(seconds)
+                finally:
+                    profile.disable()
+                    app.render_profiles = None
+                # Renders that finish from now on are not included
+                stats = pstats.Stats(profile, *list(render_profiles))
+        finally:
+            app.profiling = False
+        app.metrics.incr("profiles")
+
+        self.set_header("Cache-Control", "no-cache")
+        self.set_header("X-Pilbox-Pid", str(os.getpid()))
+        self.set_header("X-Pilbox-Seconds", "%.3f" % (time.time() - start))
+        if mode == "sample":
+            self.set_header("Content-Type", "text/plain")
+            self.finish(sampler.get_collapsed())
+        elif self.get_query_argument("format", "text") == "pstats":
+            self.set_header("Content-Type", "application/octet-stream")
+            self.finish(marshal.dumps(stats.stats))
+        else:
+            self.set_header("Content-Type", "text/plain")
+            self.finish(get_pstats_report(stats))
@@ -0,0 +1,357 @@
+#!/usr/bin/env python
+#
+# Copyright 2013 Adam Gschwender
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Invalidates every cached render of an original.
+
+Originals are replaced under the same filename, so their renders must be
+purged from all caches. Cache keys are digests, so the keys of an original
+cannot be found by scanning the cache; instead every key that is cached is
+recorded in an index on disk, grouped by bucket:
+
+    <index_dir>/<sha1 of bucket>/<sha1 of url>
+
+The first line of an index file is the url of the original, every other
+line a cache key rendered from it. Originals outside of s3_root are grouped
+by host. The index is shared by all workers and by pilbox.batch.
+
+Without an index, e.g. with only a shared memory cache, the keys of one
+original are made from the render parameters of every image route, see
+get_route_keys(), so renders are still purged by filename or url. Purges
+by prefix or of a whole bucket need the index and are refused.
+"""
+
+from __future__ import absolute_import, division, print_function, \
+    with_statement
+
+import base64
+import errno
+import hashlib
+import logging
+import os
+import os.path
+import re
+
+import tornado.gen
+import tornado.httpclient
+
+from pilbox import errors
+from pilbox.admin import AdminHandler
+from pilbox.cache import make_key
+from pilbox.cluster import FORWARDED_HEADER
+
+try:
+    from urlparse import parse_qs, urlparse
+except ImportError:
+    from urllib.parse import parse_qs, urlparse
+
+logger = logging.getLogger("tornado.application")
+
+
+def _sha1(s):
+    return hashlib.sha1(s.encode("utf-8")).hexdigest()
+
+
+def get_s3_url(s3_root, bucket, filename):
+    """Returns the origin url of filename in bucket, as built by the
+    ImageHandler."""
+    return "%s/%s/product-pictures/%s" % (
+        s3_root, bucket, filename.replace(" ", "%20"))
+
+
+def get_group(url, s3_root=None):
+    """Returns the index group of url: its bucket if it is in s3_root,
+    else its host."""
+    if s3_root and url.startswith(s3_root.rstrip("/") + "/"):
+        return url[len(s3_root.rstrip("/")) + 1:].split("/", 1)[0]
+    return urlparse(url).netloc
+
+
+def get_route_keys(url, routes):
+    """Returns the keys url is cached under by routes, a list of render
+    parameters, including its digest, see pilbox.dedup."""
+    keys = [make_key(url, **params) for params in routes]
+    keys.append(make_key(url, content="digest"))
+    return keys
+
+
+def get_key_url(key):
+    """Returns the url a cache key of pilbox.cache.make_key was made from."""
+    return parse_qs(key).get("url", [None])[0]
+
+
+def get_index_dir(index_dir=None, cache_dir=None):
+    """Returns the directory of the purge index, index_dir if set, else
+    the index directory of the file cache in cache_dir, or None if there
+    is neither."""
+    if index_dir:
+        return index_dir
+    if cache_dir:
+        return os.path.join(cache_dir, "index")
+    return None
+
+
+class PurgeIndex(object):
+    """Records the cache keys rendered from each url, see above. Keys are
+    appended to the index file of their url, so that concurrent writers
+    do not overwrite each other."""
+
+    def __init__(self, path):
+        self.path = path
+
+    def add(self, group, url, key):
+        path = self.get_path(group, url)
+        keys = self._read(path)
+        if keys is None:
+            self._create(path, url)
+        elif key in keys:
+            return
+        with open(path, "a") as f:
+            f.write(key + "\n")
+
+    def get_keys(self, group, url):
+        """Returns the keys cached from url."""
+        return self._read(self.get_path(group, url)) or []
+
+    def get_urls(self, group, prefix=None):
+        """Returns the urls of group with a cached key, optionally only
+        those starting with prefix."""
+        dirname = os.path.join(self.path, _sha1(group))
+        try:
+            names = os.listdir(dirname)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return []
+        urls = []
+        for name in names:
+            url = self._read_url(os.path.join(dirname, name))
+            if url and (not prefix or url.startswith(prefix)):
+                urls.append(url)
+        return urls
+
+    def remove(self, group, url):
+        """Forgets the keys of url, returns whether there were any."""
+        try:
+            os.unlink(self.get_path(group, url))
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return False
+        return True
+
+    def get_path(self, group, url):
+        return os.path.join(self.path, _sha1(group), _sha1(url))
+
+    def _create(self, path, url):
+        try:
+            os.makedirs(os.path.dirname(path))
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        try:
+            fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+        except OSError as e:
+            # Created by another writer in the meantime
+            if e.errno != errno.EEXIST:
+                raise
+            return
+        with os.fdopen(fd, "w") as f:
+            f.write(url + "\n")
+
+    def _read(self, path):
+        try:
+            with open(path) as f:
+                lines = f.read().splitlines()
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return None
+        return [line for line in lines[1:] if line]
+
+    def _read_url(self, path):
+        try:
+            with open(path) as f:
+                return f.readline().rstrip("\n")
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return None
+
+
+class IndexedCache(object):
+    """Records every key set in cache in the PurgeIndex index."""
+
+    def __init__(self, cache, index, s3_root=None):
+        self.cache = cache
+        self.index = index
+        self.s3_root = s3_root
+
+    def get(self, key):
+        return self.cache.get(key)
+
+    def set(self, key, body, created=None):
+        self.cache.set(key, body, created)
+        url = get_key_url(key)
+        if url:
+            self.index.add(get_group(url, self.s3_root), url, key)
+
+    def delete(self, key):
+        return self.cache.delete(key)
+
+
+def get_ban_pattern(bucket=None, filename=None, prefix=None, url=None):
+    """Returns a regular expression matching the request paths of the
+    renders to purge from a downstream cache. Paths carry the base64 of
+    the filename or url, so a filename prefix is matched by the base64 of
+    its longest part that encodes to whole characters."""
+    if url:
+        return "^/[^/]+/%s$" % re.escape(_b64encode(url))
+    path = "^/[^/]+/%s/" % re.escape(bucket)
+    if filename:
+        return path + "%s$" % re.escape(_b64encode(filename))
+    if prefix:
+        prefix = prefix.encode("utf-8")
+        prefix = prefix[:len(prefix) - len(prefix) % 3]
+        return path + re.escape(_b64encode(prefix))
+    return path
+
+
+def _b64encode(s):
+    if not isinstance(s, bytes):
+        s = s.encode("utf-8")
+    return base64.b64encode(s).decode("ascii")
+
+
+class PurgeHandler(AdminHandler):
+    """Purges the renders of one original, given by bucket and filename or
+    by url, or of all originals of a bucket, optionally only those whose
+    filename starts with prefix. Renders are removed from the caches and
+    the store of every node and banned from Varnish."""
+
+    @tornado.gen.coroutine
+    def post(self):
+        bucket = self.get_query_argument("bucket", None)
+        filename = self.get_query_argument("filename", None)
+        prefix = self.get_query_argument("prefix", None)
+        url = self.get_query_argument("url", None)
+        if not bucket and not url:
+            raise errors.UrlError("Missing bucket or url")
+        if url and (bucket or filename or prefix):
+            raise errors.UrlError("Url is exclusive of bucket")
+        if filename and prefix:
+            raise errors.UrlError("Filename is exclusive of prefix")
+
+        s3_root = self.settings.get("s3_root")
+        index = self.application.index
+        if url:
+            group, urls = get_group(url, s3_root), [url]
+        elif filename:
+            group, urls = bucket, [get_s3_url(s3_root, bucket, filename)]
+        elif index:
+            group = bucket
+            urls = index.get_urls(
+                bucket, get_s3_url(s3_root, bucket, prefix or ""))
+        else:
+            raise errors.DisabledError(
+                "Purging by prefix or bucket needs index_dir or cache_dir")
+
+        keys = yield self._purge(group, urls)
+        result = dict(urls=len(urls), keys=keys)
+        if not self.request.headers.get(FORWARDED_HEADER):
+            result["peers"] = yield self._purge_peers()
+            result["banned"] = yield self._ban(get_ban_pattern(
+                bucket=bucket, filename=filename, prefix=prefix, url=url))
+        self.application.metrics.incr("purge.requests")
+        self.application.metrics.incr("purge.keys", keys)
+        self.write_json(result)
+
+    @tornado.gen.coroutine
+    def _purge(self, group, urls):
+        """Removes the renders of urls from this node, returns their
+        number. Without an index, only the renders found in the caches of
+        this worker are counted."""
+        app = self.application
+        routes = app.get_route_params()
+        deletes = []
+        count = 0
+        for url in urls:
+            if app.index:
+                keys = app.index.get_keys(group, url)
+                count += len(keys)
+            else:
+                keys = get_route_keys(url, routes)
+            for key in keys:
+                found = app.peer_cache.delete(key)
+                if app.cache:
+                    found = app.cache.delete(key) or found
+                if found and not app.index:
+                    count += 1
+                if app.store:
+                    deletes.append(app.store.delete(key))
+            if app.index:
+                app.index.remove(group, url)
+        yield deletes
+        raise tornado.gen.Return(count)
+
+    @tornado.gen.coroutine
+    def _purge_peers(self):
+        """Sends the purge on to the other nodes, returns the number of
+        nodes that purged and failed, or None outside of a cluster."""
+        router = self.application.router
+        if not router:
+            raise tornado.gen.Return(None)
+        peers = [peer for peer in router.peers if peer != router.self_url]
+        responses = yield [self._fetch_peer(router, peer) for peer in peers]
+        raise tornado.gen.Return(dict(
+            purged=len([r for r in responses if r]),
+            failed=len([r for r in responses if not r])))
+
+    @tornado.gen.coroutine
+    def _fetch_peer(self, router, peer):
+        try:
+            resp = yield router.forward(
+                peer, self.request.uri, method="POST", body=b"",
+                request_timeout=self.settings.get("timeout"))
+        except Exception as e:
+            resp = None
+            error = str(e)
+        else:
+            error = "status %d" % resp.code if resp.code != 200 else None
+        if error:
+            logger.warn("Purge of %s failed: %s" % (peer, error))
+            self.application.metrics.incr("purge.peer_errors")
+            raise tornado.gen.Return(False)
+        raise tornado.gen.Return(True)
+
+    @tornado.gen.coroutine
+    def _ban(self, pattern):
+        """Bans the paths matching pattern from Varnish, returns whether it
+        did."""
+        varnish_url = self.settings.get("varnish_url")
+        if not varnish_url:
+            raise tornado.gen.Return(False)
+        client = tornado.httpclient.AsyncHTTPClient()
+        try:
+            yield client.fetch(
+                varnish_url.rstrip("/") + "/", method="BAN",
+                headers={"X-Ban-Url": pattern},
+                allow_nonstandard_methods=True,
+                request_timeout=self.settings.get("timeout"))
+        except Exception as e:
+            logger.warn("Varnish ban of %s failed: %s" % (pattern, e))
+            self.application.metrics.incr("purge.ban_errors")
+            raise tornado.gen.Return(False)
+        raise tornado.gen.Return(True)
@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+#
+# Copyright 2013 Adam Gschwender
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Caches the resolution of origin hosts.
+
+getaddrinfo does not report the TTL of a record, so entries are kept for a
+fixed number of seconds. Entries are refreshed in the background shortly
+before they expire, so that requests rarely wait on DNS. If a host cannot
+be resolved, its last good addresses are used for a grace period.
+"""
+
+from __future__ import absolute_import, division, print_function, \
+    with_statement
+
+import collections
+import logging
+import socket
+import time
+
+import tornado.concurrent
+import tornado.gen
+import tornado.ioloop
+import tornado.netutil
+
+logger = logging.getLogger("tornado.application")
+
+
+_Entry = collections.namedtuple("_Entry", ["addresses", "resolved"])
+
+
+def get_default_resolver():
+    """Returns a resolver that does not block the IOLoop. Tornado < 5
+    resolves on the IOLoop by default."""
+    if tornado.netutil.Resolver.configurable_default() is \
+            tornado.netutil.BlockingResolver:
+        return tornado.netutil.ThreadedResolver()
+    return tornado.netutil.Resolver()
+
+
+class CachingResolver(tornado.netutil.Resolver):
+    """Resolves with another resolver and caches the addresses for ttl
+    seconds. Once refresh of the ttl has passed, the next lookup is still
+    answered from the cache but triggers a refresh. Concurrent lookups of
+    the same host share one resolution. At most max_entries hosts are
+    kept, the least recently resolved are dropped first."""
+
+    def initialize(self, resolver=None, ttl=60, grace=300, refresh=0.8,
+                   max_entries=1024, metrics=None):
+        self.resolver = resolver or get_default_resolver()
+        self.ttl = ttl
+        self.grace = grace
+        self.refresh = refresh
+        self.max_entries = max_entries
+        self.metrics = metrics
+        self.entries = collections.OrderedDict()
+        self.pending = dict()
+
+    def close(self):
+        self.resolver.close()
+
+    def resolve(self, host, port, family=socket.AF_UNSPEC, callback=None):
+        future = self._resolve((host, port, family))
+        if callback is not None:
+            # Tornado < 4 passes a callback
+            tornado.ioloop.IOLoop.current().add_future(
+                future, lambda f: callback(f.result()))
+        return future
+
+    @tornado.gen.coroutine
+    def _resolve(self, key):
+        entry = self.entries.get(key)
+        age = time.time() - entry.resolved if entry else None
+        if entry and age < self.ttl:
+            self._incr("dns.hits")
+            if age >= self.ttl * self.refresh and key not in self.pending:
+                self._incr("dns.refreshes")
+                # Failures are counted and otherwise ignored
+                tornado.ioloop.IOLoop.current().add_future(
+                    self._lookup(key), lambda future: future.exception())
+            raise tornado.gen.Return(entry.addresses)
+
+        self._incr("dns.misses")
+        try:
+            addresses = yield self._lookup(key)
+        except Exception as e:
+            if entry is None or age >= self.ttl + self.grace:
+                raise
+            self._incr("dns.stale")
+            logger.warn("Using stale addresses of %s: %s" % (key[0], e))
+            addresses = entry.addresses
+        raise tornado.gen.Return(addresses)
+
+    def _lookup(self, key):
+        """Returns a Future to the addresses of key, which are cached once
+        resolved. Failures keep the previous entry."""
+        if key in self.pending:
+            return self.pending[key]
+        future = self._update(key)
+        if not future.done():
+            self.pending[key] = future
+        return future
+
+    @tornado.gen.coroutine
+    def _update(self, key):
+        try:
+            addresses = yield self.resolver.resolve(*key)
+        except Exception:
+            self._incr("dns.errors")
+            raise
+        finally:
+            self.pending.pop(key, None)
+        self.entries.pop(key, None)
+        self.entries[key] = _Entry(addresses, time.time())
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+        raise tornado.gen.Return(addresses)
+
+    def _incr(self, name):
+        if self.metrics:
+            self.metrics.incr(name)
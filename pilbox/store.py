@@ -0,0 +1,216 @@
+#!/usr/bin/env python
+#
+# Copyright 2013 Adam Gschwender
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Keeps rendered variants in an S3 compatible object store.
+
+Renders outlive the node that made them: a restarted or new node finds
+them in the store instead of rendering them again. Objects are named by
+the digest of their cache key under the configured url, e.g.
+https://s3.amazonaws.com/derivatives/pilbox/<sha1 of key>. Requests are
+signed with AWS signature version 4 if credentials are configured.
+"""
+
+from __future__ import absolute_import, division, print_function, \
+    with_statement
+
+import calendar
+import datetime
+import email.utils
+import hashlib
+import hmac
+import logging
+
+import tornado.gen
+import tornado.httpclient
+import tornado.ioloop
+
+from pilbox.cache import CacheEntry
+
+try:
+    from urllib import quote
+    from urlparse import urlparse
+except ImportError:
+    from urllib.parse import quote, urlparse
+
+logger = logging.getLogger("tornado.application")
+
+
+def _sha256(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def _hmac(key, msg):
+    return hmac.new(key, msg.encode("utf-8"), hashlib.sha256).digest()
+
+
+def sign_request(method, url, headers, body, access_key, secret_key,
+                 region, service="s3", now=None):
+    """Returns headers plus the AWS signature version 4 headers for the
+    request. All supplied headers are signed."""
+    now = now or datetime.datetime.utcnow()
+    amz_date = now.strftime("%Y%m%dT%H%M%SZ")
+    date = now.strftime("%Y%m%d")
+    parsed = urlparse(url)
+
+    headers = dict(headers)
+    headers["Host"] = parsed.netloc
+    headers["x-amz-date"] = amz_date
+    headers["x-amz-content-sha256"] = _sha256(body or b"")
+
+    canonical = sorted((k.lower(), " ".join(str(v).split()))
+                       for k, v in headers.items())
+    signed_headers = ";".join(k for k, _ in canonical)
+    query = "&".join(sorted(part for part in parsed.query.split("&")
+                            if part))
+    canonical_request = "\n".join([
+        method, quote(parsed.path or "/", safe="/~"), query,
+        "".join("%s:%s\n" % (k, v) for k, v in canonical),
+        signed_headers, headers["x-amz-content-sha256"]])
+
+    scope = "%s/%s/%s/aws4_request" % (date, region, service)
+    string_to_sign = "\n".join([
+        "AWS4-HMAC-SHA256", amz_date, scope,
+        _sha256(canonical_request.encode("utf-8"))])
+    key = ("AWS4" + secret_key).encode("utf-8")
+    for part in (date, region, service, "aws4_request"):
+        key = _hmac(key, part)
+    signature = hmac.new(key, string_to_sign.encode("utf-8"),
+                         hashlib.sha256).hexdigest()
+
+    headers["Authorization"] = (
+        "AWS4-HMAC-SHA256 Credential=%s/%s, SignedHeaders=%s, "
+        "Signature=%s" % (access_key, scope, signed_headers, signature))
+    return headers
+
+
+def _get_modified(resp):
+    """Returns the Last-Modified time of resp as a timestamp or None."""
+    parsed = email.utils.parsedate(resp.headers.get("Last-Modified", ""))
+    return calendar.timegm(parsed) if parsed else None
+
+
+class ObjectStore(object):
+    """Reads and writes renders in the store. Writes are started in the
+    background and never waited on; at most max_uploads are pending, more
+    are dropped. The store has its own client, which makes at most
+    max_clients requests at once, so that uploads never hold up the
+    fetches of originals."""
+
+    def __init__(self, url, access_key=None, secret_key=None,
+                 region="us-east-1", timeout=2, max_uploads=100,
+                 max_clients=10, metrics=None):
+        self.url = url.rstrip("/")
+        self.access_key = access_key
+        self.secret_key = secret_key
+        self.region = region
+        self.timeout = timeout
+        self.max_uploads = max_uploads
+        self.max_clients = max_clients
+        self.metrics = metrics
+        self.uploads = 0
+        self.client = None
+
+    def get_client(self):
+        # Created on first use, i.e. in the worker after the server forked
+        if self.client is None:
+            self.client = tornado.httpclient.AsyncHTTPClient(
+                force_instance=True, max_clients=self.max_clients)
+        return self.client
+
+    def close(self):
+        if self.client is not None:
+            self.client.close()
+            self.client = None
+
+    def get_url(self, key):
+        digest = hashlib.sha1(key.encode("utf-8")).hexdigest()
+        return "%s/%s" % (self.url, digest)
+
+    @tornado.gen.coroutine
+    def get(self, key, timeout=None):
+        """Returns the CacheEntry of key or None if it is not stored or the
+        store cannot be reached."""
+        request = self._request(key, "GET", timeout=timeout)
+        try:
+            resp = yield self.get_client().fetch(request)
+        except tornado.httpclient.HTTPError as e:
+            if e.code == 404:
+                self._incr("store.misses")
+            else:
+                logger.warn("Store error for %s: %s" % (request.url, e))
+                self._incr("store.errors")
+            raise tornado.gen.Return(None)
+        except Exception as e:
+            logger.warn("Store error for %s: %s" % (request.url, e))
+            self._incr("store.errors")
+            raise tornado.gen.Return(None)
+        self._incr("store.hits")
+        raise tornado.gen.Return(CacheEntry(resp.body, _get_modified(resp)))
+
+    def put(self, key, body):
+        """Uploads body under key in the background."""
+        if self.uploads >= self.max_uploads:
+            self._incr("store.uploads_dropped")
+            return
+        self.uploads += 1
+        request = self._request(key, "PUT", body,
+                                {"Content-Type": "image/jpeg"})
+        tornado.ioloop.IOLoop.current().add_future(
+            self.get_client().fetch(request), self._on_put)
+
+    @tornado.gen.coroutine
+    def delete(self, key):
+        """Removes key from the store, returns whether it succeeded. Keys
+        that are not stored count as removed."""
+        request = self._request(key, "DELETE")
+        try:
+            yield self.get_client().fetch(request)
+        except tornado.httpclient.HTTPError as e:
+            if e.code != 404:
+                logger.warn("Store error for %s: %s" % (request.url, e))
+                self._incr("store.errors")
+                raise tornado.gen.Return(False)
+        except Exception as e:
+            logger.warn("Store error for %s: %s" % (request.url, e))
+            self._incr("store.errors")
+            raise tornado.gen.Return(False)
+        self._incr("store.deletes")
+        raise tornado.gen.Return(True)
+
+    def _on_put(self, future):
+        self.uploads -= 1
+        try:
+            future.result()
+        except Exception as e:
+            logger.warn("Store upload failed: %s" % e)
+            self._incr("store.upload_errors")
+        else:
+            self._incr("store.uploads")
+
+    def _request(self, key, method, body=None, headers=None, timeout=None):
+        url = self.get_url(key)
+        headers = headers or dict()
+        if self.access_key and self.secret_key:
+            headers = sign_request(method, url, headers, body,
+                                   self.access_key, self.secret_key,
+                                   self.region)
+        return tornado.httpclient.HTTPRequest(
+            url, method=method, body=body, headers=headers,
+            request_timeout=timeout or self.timeout)
+
+    def _incr(self, name):
+        if self.metrics:
+            self.metrics.incr(name)
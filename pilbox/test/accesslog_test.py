@@ -0,0 +1,125 @@
+from __future__ import absolute_import, division, with_statement
+
+import os.path
+import shutil
+import tempfile
+
+from tornado.test.util import unittest
+from tornado.testing import AsyncHTTPTestCase
+
+from pilbox.accesslog import AccessLog, read_records
+from pilbox.test.handler_test import _HandlerTestMixin, b64
+
+try:
+    import cv2
+except ImportError:
+    cv2 = None
+
+
+class AccessLogTest(unittest.TestCase):
+    def setUp(self):
+        self.path = os.path.join(tempfile.mkdtemp(), "access.log")
+
+    def tearDown(self):
+        shutil.rmtree(os.path.dirname(self.path))
+
+    def read(self):
+        with open(self.path) as f:
+            return list(read_records(f))
+
+    def test_write(self):
+        log = AccessLog(self.path)
+        log.write(dict(uri="/a/1"))
+        log.write(dict(uri="/a/2"))
+        log.close()
+        log.write(dict(uri="/a/3"))
+        log.close()
+        self.assertEqual([r["uri"] for r in self.read()],
+                         ["/a/1", "/a/2", "/a/3"])
+
+    def test_dropped(self):
+        log = AccessLog(self.path, max_pending=1)
+        # Hold the thread back by filling the queue before it starts
+        log.thread = False
+        log.write(dict(uri="/a/1"))
+        log.write(dict(uri="/a/2"))
+        self.assertEqual(log.dropped, 1)
+        log.thread = None
+        log.close()
+
+    def test_write_error(self):
+        log = AccessLog(os.path.join(self.path, "missing", "access.log"))
+        log.write(dict(uri="/a/1"))
+        log.close()
+        self.assertEqual(log.dropped, 1)
+
+    def test_read_records(self):
+        with open(self.path, "w") as f:
+            f.write('{"uri": "/a/1"}\n[1]\n{"uri": "/a/2"}\n{"uri": "/a')
+        with open(self.path) as f:
+            self.assertEqual(list(read_records(f)),
+                             [dict(uri="/a/1"), dict(uri="/a/2")])
+
+
+class AccessLogHandlerTest(_HandlerTestMixin, AsyncHTTPTestCase):
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        super(AccessLogHandlerTest, self).setUp()
+
+    def tearDown(self):
+        super(AccessLogHandlerTest, self).tearDown()
+        shutil.rmtree(self.cache_dir)
+
+    def get_app_settings(self):
+        return dict(timeout=10.0, cache_dir=self.cache_dir,
+                    access_log=os.path.join(self.cache_dir, "access.log"))
+
+    def read(self):
+        self._app.access_log.close()
+        with open(self._app.settings["access_log"]) as f:
+            return list(read_records(f))
+
+    def test_image(self):
+        path = "/a/bucket/%s" % b64("test1.jpg")
+        self.fetch_image(path)
+        self.fetch_image(path)
+        self.fetch("/metrics")
+        miss, hit = self.read()
+        self.assertEqual(miss["uri"], path)
+        self.assertEqual(miss["status"], 200)
+        self.assertEqual(miss["route"], "a")
+        self.assertEqual(miss["bucket"], "bucket")
+        self.assertEqual(miss["cache"], "miss")
+        self.assertEqual((miss["source_width"], miss["source_height"]),
+                         (384, 480))
+        self.assertTrue(miss["source_bytes"] > miss["bytes"] > 0)
+        for stage in ("fetch", "resize", "encode"):
+            self.assertTrue(0 <= miss[stage] <= miss["total"], stage)
+        # Pillow decodes while resizing, rather than logging 0
+        self.assertFalse("decode" in miss)
+        self.assertEqual(hit["cache"], "hit")
+        self.assertEqual(hit["bytes"], miss["bytes"])
+        self.assertFalse("fetch" in hit)
+
+    @unittest.skipIf(cv2 is None, "OpenCV is not installed")
+    def test_decode_timed(self):
+        self._app.settings["backend"] = "opencv"
+        self.fetch_image("/a/bucket/%s" % b64("test1.jpg"))
+        self.fetch("/metrics")
+        record, = self.read()
+        self.assertTrue(0 <= record["decode"] <= record["total"])
+
+    def test_error(self):
+        self.fetch_error(404, "/a/bucket/%s" % b64("missing.jpg"))
+        record, = self.read()
+        self.assertEqual(record["status"], 404)
+        self.assertTrue("fetch" in record)
+        self.assertFalse("bytes" in record)
+
+    def test_multi(self):
+        self.fetch("/multi/a?i=bucket/%s&i=bucket/%s"
+                   % (b64("test1.jpg"), b64("test1.jpg")))
+        record, = self.read()
+        self.assertEqual(record["route"], "multi")
+        self.assertEqual(record["images"], 2)
+        self.assertEqual(sum(record["cache"].values()), 2)
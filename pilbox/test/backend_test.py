@@ -0,0 +1,137 @@
+from __future__ import absolute_import, division, with_statement
+
+import os.path
+
+import PIL.Image
+from tornado.test.util import unittest
+
+from pilbox.backend import OpenCVBackend, PillowBackend, get_backend
+from pilbox.image import Image
+from pilbox.test.benchmark import DATADIR, psnr
+
+try:
+    from io import BytesIO
+except ImportError:
+    from cStringIO import StringIO as BytesIO
+
+try:
+    import cv2
+except ImportError:
+    cv2 = None
+
+
+def _open(filename):
+    with open(os.path.join(DATADIR, filename), "rb") as f:
+        return BytesIO(f.read())
+
+
+class GetBackendTest(unittest.TestCase):
+    def test_default(self):
+        self.assertTrue(isinstance(get_backend(), PillowBackend))
+        self.assertTrue(isinstance(get_backend("pillow"), PillowBackend))
+
+    def test_unknown(self):
+        self.assertRaises(ValueError, get_backend, "foo")
+
+    @unittest.skipIf(cv2 is not None, "OpenCV is installed")
+    def test_opencv_missing(self):
+        self.assertRaises(RuntimeError, get_backend, "opencv")
+
+
+class _BackendTestMixin(object):
+    def test_resize(self):
+        for filename in ["test1.jpg", "test2.png", "test4.webp"]:
+            outfile = Image(_open(filename), self.backend) \
+                .resize(100, 100).save()
+            img = PIL.Image.open(outfile)
+            self.assertEqual(img.format, "JPEG")
+            self.assertEqual(max(img.size), 100)
+
+    def test_fast_resize(self):
+        outfile = Image(_open("test1.jpg"), self.backend) \
+            .resize(100, 100, fast=True).save()
+        self.assertEqual(PIL.Image.open(outfile).size, (80, 100))
+
+    def test_no_enlarge(self):
+        outfile = Image(_open("test1.jpg"), self.backend) \
+            .resize(1000, 1000).save()
+        self.assertEqual(PIL.Image.open(outfile).size, (384, 480))
+
+    def test_single_dimension(self):
+        outfile = Image(_open("test1.jpg"), self.backend) \
+            .resize(None, 120).save()
+        self.assertEqual(PIL.Image.open(outfile).size, (96, 120))
+
+    def test_encoder_profile(self):
+        image = Image(_open("test1.jpg"), self.backend).resize(100, 100)
+        default = image.save().getvalue()
+        smaller = image.save(quality=60, optimize=True).getvalue()
+        self.assertTrue(len(smaller) < len(default))
+        img = PIL.Image.open(image.save(progressive=True))
+        self.assertTrue(img.info.get("progressive"))
+
+
+class PillowBackendTest(_BackendTestMixin, unittest.TestCase):
+    def setUp(self):
+        self.backend = PillowBackend()
+
+    def test_keep_metadata(self):
+        src = PIL.Image.new("RGB", (200, 200), "red")
+        stream = BytesIO()
+        src.save(stream, "JPEG", icc_profile=b"profile")
+        stream.seek(0)
+        image = Image(stream, self.backend).resize(100, 100)
+        kept = PIL.Image.open(image.save(strip=False))
+        self.assertEqual(kept.info.get("icc_profile"), b"profile")
+        stripped = PIL.Image.open(image.save())
+        self.assertEqual(stripped.info.get("icc_profile"), None)
+
+
+@unittest.skipIf(cv2 is None, "OpenCV is not installed")
+class OpenCVBackendTest(_BackendTestMixin, unittest.TestCase):
+    def setUp(self):
+        self.backend = OpenCVBackend()
+
+    def test_matches_pillow(self):
+        for filename in ["test1.jpg", "test2.png", "test4.webp"]:
+            pillow = PIL.Image.open(
+                Image(_open(filename)).resize(100, 100).save())
+            opencv = PIL.Image.open(
+                Image(_open(filename), self.backend).resize(100, 100).save())
+            self.assertEqual(pillow.size, opencv.size)
+            self.assertTrue(psnr(pillow, opencv) > 25, filename)
+
+    def test_exif_orientation_ignored(self):
+        # Like Pillow, OpenCV must not apply the EXIF orientation
+        src = PIL.Image.new("RGB", (480, 384), "red")
+        exif = PIL.Image.Exif()
+        exif[0x0112] = 6
+        stream = BytesIO()
+        src.save(stream, "JPEG", exif=exif.tobytes())
+        for w, h in [(1000, 1000), (100, 100)]:
+            stream.seek(0)
+            pillow = PIL.Image.open(Image(BytesIO(stream.getvalue()))
+                                    .resize(w, h).save())
+            opencv = PIL.Image.open(Image(BytesIO(stream.getvalue()),
+                                          self.backend).resize(w, h).save())
+            self.assertEqual(pillow.size, opencv.size)
+
+    def test_pillow_fallback(self):
+        # OpenCV cannot decode GIFs, these are decoded by Pillow
+        img = PIL.Image.open(_open("test5.gif"))
+        pixels = self.backend._decode(
+            self.backend.open(img, _open("test5.gif")))
+        self.assertEqual(pixels.shape, (388, 600, 3))
+
+    def test_transparent(self):
+        src = PIL.Image.new("RGBA", (400, 300), (0, 0, 0, 0))
+        src.paste((255, 0, 0, 255), (0, 0, 200, 300))
+        stream = BytesIO()
+        src.save(stream, "PNG")
+        stream.seek(0)
+        img = PIL.Image.open(
+            Image(stream, self.backend).resize(100, 100).save())
+        self.assertEqual(img.mode, "RGB")
+        left, right = img.getpixel((5, 37)), img.getpixel((95, 37))
+        self.assertTrue(left[0] > 240 and left[1] < 15, left)
+        self.assertTrue(min(right) > 240, right)
@@ -0,0 +1,96 @@
+from __future__ import absolute_import, division, with_statement
+
+import os
+import os.path
+import shutil
+import tempfile
+
+import PIL.Image
+from tornado.test.util import unittest
+
+from pilbox import batch
+from pilbox.app import PilboxApplication
+from pilbox.cache import FileCache, make_key
+from pilbox.purge import get_group
+
+try:
+    from io import BytesIO
+except ImportError:
+    from cStringIO import StringIO as BytesIO
+
+
+DATADIR = os.path.join(os.path.dirname(__file__), "data")
+
+
+class BatchTest(unittest.TestCase):
+    def setUp(self):
+        self.source_dir = tempfile.mkdtemp()
+        self.cache_dir = tempfile.mkdtemp()
+        dirname = os.path.join(self.source_dir, "bucket", "product-pictures")
+        os.makedirs(dirname)
+        for filename in ["test1.jpg", "test2.png"]:
+            shutil.copy(os.path.join(DATADIR, filename),
+                        os.path.join(dirname, filename))
+        shutil.copy(os.path.join(DATADIR, "test1.jpg"),
+                    os.path.join(dirname, "with space.jpg"))
+        with open(os.path.join(dirname, "broken.jpg"), "wb") as f:
+            f.write(b"not an image")
+
+    def tearDown(self):
+        shutil.rmtree(self.source_dir)
+        shutil.rmtree(self.cache_dir)
+
+    def test_get_routes(self):
+        routes = batch.get_routes(PilboxApplication())
+        self.assertEqual(routes, [
+            dict(w=100, h=100, quality=80, optimize=True),
+            dict(w=500, h=500, progressive=True)])
+
+    def test_iter_paths_walk(self):
+        paths = list(batch.iter_paths(self.source_dir))
+        self.assertEqual(len(paths), 4)
+        self.assertTrue(os.path.join("bucket", "product-pictures",
+                                     "test1.jpg") in paths)
+
+    def test_iter_paths_manifest(self):
+        manifest = os.path.join(self.source_dir, "manifest.txt")
+        with open(manifest, "w") as f:
+            f.write("# comment\n/bucket/product-pictures/test1.jpg\n\n")
+        paths = list(batch.iter_paths(self.source_dir, manifest))
+        self.assertEqual(paths, ["bucket/product-pictures/test1.jpg"])
+
+    def test_get_url(self):
+        self.assertEqual(
+            batch.get_url("http://s3", "b/product-pictures/a b.jpg"),
+            "http://s3/b/product-pictures/a%20b.jpg")
+
+    def test_run(self):
+        routes = [dict(w=100, h=100), dict(w=500, h=500)]
+        stats = batch.run(self.source_dir, self.cache_dir, "http://s3",
+                          routes, processes=2)
+        self.assertEqual(stats["files"], 4)
+        self.assertEqual(stats["outputs"], 6)
+        self.assertEqual(stats["errors"], 1)
+        self.assertTrue(stats["bytes"] > 0)
+
+        cache = FileCache(self.cache_dir)
+        for url in ["http://s3/bucket/product-pictures/test1.jpg",
+                    "http://s3/bucket/product-pictures/with%20space.jpg"]:
+            entry = cache.get(make_key(url, w=100, h=100))
+            img = PIL.Image.open(BytesIO(entry.body))
+            self.assertEqual(img.format, "JPEG")
+            self.assertEqual(max(img.size), 100)
+
+    def test_index_dir(self):
+        # Indexed where the server looks purges up, see get_index()
+        index_dir = os.path.join(self.cache_dir, "purge-index")
+        routes = [dict(w=100, h=100)]
+        batch.run(self.source_dir, self.cache_dir, "http://s3", routes,
+                  processes=1, index_dir=index_dir)
+        app = PilboxApplication(cache_dir=self.cache_dir,
+                                index_dir=index_dir, s3_root="http://s3")
+        url = "http://s3/bucket/product-pictures/test1.jpg"
+        self.assertEqual(app.index.get_keys(get_group(url, "http://s3"), url),
+                         [make_key(url, w=100, h=100)])
+        self.assertFalse(os.path.exists(os.path.join(self.cache_dir,
+                                                     "index")))
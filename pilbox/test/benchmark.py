@@ -0,0 +1,344 @@
+#!/usr/bin/env python
+#
+# Copyright 2013 Adam Gschwender
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Benchmarks of the image pipeline. Run all benchmarks or only the named
+ones against the test images or a corpus of real originals, e.g.
+
+    $ python -m pilbox.test.benchmark resample
+    $ python -m pilbox.test.benchmark --corpus=/mnt/originals --upscale=1
+"""
+
+from __future__ import absolute_import, division, print_function, \
+    with_statement
+
+import math
+import os
+import os.path
+import re
+import sys
+import time
+
+import PIL.Image
+import PIL.ImageChops
+import tornado.options
+from tornado.options import define, options
+
+from pilbox.backend import BACKENDS, get_backend
+from pilbox.image import Image
+
+try:
+    from io import BytesIO
+except ImportError:
+    from cStringIO import StringIO as BytesIO
+
+
+DATADIR = os.path.join(os.path.dirname(__file__), "data")
+EXPECTED_DATADIR = os.path.join(DATADIR, "expected")
+
+define("corpus", help="directory of source images", default=DATADIR)
+define("sizes", help="comma separated target sizes", default="100x100,500x500")
+define("repeat", help="number of timed runs, the best is reported",
+       type=int, default=3)
+define("upscale", help="enlarge sources by this factor to emulate large "
+       "originals", type=int, default=4)
+
+BENCHMARKS = []
+
+
+def benchmark(fn):
+    BENCHMARKS.append(fn)
+    return fn
+
+
+def psnr(a, b):
+    """Returns the peak signal-to-noise ratio in dB between two images of
+    the same size, higher is more similar and identical images are inf."""
+    a, b = a.convert("RGB"), b.convert("RGB")
+    histogram = PIL.ImageChops.difference(a, b).histogram()
+    squares = sum(count * ((i % 256) ** 2)
+                  for i, count in enumerate(histogram))
+    mse = squares / (a.size[0] * a.size[1] * 3)
+    if not mse:
+        return float("inf")
+    return 10 * math.log10(255 ** 2 / mse)
+
+
+def load_corpus(path, upscale=1):
+    """Returns a list of (name, encoded bytes) of the images in path."""
+    corpus = []
+    for filename in sorted(os.listdir(path)):
+        filepath = os.path.join(path, filename)
+        if not os.path.isfile(filepath):
+            continue
+        try:
+            img = PIL.Image.open(filepath)
+        except IOError:
+            continue
+        if img.format.lower() not in Image.FORMATS:
+            continue
+        if upscale > 1:
+            fmt = img.format
+            size = (img.size[0] * upscale, img.size[1] * upscale)
+            img = img.resize(size, PIL.Image.BICUBIC)
+            outfile = BytesIO()
+            img.save(outfile, fmt)
+            data = outfile.getvalue()
+        else:
+            with open(filepath, "rb") as f:
+                data = f.read()
+        corpus.append((filename, data))
+    return corpus
+
+
+def get_sizes():
+    return [tuple(int(x) for x in size.split("x"))
+            for size in options.sizes.split(",")]
+
+
+def best_time(fn, repeat):
+    """Returns the fastest of repeat runs of fn in seconds."""
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+        fn()
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def iter_expected_clips():
+    """Yields (source path, expected path, width, height) of the expected
+    clip outputs."""
+    for filename in sorted(os.listdir(EXPECTED_DATADIR)):
+        m = re.match(r"^([^-]+)-(\d+)x(\d+)-clip\.[^\.]+$", filename)
+        if not m:
+            continue
+        sources = [f for f in os.listdir(DATADIR)
+                   if os.path.splitext(f)[0] == m.group(1)]
+        if sources:
+            yield (os.path.join(DATADIR, sources[0]),
+                   os.path.join(EXPECTED_DATADIR, filename),
+                   int(m.group(2)), int(m.group(3)))
+
+
+def resize(data, size, fast):
+    return Image(BytesIO(data)).resize(size[0], size[1], fast=fast).img
+
+
+@benchmark
+def resample(corpus):
+    """Compares the quality and fast resample modes of Image.resize."""
+    print("%-10s %10s %10s %8s %8s" % (
+        "size", "quality ms", "fast ms", "speedup", "psnr dB"))
+    for size in get_sizes():
+        times = dict()
+        for fast in (False, True):
+            times[fast] = best_time(
+                lambda: [resize(data, size, fast) for _, data in corpus],
+                options.repeat) / len(corpus) * 1000
+        similarity = min(psnr(resize(data, size, False),
+                              resize(data, size, True))
+                         for _, data in corpus)
+        print("%-10s %10.2f %10.2f %7.2fx %8.2f" % (
+            "%dx%d" % size, times[False], times[True],
+            times[False] / times[True], similarity))
+
+    print("\nDifference to the expected clip outputs, psnr dB")
+    print("%-40s %8s %8s" % ("expected", "quality", "fast"))
+    for source_path, expected_path, width, height in iter_expected_clips():
+        expected = PIL.Image.open(expected_path)
+        with open(source_path, "rb") as f:
+            data = f.read()
+        print("%-40s %8.2f %8.2f" % (
+            os.path.basename(expected_path),
+            psnr(resize(data, (width, height), False), expected),
+            psnr(resize(data, (width, height), True), expected)))
+
+
+@benchmark
+def backends(corpus):
+    """Compares the throughput of the image backends, in megapixels of
+    source image resized and encoded per second."""
+    available = []
+    for name in sorted(BACKENDS):
+        try:
+            available.append(get_backend(name))
+        except RuntimeError as e:
+            print("Skipping %s: %s" % (name, e))
+
+    # Only compare on images every backend can process
+    supported = []
+    for name, data in corpus:
+        try:
+            for backend in available:
+                Image(BytesIO(data), backend).save()
+        except (IOError, OSError) as e:
+            print("Skipping %s: %s" % (name, e))
+        else:
+            supported.append((name, data))
+    corpus = supported
+    pixels = sum(PIL.Image.open(BytesIO(data)).size[0] *
+                 PIL.Image.open(BytesIO(data)).size[1]
+                 for _, data in corpus)
+
+    print("%-10s %-8s %10s %10s" % ("size", "backend", "ms/image", "MP/s"))
+    for size in get_sizes():
+        for fast in (False, True):
+            for backend in available:
+                elapsed = best_time(
+                    lambda: [Image(BytesIO(data), backend)
+                             .resize(size[0], size[1], fast=fast).save()
+                             for _, data in corpus],
+                    options.repeat)
+                print("%-10s %-8s %10.2f %10.2f" % (
+                    "%dx%d%s" % (size + ("f" if fast else "",)),
+                    backend.name, elapsed / len(corpus) * 1000,
+                    pixels / elapsed / 1e6))
+
+
+def get_mode_variants(corpus):
+    """Returns a list of (name, mode, encoded bytes) with palette, RGBA and
+    CMYK versions of every image in corpus, saved as GIF, PNG and JPEG."""
+    variants = []
+    for name, data in corpus:
+        img = PIL.Image.open(BytesIO(data))
+        for mode, fmt in (("P", "GIF"), ("RGBA", "PNG"), ("CMYK", "JPEG")):
+            if img.mode == mode:
+                variant = data
+            else:
+                converted = img.convert("RGB").convert(mode)
+                if mode == "RGBA":
+                    # Fade the alpha channel so compositing matters
+                    alpha = PIL.Image.linear_gradient("L") \
+                        if hasattr(PIL.Image, "linear_gradient") else None
+                    if alpha:
+                        converted.putalpha(alpha.resize(converted.size))
+                outfile = BytesIO()
+                converted.save(outfile, fmt)
+                variant = outfile.getvalue()
+            variants.append((name, mode, variant))
+    return variants
+
+
+def convert_first(data, size):
+    """The naive pipeline, converting to RGB at the full source size."""
+    img = PIL.Image.open(BytesIO(data))
+    if img.mode in ("RGBA", "LA") or "transparency" in img.info:
+        rgba = img.convert("RGBA")
+        img = PIL.Image.new("RGB", rgba.size, (255, 255, 255))
+        img.paste(rgba, mask=rgba.split()[-1])
+    else:
+        img = img.convert("RGB")
+    img.thumbnail(size, PIL.Image.ANTIALIAS)
+    outfile = BytesIO()
+    img.save(outfile, "JPEG", quality=85)
+    return outfile
+
+
+@benchmark
+def conversion(corpus):
+    """Compares converting palette, RGBA and CMYK sources to RGB at full
+    size against converting them at the cheapest point in the pipeline."""
+    variants = get_mode_variants(corpus)
+    print("%-10s %-5s %10s %10s %10s %8s" % (
+        "size", "mode", "first ms", "ours ms", "fast ms", "psnr dB"))
+    for size in get_sizes():
+        for mode in ("P", "RGBA", "CMYK"):
+            datas = [data for _, m, data in variants if m == mode]
+            first = best_time(
+                lambda: [convert_first(data, size) for data in datas],
+                options.repeat)
+            times = dict()
+            for fast in (False, True):
+                times[fast] = best_time(
+                    lambda: [Image(BytesIO(data))
+                             .resize(size[0], size[1], fast=fast).save()
+                             for data in datas],
+                    options.repeat)
+            similarity = min(
+                psnr(PIL.Image.open(convert_first(data, size)),
+                     PIL.Image.open(Image(BytesIO(data))
+                                    .resize(size[0], size[1]).save()))
+                for data in datas)
+            print("%-10s %-5s %10.2f %10.2f %10.2f %8.2f" % (
+                "%dx%d" % size, mode, first / len(datas) * 1000,
+                times[False] / len(datas) * 1000,
+                times[True] / len(datas) * 1000, similarity))
+
+
+def get_profiles():
+    """Returns a list of (name, profile) to compare: the defaults, the
+    profiles of pilbox.app and each setting on its own."""
+    from pilbox.app import PROFILES
+    profiles = [("default", dict())]
+    profiles.extend(sorted(PROFILES.items()))
+    profiles.extend([("q75", dict(quality=75)),
+                     ("4:4:4", dict(subsampling="4:4:4")),
+                     ("progressive", dict(progressive=True)),
+                     ("optimize", dict(optimize=True))])
+    return profiles
+
+
+@benchmark
+def profiles(corpus):
+    """Compares the encoder profiles by output bytes, bytes saved against
+    the defaults, encode time and similarity to the resized source. Only
+    the encode is timed, every profile encodes the same resized image."""
+    print("%-10s %-12s %10s %8s %10s %8s" % (
+        "size", "profile", "bytes", "saved", "encode ms", "psnr dB"))
+    for size in get_sizes():
+        resized = []
+        for _, data in corpus:
+            image = Image(BytesIO(data)).resize(size[0], size[1])
+            reference = PIL.Image.open(image.save(quality=100,
+                                                  subsampling="4:4:4"))
+            resized.append((image, reference))
+        baseline = None
+        for name, profile in get_profiles():
+            outputs = [image.save(**profile).getvalue()
+                       for image, _ in resized]
+            elapsed = best_time(
+                lambda: [image.save(**profile) for image, _ in resized],
+                options.repeat)
+            total = sum(len(output) for output in outputs)
+            baseline = baseline or total
+            similarity = sum(psnr(PIL.Image.open(BytesIO(output)), ref)
+                             for output, (_, ref) in zip(outputs, resized))
+            print("%-10s %-12s %10d %7.1f%% %10.2f %8.2f" % (
+                "%dx%d" % size, name, total // len(corpus),
+                (1 - total / baseline) * 100,
+                elapsed / len(corpus) * 1000, similarity / len(corpus)))
+
+
+def main():
+    names = tornado.options.parse_command_line()
+    corpus = []
+    if os.path.isdir(options.corpus):
+        corpus = load_corpus(options.corpus, options.upscale)
+    if not corpus:
+        print("No images found in %s" % options.corpus)
+        sys.exit(1)
+    print("Corpus of %d images from %s\n" % (len(corpus), options.corpus))
+    for fn in BENCHMARKS:
+        if names and fn.__name__ not in names:
+            continue
+        print("== %s: %s\n" % (fn.__name__, fn.__doc__))
+        fn(corpus)
+        print("")
+
+
+if __name__ == "__main__":
+    main()
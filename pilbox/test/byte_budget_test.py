@@ -0,0 +1,83 @@
+from __future__ import absolute_import, division, with_statement
+
+import os.path
+
+from tornado.test.util import unittest
+
+from pilbox.app import get_render_params, render
+from pilbox.image import Image, QualityEstimator
+from pilbox.test.benchmark import DATADIR
+
+try:
+    from io import BytesIO
+except ImportError:
+    from cStringIO import StringIO as BytesIO
+
+
+def _resized(filename="test1.jpg", size=300):
+    with open(os.path.join(DATADIR, filename), "rb") as f:
+        return Image(BytesIO(f.read())).resize(size, size)
+
+
+class ByteBudgetTest(unittest.TestCase):
+    def setUp(self):
+        self.estimator = QualityEstimator()
+
+    def test_fits_budget(self):
+        image = _resized()
+        limit = len(image.save(quality=90).getvalue()) // 2
+        outfile = image.save(quality=90, max_bytes=limit,
+                             estimator=self.estimator)
+        size = len(outfile.getvalue())
+        self.assertTrue(limit * 0.7 < size <= limit, size)
+        self.assertEqual(self.estimator.get_hit_rate(), 1)
+        self.assertTrue(self.estimator.encodes <= 4)
+
+    def test_highest_quality(self):
+        image = _resized()
+        outfile = image.save(quality=90, max_bytes=10 ** 7,
+                             estimator=self.estimator)
+        self.assertEqual(outfile.getvalue(), image.save(quality=90).getvalue())
+        self.assertEqual(self.estimator.encodes, 1)
+
+    def test_unreachable_budget(self):
+        image = _resized()
+        outfile = image.save(quality=90, max_bytes=100,
+                             estimator=self.estimator)
+        self.assertEqual(outfile.getvalue(),
+                         image.save(quality=30).getvalue())
+        self.assertEqual(self.estimator.get_hit_rate(), 0)
+
+    def test_seeded_by_previous(self):
+        image = _resized()
+        limit = len(image.save(quality=60).getvalue())
+        image.save(quality=90, max_bytes=limit, estimator=self.estimator)
+        encodes = self.estimator.encodes
+        image.save(quality=90, max_bytes=limit, estimator=self.estimator)
+        self.assertEqual(self.estimator.encodes, encodes + 1)
+        self.assertEqual(self.estimator.get_encodes_per_search(),
+                         (encodes + 1) / 2)
+
+    def test_webp(self):
+        image = _resized()
+        limit = len(image.save(quality=60, format="WEBP").getvalue())
+        outfile = image.save(quality=90, max_bytes=limit, format="WEBP",
+                             estimator=self.estimator)
+        self.assertTrue(len(outfile.getvalue()) <= limit)
+        self.assertEqual(outfile.getvalue()[8:12], b"WEBP")
+
+    def test_mobile_profile(self):
+        params = get_render_params(300, 300, profile="mobile")
+        self.assertEqual(params["max_bytes"], 8192)
+        with open(os.path.join(DATADIR, "test1.jpg"), "rb") as f:
+            outfile = render(BytesIO(f.read()), **params)
+        self.assertTrue(len(outfile.getvalue()) <= 8192)
+
+    def test_groups(self):
+        group = self.estimator.get_group(8192, (100, 100), "JPEG")
+        self.assertEqual(group, self.estimator.get_group(8192, (90, 110),
+                                                         "JPEG"))
+        self.assertNotEqual(group, self.estimator.get_group(8192, (500, 500),
+                                                            "JPEG"))
+        self.assertNotEqual(group, self.estimator.get_group(4096, (100, 100),
+                                                            "JPEG"))
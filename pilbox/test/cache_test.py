@@ -0,0 +1,222 @@
+from __future__ import absolute_import, division, with_statement
+
+import os
+import os.path
+import shutil
+import tempfile
+import time
+
+from tornado.test.util import unittest
+
+from pilbox.cache import FileCache, MemoryCache, SharedMemoryCache, \
+    TieredCache, make_key
+from pilbox.metrics import Metrics
+
+
+class MakeKeyTest(unittest.TestCase):
+    def test_deterministic(self):
+        self.assertEqual(make_key("http://a/b.jpg", w=1, h=2),
+                         make_key("http://a/b.jpg", h=2, w=1))
+
+    def test_params_distinguish(self):
+        self.assertNotEqual(make_key("http://a/b.jpg", w=1, h=2),
+                            make_key("http://a/b.jpg", w=2, h=1))
+        self.assertNotEqual(make_key("http://a/b.jpg", w=1, h=2),
+                            make_key("http://a/c.jpg", w=1, h=2))
+
+
+class FileCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.cache = FileCache(self.path)
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_miss(self):
+        self.assertEqual(self.cache.get("foo"), None)
+
+    def test_set_get(self):
+        self.cache.set("foo", b"bar")
+        entry = self.cache.get("foo")
+        self.assertEqual(entry.body, b"bar")
+        self.assertTrue(entry.created > 0)
+
+    def test_overwrite(self):
+        self.cache.set("foo", b"bar")
+        self.cache.set("foo", b"baz")
+        self.assertEqual(self.cache.get("foo").body, b"baz")
+
+    def test_delete(self):
+        self.cache.set("foo", b"bar")
+        self.assertTrue(self.cache.delete("foo"))
+        self.assertFalse(self.cache.delete("foo"))
+        self.assertEqual(self.cache.get("foo"), None)
+
+    def test_layout(self):
+        path = self.cache.get_path("foo")
+        relpath = os.path.relpath(path, self.path)
+        parts = relpath.split(os.sep)
+        self.assertEqual(len(parts), 3)
+        self.assertTrue(parts[2].startswith(parts[0] + parts[1]))
+
+
+class SharedMemoryCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.cache = SharedMemoryCache(
+            4 * 1024 * 1024, slot_sizes=(1024, 64 * 1024))
+
+    def test_miss(self):
+        self.assertEqual(self.cache.get("foo"), None)
+
+    def test_set_get(self):
+        self.cache.set("foo", b"bar")
+        entry = self.cache.get("foo")
+        self.assertEqual(entry.body, b"bar")
+        self.assertTrue(entry.created > 0)
+
+    def test_size_classes(self):
+        small, large = b"x" * 100, b"y" * 10000
+        self.cache.set("small", small)
+        self.cache.set("large", large)
+        self.assertEqual(self.cache.get("small").body, small)
+        self.assertEqual(self.cache.get("large").body, large)
+
+    def test_move_between_classes(self):
+        self.cache.set("foo", b"y" * 10000)
+        self.cache.set("foo", b"x")
+        self.assertEqual(self.cache.get("foo").body, b"x")
+
+    def test_too_large(self):
+        self.cache.set("foo", b"x" * (64 * 1024))
+        self.assertEqual(self.cache.get("foo"), None)
+
+    def test_delete(self):
+        self.cache.set("foo", b"bar")
+        self.assertTrue(self.cache.delete("foo"))
+        self.assertFalse(self.cache.delete("foo"))
+        self.assertEqual(self.cache.get("foo"), None)
+
+    def test_eviction(self):
+        cache = SharedMemoryCache(1024 * SharedMemoryCache.WAYS,
+                                  slot_sizes=(1024,))
+        for i in range(SharedMemoryCache.WAYS + 1):
+            cache.set("key%d" % i, b"x")
+        self.assertEqual(cache.get("key0"), None)
+        self.assertEqual(cache.get("key%d" % SharedMemoryCache.WAYS).body,
+                         b"x")
+
+    def test_lock_timeout(self):
+        # As if a worker died holding the lock of the key's set
+        metrics = Metrics()
+        cache = SharedMemoryCache(1024 * SharedMemoryCache.WAYS,
+                                  slot_sizes=(1024,), lock_timeout=0.01,
+                                  metrics=metrics)
+        cache.set("foo", b"bar")
+        _, stripe = cache._locate(cache._digest("foo"), 1)
+        lock = cache.locks[stripe]
+        lock.acquire()
+        try:
+            self.assertEqual(cache.get("foo"), None)
+            cache.set("foo", b"baz")
+            self.assertFalse(cache.delete("foo"))
+        finally:
+            lock.release()
+        self.assertEqual(metrics.counters["cache.lock_timeouts"], 3)
+        self.assertEqual(cache.get("foo").body, b"bar")
+
+    def test_stuck_lock_disables_stripe(self):
+        metrics = Metrics()
+        cache = SharedMemoryCache(1024 * SharedMemoryCache.WAYS,
+                                  slot_sizes=(1024,), lock_timeout=0.05,
+                                  metrics=metrics)
+        cache.set("foo", b"bar")
+        _, stripe = cache._locate(cache._digest("foo"), 1)
+        lock = cache.locks[stripe]
+        lock.acquire()
+        try:
+            for _ in range(SharedMemoryCache.MAX_LOCK_TIMEOUTS):
+                self.assertEqual(cache.get("foo"), None)
+            start = time.time()
+            for _ in range(10):
+                self.assertEqual(cache.get("foo"), None)
+            self.assertTrue(time.time() - start < 0.05)
+        finally:
+            lock.release()
+        self.assertEqual(metrics.counters["cache.lock_timeouts"],
+                         SharedMemoryCache.MAX_LOCK_TIMEOUTS)
+        self.assertEqual(metrics.counters["cache.stripes_disabled"], 1)
+        # Enabled again once the lock is free
+        self.assertEqual(cache.get("foo").body, b"bar")
+        self.assertEqual(cache.lock_timeouts[stripe], 0)
+
+    @unittest.skipIf(not hasattr(os, "fork"), "fork is not available")
+    def test_shared_across_fork(self):
+        pid = os.fork()
+        if pid == 0:
+            try:
+                self.cache.set("child", b"from child")
+            finally:
+                os._exit(0)
+        os.waitpid(pid, 0)
+        self.assertEqual(self.cache.get("child").body, b"from child")
+
+
+class MemoryCacheTest(unittest.TestCase):
+    def test_set_get(self):
+        cache = MemoryCache(100)
+        cache.set("foo", b"bar")
+        self.assertEqual(cache.get("foo").body, b"bar")
+        self.assertTrue(cache.delete("foo"))
+        self.assertEqual(cache.get("foo"), None)
+        self.assertEqual(cache.used, 0)
+
+    def test_least_recently_used_dropped(self):
+        cache = MemoryCache(10)
+        cache.set("a", b"aaaa")
+        cache.set("b", b"bbbb")
+        cache.get("a")
+        cache.set("c", b"cccc")
+        self.assertEqual(cache.get("b"), None)
+        self.assertEqual(cache.get("a").body, b"aaaa")
+        self.assertEqual(cache.used, 8)
+
+    def test_too_large(self):
+        cache = MemoryCache(2)
+        cache.set("a", b"aaaa")
+        self.assertEqual(cache.get("a"), None)
+
+    def test_ttl(self):
+        cache = MemoryCache(100, ttl=10)
+        cache.set("a", b"new")
+        cache.set("b", b"old", time.time() - 20)
+        self.assertEqual(cache.get("a").body, b"new")
+        self.assertEqual(cache.get("b"), None)
+        self.assertEqual(cache.used, 3)
+
+
+class TieredCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.shm = SharedMemoryCache(1024 * 1024, slot_sizes=(64 * 1024,))
+        self.disk = FileCache(self.path)
+        self.cache = TieredCache([self.shm, self.disk])
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_set_writes_all_tiers(self):
+        self.cache.set("foo", b"bar")
+        self.assertEqual(self.shm.get("foo").body, b"bar")
+        self.assertEqual(self.disk.get("foo").body, b"bar")
+
+    def test_backfill(self):
+        self.disk.set("foo", b"bar", created=1000)
+        entry = self.cache.get("foo")
+        self.assertEqual(entry.body, b"bar")
+        self.assertEqual(self.shm.get("foo"), (b"bar", 1000))
+
+    def test_delete(self):
+        self.cache.set("foo", b"bar")
+        self.assertTrue(self.cache.delete("foo"))
+        self.assertEqual(self.cache.get("foo"), None)
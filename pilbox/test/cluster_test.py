@@ -0,0 +1,140 @@
+from __future__ import absolute_import, division, with_statement
+
+import base64
+import collections
+
+import tornado.httpserver
+from tornado.test.util import unittest
+from tornado.testing import AsyncHTTPTestCase, bind_unused_port
+
+from pilbox.cluster import HashRing, PeerRouter
+from pilbox.test.handler_test import _HandlerTestMixin, \
+    _PilboxTestApplication, b64, route_key
+
+
+class HashRingTest(unittest.TestCase):
+    def test_stable(self):
+        ring = HashRing(["a", "b", "c"])
+        self.assertEqual(ring.get_node("key"), ring.get_node("key"))
+        self.assertEqual(HashRing(["c", "b", "a"]).get_node("key"),
+                         ring.get_node("key"))
+
+    def test_spread(self):
+        ring = HashRing(["a", "b", "c"])
+        counts = collections.Counter(ring.get_node("key%d" % i)
+                                     for i in range(3000))
+        for node in ("a", "b", "c"):
+            self.assertTrue(800 < counts[node] < 1200, counts)
+
+    def test_removed_node_moves_only_its_keys(self):
+        before = HashRing(["a", "b", "c"])
+        after = HashRing(["a", "b"])
+        for i in range(1000):
+            key = "key%d" % i
+            if before.get_node(key) != "c":
+                self.assertEqual(before.get_node(key), after.get_node(key))
+
+    def test_empty(self):
+        self.assertEqual(HashRing([]).get_node("key"), None)
+
+
+class PeerRouterTest(unittest.TestCase):
+    def test_self_must_be_peer(self):
+        self.assertRaises(ValueError, PeerRouter, ["http://a"], "http://b")
+
+    def test_owner(self):
+        router = PeerRouter(["http://a/", "http://b"], "http://a")
+        owners = set(router.get_owner("key%d" % i) for i in range(100))
+        self.assertEqual(owners, set([None, "http://b"]))
+
+
+class ClusterHandlerTest(_HandlerTestMixin, AsyncHTTPTestCase):
+    """Runs a second node next to the one under test."""
+
+    def get_app(self):
+        sock, port = bind_unused_port()
+        self.self_url = self.get_url("").rstrip("/")
+        self.peer_url = "http://127.0.0.1:%d" % port
+        self.peer_app = _PilboxTestApplication(
+            s3_root=self.get_s3_root(), **self.get_cluster_settings())
+        self.peer_server = tornado.httpserver.HTTPServer(self.peer_app)
+        self.peer_server.add_sockets([sock])
+        return super(ClusterHandlerTest, self).get_app()
+
+    def tearDown(self):
+        self.peer_server.stop()
+        self.peer_app.close()
+        super(ClusterHandlerTest, self).tearDown()
+
+    def get_cluster_settings(self, **kwargs):
+        settings = dict(timeout=10.0,
+                        cluster_peers=",".join(self.get_peers()),
+                        cluster_self=self.peer_url)
+        settings.update(kwargs)
+        return settings
+
+    def get_peers(self):
+        return [self.self_url, self.peer_url]
+
+    def get_app_settings(self):
+        return self.get_cluster_settings(cluster_self=self.self_url)
+
+    def find_path(self, owner, filename="test1.jpg"):
+        """Returns the path of a render of filename owned by owner."""
+        for i in range(100):
+            bucket = "bucket%d" % i
+            url = "%s/%s/product-pictures/%s" % (
+                self.get_s3_root(), bucket, filename)
+            key = route_key(url)
+            if self._app.router.ring.get_node(key) == owner:
+                return "/a/%s/%s" % (bucket, b64(filename))
+        self.fail("No key owned by %s" % owner)
+
+    def test_forwarded_to_owner(self):
+        path = self.find_path(self.peer_url)
+        img = self.fetch_image(path)
+        self.assertEqual(max(img.size), 100)
+        self.assertEqual(self._app.metrics.counters["cluster.forwarded"], 1)
+        self.assertEqual(self._app.metrics.counters["origin.fetches"], 0)
+        self.assertEqual(self.peer_app.metrics.counters["origin.fetches"], 1)
+
+        # Kept briefly by the forwarding node
+        self.fetch_image(path)
+        self.assertEqual(
+            self._app.metrics.counters["cluster.peer_cache_hits"], 1)
+        self.assertEqual(self.peer_app.metrics.counters["origin.fetches"], 1)
+
+    def test_rendered_by_owner(self):
+        self.fetch_image(self.find_path(self.self_url))
+        self.assertEqual(self._app.metrics.counters["cluster.forwarded"], 0)
+        self.assertEqual(self._app.metrics.counters["origin.fetches"], 1)
+
+    def test_owner_error_relayed(self):
+        self.fetch_error(404, self.find_path(self.peer_url, "missing.jpg"))
+        self.assertEqual(self._app.metrics.counters["cluster.forwarded"], 1)
+
+    def test_multi_urlsafe_forwarded(self):
+        # Owners decode the path of the route as standard base64
+        items, paths = [], []
+        for filename in ("img10~.jpg", "img1??.jpg"):
+            path = self.find_path(self.peer_url, filename)
+            bucket = path.split("/")[2]
+            items.append("%s/%s" % (bucket, base64.urlsafe_b64encode(
+                filename.encode("utf-8")).decode("ascii")))
+            paths.append(path)
+        self.assertTrue("-" in items[0] and "_" in items[1])
+        _, parts = self.fetch_parts(
+            "/multi/a?" + "&".join("i=%s" % item for item in items))
+        self.assertEqual([headers["Content-Location"] for headers, _ in parts],
+                         paths)
+        self.assertEqual([headers["X-Pilbox-Status"] for headers, _ in parts],
+                         ["404", "404"])
+        self.assertEqual(self._app.metrics.counters["cluster.forwarded"], 2)
+        self.assertEqual(self._app.metrics.counters["cluster.fallbacks"], 0)
+
+    def test_fallback_when_owner_down(self):
+        path = self.find_path(self.peer_url)
+        self.peer_server.stop()
+        img = self.fetch_image(path)
+        self.assertEqual(max(img.size), 100)
+        self.assertEqual(self._app.metrics.counters["cluster.fallbacks"], 1)
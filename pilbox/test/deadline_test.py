@@ -0,0 +1,48 @@
+from __future__ import absolute_import, division, with_statement
+
+import os.path
+import time
+
+from tornado.test.util import unittest
+
+from pilbox import errors
+from pilbox.app import render_image
+from pilbox.deadline import Deadline
+from pilbox.image import Image
+
+
+DATADIR = os.path.join(os.path.dirname(__file__), "data")
+
+
+class DeadlineTest(unittest.TestCase):
+    def test_no_deadline(self):
+        deadline = Deadline(0)
+        self.assertEqual(deadline.remaining(), None)
+        self.assertFalse(deadline.expired())
+        self.assertEqual(deadline.limit(10), 10)
+        self.assertEqual(deadline.limit(None), None)
+        deadline.check("fetch")
+
+    def test_remaining(self):
+        deadline = Deadline(10, start=time.time() - 4)
+        self.assertTrue(5 < deadline.remaining() <= 6)
+        self.assertEqual(deadline.limit(1), 1)
+        self.assertTrue(deadline.limit(20) <= 6)
+        self.assertTrue(deadline.limit(None) <= 6)
+
+    def test_expired(self):
+        deadline = Deadline(1, start=time.time() - 2)
+        self.assertEqual(deadline.remaining(), 0)
+        self.assertTrue(deadline.expired())
+        with self.assertRaises(errors.DeadlineError) as cm:
+            deadline.check("fetch")
+        self.assertEqual(cm.exception.stage, "fetch")
+        self.assertEqual(cm.exception.status_code, 504)
+
+    def test_render_dropped(self):
+        deadline = Deadline(1, start=time.time() - 2)
+        with open(os.path.join(DATADIR, "test1.jpg"), "rb") as f:
+            image = Image(f)
+            with self.assertRaises(errors.DeadlineError) as cm:
+                render_image(image, 100, 100, deadline=deadline)
+        self.assertEqual(cm.exception.stage, "decode")
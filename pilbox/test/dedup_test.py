@@ -0,0 +1,130 @@
+from __future__ import absolute_import, division, with_statement
+
+import shutil
+import tempfile
+import time
+
+from tornado.test.util import unittest
+from tornado.testing import AsyncHTTPTestCase
+
+from pilbox.cache import MemoryCache, make_key
+from pilbox.dedup import ContentIndex, hash_content, make_content_key
+from pilbox.purge import IndexedCache, PurgeIndex
+from pilbox.test.handler_test import _HandlerTestMixin, b64
+
+
+class ContentIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.cache = MemoryCache(1024 * 1024)
+        self.dedup = ContentIndex(self.cache)
+
+    def test_hash_content(self):
+        digest = hash_content(b"abc")
+        self.assertEqual(digest, hash_content(b"abc"))
+        self.assertNotEqual(digest, hash_content(b"abd"))
+        self.assertTrue(digest.split(":")[0] in ("xxh128", "xxh64", "sha1"))
+
+    def test_content_key(self):
+        self.assertEqual(make_content_key("sha1:ab", w=1, h=2),
+                         "h=2&w=1&content=sha1%3Aab")
+
+    def test_digest(self):
+        self.assertEqual(self.dedup.get_digest("http://a/1.jpg"), None)
+        self.dedup.set_digest("http://a/1.jpg", "sha1:ab")
+        self.assertEqual(self.dedup.get_digest("http://a/1.jpg"), "sha1:ab")
+
+    def test_url(self):
+        self.dedup.set_digest("http://a/1.jpg", "sha1:ab")
+        self.dedup.set_url("sha1:ab", "http://a/1.jpg", w=1, h=1)
+        self.assertEqual(self.dedup.get_url("sha1:ab", w=1, h=1),
+                         "http://a/1.jpg")
+        self.assertEqual(self.dedup.get_url("sha1:ab", w=2, h=2), None)
+
+    def test_url_content_changed(self):
+        self.dedup.set_url("sha1:ab", "http://a/1.jpg", w=1, h=1)
+        self.dedup.set_digest("http://a/1.jpg", "sha1:cd")
+        self.assertEqual(self.dedup.get_url("sha1:ab", w=1, h=1), None)
+
+    def test_ttl(self):
+        self.dedup.ttl = 10
+        self.cache.set(make_key("http://a/1.jpg", content="digest"),
+                       b"sha1:ab", time.time() - 20)
+        self.assertEqual(self.dedup.get_digest("http://a/1.jpg"), None)
+
+    def test_ratio(self):
+        self.assertEqual(self.dedup.get_ratio(), None)
+        self.dedup.hits, self.dedup.misses = 1, 3
+        self.assertEqual(self.dedup.get_ratio(), 0.25)
+
+    def test_digest_is_purged(self):
+        path = tempfile.mkdtemp()
+        try:
+            index = PurgeIndex(path)
+            dedup = ContentIndex(IndexedCache(self.cache, index))
+            dedup.set_digest("http://a/1.jpg", "sha1:ab")
+            self.assertEqual(index.get_keys("a", "http://a/1.jpg"),
+                             [make_key("http://a/1.jpg", content="digest")])
+        finally:
+            shutil.rmtree(path)
+
+
+class DedupHandlerTest(_HandlerTestMixin, AsyncHTTPTestCase):
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        super(DedupHandlerTest, self).setUp()
+        self.fetches = []
+        fetch = self._app.fetcher.fetch
+
+        def counting_fetch(client, url, **kwargs):
+            self.fetches.append(url)
+            return fetch(client, url, **kwargs)
+        self._app.fetcher.fetch = counting_fetch
+
+    def tearDown(self):
+        super(DedupHandlerTest, self).tearDown()
+        shutil.rmtree(self.cache_dir)
+
+    def get_app_settings(self):
+        return dict(timeout=10.0, cache_dir=self.cache_dir, dedup=True)
+
+    def test_alias_after_fetch(self):
+        first = self.fetch("/a/bucket/%s" % b64("test1.jpg"))
+        second = self.fetch("/a/other/%s" % b64("test1.jpg"))
+        self.assertEqual(second.body, first.body)
+        self.assertEqual(len(self.fetches), 2)
+        self.assertEqual((self._app.dedup.hits, self._app.dedup.misses),
+                         (1, 1))
+        resp = self.fetch("/metrics")
+        self.assertTrue(b'"dedup.ratio": 0.5' in resp.body)
+
+    def test_alias_without_fetch(self):
+        self.fetch_image("/a/other/%s" % b64("test1.jpg"))
+        self.fetch_image("/b/bucket/%s" % b64("test1.jpg"))
+        self.fetch_image("/b/other/%s" % b64("test1.jpg"))
+        self.assertEqual(len(self.fetches), 2)
+        self.assertEqual(self._app.dedup.hits, 1)
+
+    def test_different_content(self):
+        self.fetch_image("/a/bucket/%s" % b64("test1.jpg"))
+        self.fetch_image("/a/bucket/%s" % b64("test2.png"))
+        self.assertEqual((self._app.dedup.hits, self._app.dedup.misses),
+                         (0, 2))
+
+
+class ThreadedDedupHandlerTest(DedupHandlerTest):
+    def get_app_settings(self):
+        settings = super(ThreadedDedupHandlerTest, self).get_app_settings()
+        settings["render_threads"] = 1
+        return settings
+
+    def test_hash_on_executor(self):
+        submitted = []
+        executor = self._app.executor
+        submit = executor.submit
+
+        def recording_submit(fn, *args, **kwargs):
+            submitted.append(fn)
+            return submit(fn, *args, **kwargs)
+        executor.submit = recording_submit
+        self.fetch_image("/a/bucket/%s" % b64("test1.jpg"))
+        self.assertTrue(hash_content in submitted)
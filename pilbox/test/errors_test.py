@@ -12,7 +12,8 @@ class ErrorsTest(unittest.TestCase):
                   DimensionsError, FilterError, FormatError, ModeError,
                   OptimizeError, PositionError, QualityError, UrlError,
                   ImageFormatError, FetchError, DegreeError, OperationError,
-                  RectangleError]
+                  RectangleError, PixelMemoryError, ProfilerBusyError,
+                  ClientClosedError, DeadlineError, DisabledError]
         codes = []
         for error in errors:
             code = str(error.get_code())
@@ -0,0 +1,442 @@
+from __future__ import absolute_import, division, with_statement
+
+import base64
+import os.path
+import shutil
+import tempfile
+import threading
+import time
+
+import PIL.Image
+import tornado.concurrent
+import tornado.escape
+import tornado.gen
+import tornado.httpclient
+import tornado.ioloop
+import tornado.web
+from tornado.testing import AsyncHTTPTestCase, gen_test
+
+from pilbox import errors
+from pilbox.app import ImageHandler, PilboxApplication, get_render_params
+from pilbox.cache import make_key
+
+try:
+    from io import BytesIO
+except ImportError:
+    from cStringIO import StringIO as BytesIO
+
+
+DATADIR = os.path.join(os.path.dirname(__file__), "data")
+
+
+def b64(s):
+    return base64.b64encode(s.encode("utf-8")).decode("ascii")
+
+
+def route_key(url, size=100):
+    """Returns the cache key of url rendered by the bucket route of size."""
+    profile = "thumbnail" if size == 100 else "product"
+    return make_key(url, **get_render_params(size, size, profile=profile))
+
+
+def sleep(seconds):
+    future = tornado.concurrent.Future()
+    io_loop = tornado.ioloop.IOLoop.current()
+    io_loop.add_timeout(io_loop.time() + seconds,
+                        lambda: future.set_result(None))
+    return future
+
+
+class _SlowFileHandler(tornado.web.StaticFileHandler):
+    @tornado.gen.coroutine
+    def get(self, path, include_body=True):
+        yield sleep(1)
+        yield super(_SlowFileHandler, self).get(path, include_body)
+
+
+class _BrokenHandler(tornado.web.RequestHandler):
+    def get(self, path):
+        raise tornado.web.HTTPError(503)
+
+
+class _PilboxTestApplication(PilboxApplication):
+    def get_handlers(self):
+        handlers = [(r"/s3/slow/product-pictures/(.*)", _SlowFileHandler,
+                     {"path": DATADIR}),
+                    (r"/s3/broken/product-pictures/(.*)", _BrokenHandler),
+                    (r"/s3/[\w-]+/product-pictures/(.*)",
+                     tornado.web.StaticFileHandler,
+                     {"path": DATADIR})]
+        handlers.extend(super(_PilboxTestApplication, self).get_handlers())
+        return handlers
+
+
+class _HandlerTestMixin(object):
+    def get_s3_root(self):
+        return self.get_url("/s3")
+
+    def get_app(self):
+        return _PilboxTestApplication(s3_root=self.get_s3_root(),
+                                      **self.get_app_settings())
+
+    def get_app_settings(self):
+        return dict(timeout=10.0)
+
+    def tearDown(self):
+        self._app.close()
+        super(_HandlerTestMixin, self).tearDown()
+
+    def fetch_image(self, path, **kwargs):
+        resp = self.fetch(path, **kwargs)
+        self.assertEqual(resp.code, 200)
+        self.assertEqual(resp.headers.get("Content-Type"), "image/jpeg")
+        return PIL.Image.open(BytesIO(resp.body))
+
+    def fetch_error(self, code, path, **kwargs):
+        resp = self.fetch(path, **kwargs)
+        self.assertEqual(resp.code, code)
+        self.assertEqual(resp.headers.get("Content-Type"), "application/json")
+        return tornado.escape.json_decode(resp.body)
+
+    def fetch_parts(self, path):
+        resp = self.fetch(path)
+        self.assertEqual(resp.code, 200)
+        content_type = resp.headers["Content-Type"]
+        self.assertTrue(content_type.startswith("multipart/mixed"))
+        boundary = content_type.split("boundary=")[1].encode("ascii")
+        parts = []
+        for chunk in resp.body.split(b"--" + boundary)[1:-1]:
+            head, body = chunk.split(b"\r\n\r\n", 1)
+            headers = dict(line.decode("utf-8").split(": ", 1)
+                           for line in head.strip().split(b"\r\n"))
+            self.assertEqual(len(body) - 2, int(headers["Content-Length"]))
+            parts.append((headers, body[:-2]))
+        return resp, parts
+
+
+class HandlerTest(_HandlerTestMixin, AsyncHTTPTestCase):
+    def test_bucket_route(self):
+        img = self.fetch_image("/a/bucket/%s" % b64("test1.jpg"))
+        self.assertEqual(img.format, "JPEG")
+        self.assertEqual(max(img.size), 100)
+
+    def test_external_route(self):
+        url = self.get_url("/s3/bucket/product-pictures/test1.jpg")
+        img = self.fetch_image("/d/%s" % b64(url))
+        self.assertEqual(img.size, (384, 480))
+
+    def test_missing_original(self):
+        resp = self.fetch_error(404, "/a/bucket/%s" % b64("missing.jpg"))
+        self.assertEqual(resp.get("error_code"), errors.FetchError.get_code())
+
+    def test_resolver_with_default_client(self):
+        # Another client is the IOLoop's shared one, created without the
+        # resolver
+        tornado.httpclient.AsyncHTTPClient()
+        self.fetch_image("/a/bucket/%s" % b64("test1.jpg"))
+        self.fetch_image("/a/bucket/%s" % b64("test3.jpg"))
+        counters = self._app.metrics.counters
+        self.assertEqual(counters["dns.misses"], 1)
+        self.assertEqual(counters["dns.hits"], 1)
+
+    def test_pixel_memory_released(self):
+        self.fetch_image("/a/bucket/%s" % b64("test1.jpg"))
+        resp = self.fetch("/metrics")
+        self.assertEqual(resp.code, 200)
+        metrics = tornado.escape.json_decode(resp.body)
+        self.assertEqual(metrics["pixel_memory.current"], 0)
+        self.assertTrue(metrics["pixel_memory.peak"] > 0)
+
+
+class PixelMemoryHandlerTest(_HandlerTestMixin, AsyncHTTPTestCase):
+    def get_app_settings(self):
+        return dict(timeout=10.0, max_pixel_memory=1000, pixel_memory_wait=0)
+
+    def test_exhausted(self):
+        self._app.pixel_budget.current = 1
+        resp = self.fetch_error(503, "/a/bucket/%s" % b64("test1.jpg"))
+        self.assertEqual(resp.get("error_code"),
+                         errors.PixelMemoryError.get_code())
+
+
+class CachedHandlerTest(_HandlerTestMixin, AsyncHTTPTestCase):
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        super(CachedHandlerTest, self).setUp()
+
+    def tearDown(self):
+        super(CachedHandlerTest, self).tearDown()
+        shutil.rmtree(self.cache_dir)
+
+    def get_app_settings(self):
+        return dict(timeout=10.0, cache_dir=self.cache_dir)
+
+    def test_render_is_cached(self):
+        self.fetch_image("/a/bucket/%s" % b64("test1.jpg"))
+        url = "%s/bucket/product-pictures/test1.jpg" % self.get_s3_root()
+        entry = self._app.cache.get(route_key(url))
+        self.assertTrue(entry is not None)
+
+    def test_serves_from_cache(self):
+        url = "%s/bucket/product-pictures/cached.jpg" % self.get_s3_root()
+        outfile = BytesIO()
+        PIL.Image.new("RGB", (7, 7)).save(outfile, "JPEG")
+        self._app.cache.set(route_key(url), outfile.getvalue())
+        img = self.fetch_image("/a/bucket/%s" % b64("cached.jpg"))
+        self.assertEqual(img.size, (7, 7))
+
+
+class SharedMemoryCachedHandlerTest(_HandlerTestMixin, AsyncHTTPTestCase):
+    def get_app_settings(self):
+        return dict(timeout=10.0, shm_cache_size=4 * 1024 * 1024)
+
+    def test_render_is_cached(self):
+        self.fetch_image("/b/bucket/%s" % b64("test1.jpg"))
+        url = "%s/bucket/product-pictures/test1.jpg" % self.get_s3_root()
+        entry = self._app.cache.get(route_key(url, 500))
+        self.assertTrue(entry is not None)
+
+
+class CancelHandlerTest(_HandlerTestMixin, AsyncHTTPTestCase):
+    def get_app_settings(self):
+        return dict(timeout=10.0, render_threads=1)
+
+    @tornado.gen.coroutine
+    def abandon(self, path):
+        try:
+            yield self.http_client.fetch(self.get_url(path),
+                                         request_timeout=0.2)
+        except tornado.httpclient.HTTPError as e:
+            self.assertEqual(e.code, 599)
+        else:
+            self.fail("Request was not abandoned")
+
+    @tornado.gen.coroutine
+    def wait_for(self, name):
+        counters = self._app.metrics.counters
+        for _ in range(100):
+            if counters.get(name):
+                break
+            yield sleep(0.01)
+        self.assertEqual(counters.get(name), 1)
+
+    @gen_test
+    def test_cancel_fetch(self):
+        yield self.abandon("/a/slow/%s" % b64("test1.jpg"))
+        yield self.wait_for("cancelled.fetch")
+        self.assertEqual(self._app.metrics.counters["requests.cancelled"], 1)
+
+    @gen_test
+    def test_cancel_queued(self):
+        started, release = threading.Event(), threading.Event()
+
+        def block():
+            started.set()
+            release.wait()
+        self._app.executor.submit(block)
+        started.wait()
+        try:
+            yield self.abandon("/a/bucket/%s" % b64("test1.jpg"))
+            yield self.wait_for("cancelled.queue")
+        finally:
+            release.set()
+        self.assertEqual(self._app.pixel_budget.current, 0)
+
+
+class DeadlineHandlerTest(_HandlerTestMixin, AsyncHTTPTestCase):
+    def get_app_settings(self):
+        return dict(timeout=10.0, deadline=0.3, render_threads=1)
+
+    def test_fetch_exceeded(self):
+        resp = self.fetch_error(504, "/a/slow/%s" % b64("test1.jpg"))
+        self.assertEqual(resp.get("error_code"),
+                         errors.DeadlineError.get_code())
+        self.assertEqual(self._app.metrics.counters["deadline.fetch"], 1)
+
+    def test_queued_dropped(self):
+        started, release = threading.Event(), threading.Event()
+
+        def block():
+            started.set()
+            release.wait()
+        self._app.executor.submit(block)
+        started.wait()
+        try:
+            resp = self.fetch_error(504, "/a/bucket/%s" % b64("test1.jpg"))
+        finally:
+            release.set()
+        self.assertEqual(resp.get("error_code"),
+                         errors.DeadlineError.get_code())
+        self.assertEqual(self._app.metrics.counters["deadline.queue"], 1)
+        self.assertEqual(self._app.pixel_budget.current, 0)
+
+    def test_within_deadline(self):
+        img = self.fetch_image("/a/bucket/%s" % b64("test1.jpg"))
+        self.assertEqual(max(img.size), 100)
+
+
+class StaleHandlerTest(_HandlerTestMixin, AsyncHTTPTestCase):
+    def get_app_settings(self):
+        return dict(timeout=10.0, shm_cache_size=4 * 1024 * 1024,
+                    cache_ttl=60, stale_while_revalidate=60,
+                    stale_if_error=600)
+
+    def set_entry(self, bucket, filename, age):
+        url = "%s/%s/product-pictures/%s" % (
+            self.get_s3_root(), bucket, filename)
+        key = route_key(url)
+        outfile = BytesIO()
+        PIL.Image.new("RGB", (7, 7)).save(outfile, "JPEG")
+        self._app.cache.set(key, outfile.getvalue(), time.time() - age)
+        return key
+
+    def wait_for_refresh(self):
+        @tornado.gen.coroutine
+        def wait():
+            while self._app.refreshing:
+                yield sleep(0.01)
+        self.io_loop.run_sync(wait)
+
+    def test_cache_control(self):
+        resp = self.fetch("/a/bucket/%s" % b64("test1.jpg"))
+        self.assertEqual(resp.headers.get("Cache-Control"),
+                         "public, max-age=60, stale-while-revalidate=60, "
+                         "stale-if-error=600")
+
+    def test_fresh(self):
+        self.set_entry("bucket", "test1.jpg", 10)
+        img = self.fetch_image("/a/bucket/%s" % b64("test1.jpg"))
+        self.assertEqual(img.size, (7, 7))
+        self.assertEqual(self._app.metrics.counters["origin.fetches"], 0)
+
+    def test_stale_while_revalidate(self):
+        key = self.set_entry("bucket", "test1.jpg", 90)
+        img = self.fetch_image("/a/bucket/%s" % b64("test1.jpg"))
+        self.assertEqual(img.size, (7, 7))
+        self.wait_for_refresh()
+        # The original has not changed since, so the origin answers 304
+        self.assertEqual(self._app.metrics.counters["cache.revalidated"], 1)
+        self.assertTrue(time.time() - self._app.cache.get(key).created < 10)
+
+    def test_refresh_keeps_request_deadline(self):
+        # Other images of a /multi request share the request's deadline
+        self.set_entry("bucket", "test1.jpg", 90)
+        deadlines = []
+        refresh = ImageHandler._refresh
+
+        def spy(handler, *args):
+            before = handler._deadline
+            refresh(handler, *args)
+            deadlines.append((before, handler._deadline))
+        ImageHandler._refresh = spy
+        try:
+            resp = self.fetch("/multi/a?i=bucket/%s&i=bucket/%s"
+                              % (b64("test1.jpg"), b64("test3.jpg")))
+        finally:
+            ImageHandler._refresh = refresh
+        self.assertEqual(resp.code, 200)
+        self.wait_for_refresh()
+        self.assertEqual(len(deadlines), 1)
+        self.assertIs(deadlines[0][0], deadlines[0][1])
+        self.assertEqual(self._app.metrics.counters["cache.revalidated"], 1)
+
+    def test_expired_revalidated(self):
+        self.set_entry("bucket", "test1.jpg", 200)
+        img = self.fetch_image("/a/bucket/%s" % b64("test1.jpg"))
+        self.assertEqual(img.size, (7, 7))
+        self.assertEqual(self._app.metrics.counters["cache.revalidated"], 1)
+
+    def test_changed_rendered(self):
+        # Cached before the original was last modified
+        mtime = os.path.getmtime(os.path.join(DATADIR, "test1.jpg"))
+        self.set_entry("bucket", "test1.jpg", time.time() - mtime + 1000)
+        img = self.fetch_image("/a/bucket/%s" % b64("test1.jpg"))
+        self.assertEqual(max(img.size), 100)
+
+    def test_stale_if_error(self):
+        self.set_entry("broken", "test1.jpg", 200)
+        img = self.fetch_image("/a/broken/%s" % b64("test1.jpg"))
+        self.assertEqual(img.size, (7, 7))
+        self.assertEqual(self._app.metrics.counters["cache.stale_if_error"], 1)
+
+    def test_too_stale_for_error(self):
+        self.set_entry("broken", "test1.jpg", 1000)
+        self.fetch_error(404, "/a/broken/%s" % b64("test1.jpg"))
+
+    def test_missing_not_served_stale(self):
+        self.set_entry("bucket", "missing.jpg", 200)
+        self.fetch_error(404, "/a/bucket/%s" % b64("missing.jpg"))
+
+
+class PassthroughHandlerTest(_HandlerTestMixin, AsyncHTTPTestCase):
+    def get_app_settings(self):
+        return dict(timeout=10.0, passthrough=True, strip_metadata=False)
+
+    def test_small_jpeg_unchanged(self):
+        resp = self.fetch("/b/bucket/%s" % b64("test1.jpg"))
+        self.assertEqual(resp.code, 200)
+        self.assertEqual(resp.headers.get("Content-Type"), "image/jpeg")
+        with open(os.path.join(DATADIR, "test1.jpg"), "rb") as f:
+            self.assertEqual(resp.body, f.read())
+
+    def test_large_jpeg_resized(self):
+        img = self.fetch_image("/a/bucket/%s" % b64("test1.jpg"))
+        self.assertEqual(max(img.size), 100)
+
+
+class MultiImageHandlerTest(_HandlerTestMixin, AsyncHTTPTestCase):
+    def get_app_settings(self):
+        return dict(timeout=10.0, max_batch_size=3)
+
+    def test_multi(self):
+        items = ["bucket/%s" % b64("test1.jpg"),
+                 "bucket/%s" % b64("missing.jpg"),
+                 "other/%s" % b64("test2.png")]
+        resp, parts = self.fetch_parts(
+            "/multi/a?" + "&".join("i=%s" % item for item in items))
+        self.assertEqual(resp.headers["Cache-Control"], "no-store")
+        self.assertEqual([headers["Content-Location"] for headers, _ in parts],
+                         ["/a/%s" % item for item in items])
+        self.assertEqual([headers["X-Pilbox-Status"] for headers, _ in parts],
+                         ["200", "404", "200"])
+        for i in (0, 2):
+            img = PIL.Image.open(BytesIO(parts[i][1]))
+            self.assertEqual(img.format, "JPEG")
+            self.assertEqual(max(img.size), 100)
+        error = tornado.escape.json_decode(parts[1][1])
+        self.assertEqual(error["error_code"], errors.FetchError.get_code())
+
+    def test_same_as_route(self):
+        item = "bucket/%s" % b64("test1.jpg")
+        _, parts = self.fetch_parts("/multi/b?i=%s" % item)
+        resp = self.fetch("/b/%s" % item)
+        self.assertEqual(parts[0][1], resp.body)
+
+    def test_not_cached_downstream(self):
+        resp, _ = self.fetch_parts("/multi/a?i=bucket/%s" % b64("test1.jpg"))
+        self.assertEqual(resp.headers["Cache-Control"], "no-store")
+
+    def test_plus_in_filename(self):
+        # The base64 of img10~.jpg is aW1nMTB+LmpwZw==, the original is
+        # missing, so the filename is decoded if the part is 404, not 400
+        for arg in ("aW1nMTB+LmpwZw==", "aW1nMTB%2BLmpwZw==",
+                    "aW1nMTB-LmpwZw=="):
+            _, parts = self.fetch_parts("/multi/a?i=bucket/%s" % arg)
+            # The path of the route is always standard base64
+            self.assertEqual(parts[0][0]["Content-Location"],
+                             "/a/bucket/aW1nMTB+LmpwZw==")
+            self.assertEqual(parts[0][0]["X-Pilbox-Status"], "404")
+            error = tornado.escape.json_decode(parts[0][1])
+            self.assertEqual(error["error_code"],
+                             errors.FetchError.get_code())
+
+    def test_invalid_item(self):
+        _, parts = self.fetch_parts("/multi/a?i=a.b/%s" % b64("test1.jpg"))
+        self.assertEqual(parts[0][0]["X-Pilbox-Status"], "400")
+
+    def test_too_many(self):
+        resp = self.fetch_error(400, "/multi/a?i=a/b&i=a/b&i=a/b&i=a/b")
+        self.assertEqual(resp["error_code"], errors.UrlError.get_code())
+
+    def test_missing_images(self):
+        self.fetch_error(400, "/multi/a")
@@ -0,0 +1,65 @@
+from __future__ import absolute_import, division, with_statement
+
+import threading
+
+import tornado.escape
+from tornado.testing import AsyncHTTPTestCase
+
+from pilbox.test.handler_test import _HandlerTestMixin, b64
+
+
+class HealthHandlerTest(_HandlerTestMixin, AsyncHTTPTestCase):
+    def get_app_settings(self):
+        return dict(timeout=10.0, max_requests=4, render_threads=1,
+                    max_render_queue=2)
+
+    def fetch_json(self, path, code=200):
+        resp = self.fetch(path)
+        self.assertEqual(resp.code, code)
+        self.assertEqual(resp.headers.get("Cache-Control"), "no-cache")
+        return tornado.escape.json_decode(resp.body)
+
+    def test_health(self):
+        self.assertEqual(self.fetch_json("/health")["status"], "ok")
+
+    def test_ready(self):
+        self.fetch_image("/a/bucket/%s" % b64("test1.jpg"))
+        resp = self.fetch_json("/ready")
+        self.assertEqual(resp["status"], "ready")
+        self.assertEqual(resp["reasons"], [])
+        self.assertEqual(resp["in_flight"], 0)
+        self.assertEqual(resp["render_queue"], 0)
+        self.assertEqual(resp["pixel_memory"], 0)
+
+    def test_saturated_in_flight(self):
+        self._app.in_flight = 4
+        resp = self.fetch_json("/ready", 503)
+        self.assertEqual(resp["status"], "saturated")
+        self.assertEqual(resp["reasons"], ["in_flight"])
+        self.assertEqual(self._app.metrics.counters["ready.saturated"], 1)
+
+    def test_saturated_render_queue(self):
+        self._app.renders = 3
+        self.assertEqual(self.fetch_json("/ready")["render_queue"], 2)
+        self._app.renders = 4
+        resp = self.fetch_json("/ready", 503)
+        self.assertEqual(resp["reasons"], ["render_queue"])
+
+    def test_saturated_pixel_memory(self):
+        self._app.pixel_budget.waiters.append(None)
+        resp = self.fetch_json("/ready", 503)
+        self.assertEqual(resp["reasons"], ["pixel_memory"])
+
+    def test_ready_while_rendering(self):
+        started, release = threading.Event(), threading.Event()
+
+        def block():
+            started.set()
+            release.wait()
+        self._app.executor.submit(block)
+        started.wait()
+        try:
+            resp = self.fetch_json("/ready")
+        finally:
+            release.set()
+        self.assertEqual(resp["status"], "ready")
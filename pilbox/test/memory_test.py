@@ -0,0 +1,107 @@
+from __future__ import absolute_import, division, with_statement
+
+import os.path
+import shutil
+import tempfile
+
+import tornado.escape
+from tornado.test.util import unittest
+from tornado.testing import AsyncHTTPTestCase
+
+from pilbox import errors, memory
+from pilbox.accesslog import read_records
+from pilbox.memory import PeakTracker, get_max_rss, get_rss, tracemalloc
+from pilbox.signature import sign
+from pilbox.test.handler_test import _HandlerTestMixin, b64
+
+
+@unittest.skipIf(tracemalloc is None, "tracemalloc is not available")
+class PeakTrackerTest(unittest.TestCase):
+    def setUp(self):
+        tracemalloc.start()
+
+    def tearDown(self):
+        tracemalloc.stop()
+
+    def test_peak(self):
+        tracker = PeakTracker()
+        token = tracker.begin()
+        data = b"x" * (1024 * 1024)
+        del data
+        peak = tracker.end(token)
+        self.assertTrue(peak >= 1024 * 1024, peak)
+        self.assertEqual(tracker.max_peak, peak)
+        self.assertEqual(tracker.active, 0)
+
+    def test_not_tracing(self):
+        tracemalloc.stop()
+        tracker = PeakTracker()
+        self.assertEqual(tracker.end(tracker.begin()), None)
+
+
+class RssTest(unittest.TestCase):
+    def test_rss(self):
+        rss = get_rss()
+        if rss is not None:
+            self.assertTrue(rss > 0)
+        max_rss = get_max_rss()
+        if max_rss is not None and rss is not None:
+            self.assertTrue(max_rss >= rss)
+
+
+@unittest.skipIf(tracemalloc is None, "tracemalloc is not available")
+class MemoryHandlerTest(_HandlerTestMixin, AsyncHTTPTestCase):
+    def setUp(self):
+        self.log_dir = tempfile.mkdtemp()
+        super(MemoryHandlerTest, self).setUp()
+
+    def get_app_settings(self):
+        return dict(timeout=10.0, admin_key="abc",
+                    access_log=os.path.join(self.log_dir, "access.log"))
+
+    def tearDown(self):
+        tracemalloc.stop()
+        super(MemoryHandlerTest, self).tearDown()
+        shutil.rmtree(self.log_dir)
+
+    def memory(self, qs):
+        resp = self.fetch("/debug/memory?%s" % sign("abc", qs))
+        self.assertEqual(resp.code, 200)
+        return tornado.escape.json_decode(resp.body)
+
+    def test_status(self):
+        resp = self.memory("action=status")
+        self.assertFalse(resp["tracing"])
+        self.assertTrue("rss" in resp)
+
+    def test_snapshot_and_diff(self):
+        self.assertTrue(self.memory("action=start")["tracing"])
+        resp = self.memory("action=snapshot&limit=5")
+        self.assertTrue(len(resp["sites"]) <= 5)
+        self.fetch_image("/a/bucket/%s" % b64("test1.jpg"))
+        resp = self.memory("action=diff&limit=5&group=filename")
+        self.assertTrue(all("size_diff" in site for site in resp["sites"]))
+        self.assertTrue(resp["request_peak"] > 0)
+        self.assertFalse(self.memory("action=stop")["tracing"])
+
+    def test_snapshot_not_tracing(self):
+        resp = self.fetch("/debug/memory?%s" % sign("abc", "action=snapshot"))
+        self.assertEqual(resp.code, 400)
+
+    def test_request_peak_logged(self):
+        self.memory("action=start")
+        self.fetch_image("/a/bucket/%s" % b64("test1.jpg"))
+        self._app.access_log.close()
+        with open(self._app.settings["access_log"]) as f:
+            record, = read_records(f)
+        self.assertTrue(record["memory_peak"] > 0)
+
+    def test_unavailable(self):
+        memory.tracemalloc = None
+        try:
+            resp = self.fetch("/debug/memory?%s" % sign("abc", "action=start"))
+        finally:
+            memory.tracemalloc = tracemalloc
+        self.assertEqual(resp.code, 404)
+        body = tornado.escape.json_decode(resp.body)
+        self.assertEqual(body["error_code"], errors.DisabledError.get_code())
@@ -0,0 +1,196 @@
+from __future__ import absolute_import, division, with_statement
+
+import tornado.concurrent
+import tornado.gen
+import tornado.httpclient
+import tornado.ioloop
+import tornado.web
+from tornado.test.util import unittest
+from tornado.testing import AsyncHTTPTestCase, gen_test
+
+from pilbox.metrics import Metrics
+from pilbox.origin import HedgeBudget, LatencyTracker, OriginFetcher
+
+
+def sleep(seconds):
+    future = tornado.concurrent.Future()
+    io_loop = tornado.ioloop.IOLoop.current()
+    io_loop.add_timeout(io_loop.time() + seconds,
+                        lambda: future.set_result(None))
+    return future
+
+
+class _OriginHandler(tornado.web.RequestHandler):
+    """Delays the response to the first request for each name."""
+
+    def initialize(self, seen, finished):
+        self.seen = seen
+        self.finished = finished
+
+    @tornado.gen.coroutine
+    def get(self, name, delay):
+        count = self.seen.get(name, 0)
+        self.seen[name] = count + 1
+        if not count:
+            yield sleep(float(delay))
+        self.finish(("%s-%d" % (name, count)).encode("utf-8"))
+        self.finished.append(name)
+
+
+class _FlakyHandler(tornado.web.RequestHandler):
+    """Fails the first request for each name after first seconds, answers
+    the others with code after later seconds."""
+
+    def initialize(self, seen):
+        self.seen = seen
+
+    @tornado.gen.coroutine
+    def get(self, name, first, later, code):
+        count = self.seen.get(name, 0)
+        self.seen[name] = count + 1
+        if not count:
+            yield sleep(float(first))
+            raise tornado.web.HTTPError(503)
+        yield sleep(float(later))
+        self.set_status(int(code))
+        self.finish(("%s-%d" % (name, count)).encode("utf-8"))
+
+
+class LatencyTrackerTest(unittest.TestCase):
+    def test_too_few_samples(self):
+        tracker = LatencyTracker(min_samples=5)
+        for i in range(4):
+            tracker.add(i)
+        self.assertEqual(tracker.percentile(95), None)
+
+    def test_percentile(self):
+        tracker = LatencyTracker(min_samples=1, refresh=1)
+        for i in range(100):
+            tracker.add(i)
+        self.assertEqual(tracker.percentile(95), 95)
+        self.assertEqual(tracker.percentile(50), 50)
+
+    def test_rolling_window(self):
+        tracker = LatencyTracker(size=10, min_samples=1, refresh=1)
+        for i in range(100):
+            tracker.add(i)
+        self.assertEqual(tracker.percentile(0), 90)
+
+
+class HedgeBudgetTest(unittest.TestCase):
+    def test_ratio(self):
+        budget = HedgeBudget(0.25)
+        hedges = 0
+        for _ in range(100):
+            budget.deposit()
+            hedges += budget.withdraw()
+        self.assertEqual(hedges, 25)
+
+    def test_burst(self):
+        budget = HedgeBudget(1, burst=2)
+        for _ in range(10):
+            budget.deposit()
+        self.assertTrue(budget.withdraw())
+        self.assertTrue(budget.withdraw())
+        self.assertFalse(budget.withdraw())
+
+
+class OriginFetcherTest(AsyncHTTPTestCase):
+    def get_app(self):
+        self.seen = dict()
+        self.finished = []
+        return tornado.web.Application([
+            (r"/([\w-]+)/([\d.]+)", _OriginHandler,
+             dict(seen=self.seen, finished=self.finished)),
+            (r"/flaky/([\w-]+)/([\d.]+)/([\d.]+)/(\d+)", _FlakyHandler,
+             dict(seen=self.seen))])
+
+    @tornado.gen.coroutine
+    def wait_finished(self, count):
+        while len(self.finished) < count:
+            yield sleep(0.01)
+
+    @gen_test
+    def test_no_hedge(self):
+        fetcher = OriginFetcher()
+        resp = yield fetcher.fetch(self.http_client, self.get_url("/a/0.1"))
+        self.assertEqual(resp.body, b"a-0")
+
+    @gen_test
+    def test_hedge_wins(self):
+        metrics = Metrics()
+        fetcher = OriginFetcher(hedge=True, delay=0.05, ratio=1,
+                                metrics=metrics)
+        resp = yield fetcher.fetch(self.http_client, self.get_url("/b/0.5"))
+        self.assertEqual(resp.body, b"b-1")
+        self.assertEqual(metrics.counters["origin.hedges"], 1)
+        self.assertEqual(metrics.counters["origin.hedge_wins"], 1)
+        # The slow request is abandoned once it answers
+        yield self.wait_finished(2)
+
+    @gen_test
+    def test_hedge_outlives_failure(self):
+        # The first request fails while the hedge is still in flight
+        metrics = Metrics()
+        fetcher = OriginFetcher(hedge=True, delay=0.05, ratio=1,
+                                metrics=metrics)
+        resp = yield fetcher.fetch(self.http_client,
+                                   self.get_url("/flaky/f/0.1/0.2/200"))
+        self.assertEqual(resp.body, b"f-1")
+        self.assertEqual(metrics.counters["origin.hedge_wins"], 1)
+
+    @gen_test
+    def test_all_failed(self):
+        fetcher = OriginFetcher(hedge=True, delay=0.05, ratio=1)
+        try:
+            yield fetcher.fetch(self.http_client,
+                                self.get_url("/flaky/g/0.1/0.2/404"))
+        except tornado.httpclient.HTTPError as e:
+            self.assertEqual(e.code, 404)
+        else:
+            self.fail("HTTPError not raised")
+        self.assertEqual(self.seen["g"], 2)
+
+    @gen_test
+    def test_fast_failure_not_hedged(self):
+        metrics = Metrics()
+        fetcher = OriginFetcher(hedge=True, delay=0.1, ratio=1,
+                                metrics=metrics)
+        try:
+            yield fetcher.fetch(self.http_client,
+                                self.get_url("/flaky/h/0/0/200"))
+        except tornado.httpclient.HTTPError as e:
+            self.assertEqual(e.code, 503)
+        else:
+            self.fail("HTTPError not raised")
+        yield sleep(0.2)
+        self.assertEqual(metrics.counters["origin.hedges"], 0)
+
+    @gen_test
+    def test_fast_not_hedged(self):
+        metrics = Metrics()
+        fetcher = OriginFetcher(hedge=True, delay=0.5, ratio=1,
+                                metrics=metrics)
+        self.seen["c"] = 1
+        resp = yield fetcher.fetch(self.http_client, self.get_url("/c/0"))
+        self.assertEqual(resp.body, b"c-1")
+        self.assertEqual(metrics.counters["origin.hedges"], 0)
+
+    @gen_test
+    def test_budget_exhausted(self):
+        metrics = Metrics()
+        fetcher = OriginFetcher(hedge=True, delay=0.01, ratio=0.05,
+                                metrics=metrics)
+        resp = yield fetcher.fetch(self.http_client, self.get_url("/d/0.1"))
+        self.assertEqual(resp.body, b"d-0")
+        self.assertEqual(metrics.counters["origin.hedges"], 0)
+        self.assertEqual(metrics.counters["origin.hedges_denied"], 1)
+
+    @gen_test
+    def test_delay_from_percentile(self):
+        fetcher = OriginFetcher(hedge=True, ratio=1)
+        self.assertEqual(fetcher.get_delay(), None)
+        for _ in range(fetcher.latency.min_samples):
+            self.seen["e"] = 1
+            yield fetcher.fetch(self.http_client, self.get_url("/e/0"))
+        self.assertTrue(fetcher.get_delay() < 0.5)
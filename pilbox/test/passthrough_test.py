@@ -0,0 +1,116 @@
+from __future__ import absolute_import, division, with_statement
+
+import os.path
+import struct
+
+import PIL.Image
+from tornado.test.util import unittest
+
+from pilbox.app import render
+from pilbox.image import Image, strip_jpeg_metadata
+from pilbox.test.benchmark import DATADIR
+
+try:
+    from io import BytesIO
+except ImportError:
+    from cStringIO import StringIO as BytesIO
+
+
+def _segment(marker, payload):
+    return struct.pack(">BBH", 0xFF, marker, len(payload) + 2) + payload
+
+
+def _jpeg(size=(80, 60), mode="RGB", exif=None, icc_profile=None,
+          comment=False):
+    outfile = BytesIO()
+    kwargs = dict()
+    if exif:
+        kwargs["exif"] = exif
+    if icc_profile:
+        kwargs["icc_profile"] = icc_profile
+    PIL.Image.new(mode, size, "red").save(outfile, "JPEG", **kwargs)
+    data = outfile.getvalue()
+    if comment:
+        data = data[:2] + _segment(0xFE, b"a comment") + data[2:]
+    return data
+
+
+def _exif(orientation):
+    # Little endian TIFF header with a single orientation entry
+    ifd = struct.pack("<HHHIHHI", 1, 0x0112, 3, 1, orientation, 0, 0)
+    return b"Exif\x00\x00" + b"II*\x00" + struct.pack("<I", 8) + ifd
+
+
+class StripMetadataTest(unittest.TestCase):
+    def test_strips_exif_and_comments(self):
+        data = _jpeg(exif=_exif(1), comment=True)
+        stripped = strip_jpeg_metadata(data)
+        self.assertTrue(len(stripped) < len(data))
+        self.assertFalse(b"Exif" in stripped)
+        self.assertFalse(b"a comment" in stripped)
+
+    def test_keeps_icc_profile(self):
+        data = _jpeg(icc_profile=b"not a real profile")
+        stripped = strip_jpeg_metadata(data)
+        img = PIL.Image.open(BytesIO(stripped))
+        self.assertEqual(img.info.get("icc_profile"), b"not a real profile")
+
+    def test_image_data_unchanged(self):
+        data = _jpeg(exif=_exif(1))
+        original = PIL.Image.open(BytesIO(data))
+        stripped = PIL.Image.open(BytesIO(strip_jpeg_metadata(data)))
+        self.assertEqual(list(original.getdata()), list(stripped.getdata()))
+
+    def test_not_jpeg(self):
+        self.assertEqual(strip_jpeg_metadata(b"GIF89a"), b"GIF89a")
+
+    def test_truncated(self):
+        data = _jpeg()[:30]
+        self.assertEqual(strip_jpeg_metadata(data), data)
+
+
+class PassthroughTest(unittest.TestCase):
+    def test_small_jpeg(self):
+        image = Image(BytesIO(_jpeg()))
+        self.assertTrue(image.can_passthrough(100, 100))
+
+    def test_large_jpeg(self):
+        image = Image(BytesIO(_jpeg(size=(120, 60))))
+        self.assertFalse(image.can_passthrough(100, 100))
+
+    def test_not_jpeg(self):
+        with open(os.path.join(DATADIR, "test2.png"), "rb") as f:
+            image = Image(BytesIO(f.read()))
+        self.assertFalse(image.can_passthrough(1000, 1000))
+
+    def test_cmyk(self):
+        image = Image(BytesIO(_jpeg(mode="CMYK")))
+        self.assertFalse(image.can_passthrough(100, 100))
+
+    def test_orientation(self):
+        image = Image(BytesIO(_jpeg(exif=_exif(6))))
+        self.assertFalse(image.can_passthrough(100, 100))
+        self.assertTrue(image.can_passthrough(100, 100, strip=True))
+        image = Image(BytesIO(_jpeg(exif=_exif(1))))
+        self.assertTrue(image.can_passthrough(100, 100))
+
+    def test_render_returns_original(self):
+        data = _jpeg(exif=_exif(1), comment=True)
+        rv = render(BytesIO(data), 100, 100, passthrough=True)
+        self.assertEqual(rv.read(), data)
+
+    def test_render_strips(self):
+        data = _jpeg(exif=_exif(1), comment=True)
+        rv = render(BytesIO(data), 100, 100, passthrough=True,
+                    strip_metadata=True)
+        self.assertEqual(rv.read(), strip_jpeg_metadata(data))
+
+    def test_render_without_passthrough(self):
+        data = _jpeg(exif=_exif(1), comment=True)
+        rv = render(BytesIO(data), 100, 100)
+        self.assertNotEqual(rv.read(), data)
+
+    def test_render_large(self):
+        data = _jpeg(size=(300, 200))
+        img = PIL.Image.open(render(BytesIO(data), 100, 100, passthrough=True))
+        self.assertEqual(img.size, (100, 67))
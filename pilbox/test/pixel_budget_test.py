@@ -0,0 +1,86 @@
+from __future__ import absolute_import, division, with_statement
+
+import os.path
+
+from tornado.test.util import unittest
+from tornado.testing import AsyncTestCase, gen_test
+
+from pilbox import errors
+from pilbox.image import Image, PixelBudget
+
+
+DATADIR = os.path.join(os.path.dirname(__file__), "data")
+
+
+class DecodeSizeTest(unittest.TestCase):
+    def test_rgb_takes_four_bytes(self):
+        with open(os.path.join(DATADIR, "test1.jpg"), "rb") as f:
+            image = Image(f)
+            width, height = image._header.size
+            self.assertEqual(image.get_decode_size(), width * height * 4)
+
+
+class PixelBudgetTest(AsyncTestCase):
+    @gen_test
+    def test_reserve_within_limit(self):
+        budget = PixelBudget(100)
+        yield budget.reserve(60)
+        yield budget.reserve(40)
+        self.assertEqual(budget.current, 100)
+        budget.release(60)
+        self.assertEqual(budget.current, 40)
+        self.assertEqual(budget.peak, 100)
+
+    @gen_test
+    def test_waits_for_release(self):
+        budget = PixelBudget(100)
+        yield budget.reserve(60)
+        future = budget.reserve(60)
+        self.assertFalse(future.done())
+        budget.release(60)
+        yield future
+        self.assertEqual(budget.current, 60)
+        self.assertEqual(budget.peak, 60)
+
+    @gen_test
+    def test_granted_in_order(self):
+        budget = PixelBudget(100)
+        yield budget.reserve(90)
+        first = budget.reserve(50)
+        second = budget.reserve(10)
+        self.assertFalse(second.done())
+        budget.release(90)
+        self.assertTrue(first.done())
+        self.assertTrue(second.done())
+
+    @gen_test
+    def test_oversized_reserved_alone(self):
+        budget = PixelBudget(100)
+        yield budget.reserve(10)
+        future = budget.reserve(500)
+        self.assertFalse(future.done())
+        budget.release(10)
+        yield future
+        self.assertEqual(budget.current, 500)
+
+    @gen_test
+    def test_timeout(self):
+        budget = PixelBudget(100)
+        yield budget.reserve(100)
+        with self.assertRaises(errors.PixelMemoryError):
+            yield budget.reserve(1, timeout=0.01)
+        self.assertEqual(len(budget.waiters), 0)
+        self.assertEqual(budget.current, 100)
+
+    @gen_test
+    def test_fail_immediately(self):
+        budget = PixelBudget(100)
+        yield budget.reserve(100)
+        with self.assertRaises(errors.PixelMemoryError):
+            yield budget.reserve(1, timeout=0)
+
+    @gen_test
+    def test_unlimited(self):
+        budget = PixelBudget(0)
+        yield [budget.reserve(10 ** 9), budget.reserve(10 ** 9)]
+        self.assertEqual(budget.peak, 2 * 10 ** 9)
@@ -0,0 +1,116 @@
+from __future__ import absolute_import, division, with_statement
+
+import marshal
+import threading
+
+import tornado.gen
+from tornado.test.util import unittest
+from tornado.testing import AsyncHTTPTestCase, gen_test
+
+from pilbox import errors
+from pilbox.profiler import StackSampler
+from pilbox.signature import sign
+from pilbox.test.handler_test import _HandlerTestMixin, b64
+
+
+def _busy(stopped):
+    while not stopped.is_set():
+        stopped.wait(0.001)
+
+
+class StackSamplerTest(unittest.TestCase):
+    def test_sample(self):
+        stopped = threading.Event()
+        thread = threading.Thread(target=_busy, args=(stopped,),
+                                  name="worker-3")
+        thread.start()
+        try:
+            sampler = StackSampler()
+            sampler.sample()
+            sampler.sample()
+        finally:
+            stopped.set()
+            thread.join()
+        self.assertEqual(sampler.samples, 2)
+        stacks = [line.rsplit(" ", 1)
+                  for line in sampler.get_collapsed().splitlines()]
+        worker = [(stack, count) for stack, count in stacks
+                  if stack.startswith("worker;")]
+        self.assertEqual(len(worker), 1)
+        self.assertTrue("profiler_test.py:_busy" in worker[0][0])
+        self.assertEqual(worker[0][1], "2")
+
+
+class ProfileHandlerTest(_HandlerTestMixin, AsyncHTTPTestCase):
+    def get_app_settings(self):
+        return dict(timeout=10.0, admin_key="abc", max_profile_seconds=1)
+
+    def profile(self, qs):
+        return self.http_client.fetch(
+            self.get_url("/debug/profile?%s" % sign("abc", qs)),
+            raise_error=False)
+
+    @gen_test
+    def test_sample(self):
+        profile = self.profile("seconds=0.3")
+        yield self.http_client.fetch(
+            self.get_url("/a/bucket/%s" % b64("test1.jpg")))
+        resp = yield profile
+        self.assertEqual(resp.code, 200)
+        self.assertTrue(b"MainThread;" in resp.body)
+        self.assertTrue(resp.headers["X-Pilbox-Pid"])
+
+    @gen_test
+    def test_cprofile(self):
+        profile = self.profile("seconds=0.3&mode=cprofile")
+        yield self.http_client.fetch(
+            self.get_url("/a/bucket/%s" % b64("test1.jpg")))
+        resp = yield profile
+        self.assertEqual(resp.code, 200)
+        self.assertTrue(b"cumulative" in resp.body)
+        self.assertTrue(b"render_image" in resp.body)
+
+    @gen_test
+    def test_pstats(self):
+        resp = yield self.profile("seconds=0.1&mode=cprofile&format=pstats")
+        self.assertEqual(resp.code, 200)
+        self.assertTrue(isinstance(marshal.loads(resp.body), dict))
+
+    @gen_test
+    def test_busy(self):
+        first = self.profile("seconds=0.3")
+        yield tornado.gen.moment
+        resp = yield self.profile("seconds=0.1")
+        self.assertEqual(resp.code, 503)
+        self.assertTrue(str(errors.ProfilerBusyError.get_code()).encode()
+                        in resp.body)
+        yield first
+
+    @gen_test
+    def test_too_long(self):
+        resp = yield self.profile("seconds=5")
+        self.assertEqual(resp.code, 400)
+
+    @gen_test
+    def test_unsigned(self):
+        resp = yield self.http_client.fetch(
+            self.get_url("/debug/profile?seconds=1"), raise_error=False)
+        self.assertEqual(resp.code, 403)
+
+
+class ThreadedProfileHandlerTest(ProfileHandlerTest):
+    def get_app_settings(self):
+        settings = super(ThreadedProfileHandlerTest, self).get_app_settings()
+        settings["render_threads"] = 1
+        return settings
+
+    @gen_test
+    def test_cprofile_render_threads(self):
+        profile = self.profile("seconds=0.3&mode=cprofile&format=pstats")
+        yield self.http_client.fetch(
+            self.get_url("/a/bucket/%s" % b64("test1.jpg")))
+        resp = yield profile
+        self.assertEqual(resp.code, 200)
+        functions = [func for _, _, func in marshal.loads(resp.body)]
+        self.assertTrue("render_image" in functions)
+        self.assertEqual(self._app.render_profiles, None)
@@ -0,0 +1,242 @@
+from __future__ import absolute_import, division, with_statement
+
+import os.path
+import re
+import shutil
+import tempfile
+
+import tornado.escape
+import tornado.web
+from tornado.test.util import unittest
+from tornado.testing import AsyncHTTPTestCase
+
+from pilbox import errors
+from pilbox.cache import MemoryCache, make_key
+from pilbox.purge import IndexedCache, PurgeIndex, get_ban_pattern, \
+    get_group, get_index_dir, get_key_url
+from pilbox.signature import sign
+from pilbox.test.handler_test import _HandlerTestMixin, \
+    _PilboxTestApplication, b64, route_key
+
+
+class PurgeIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.index = PurgeIndex(self.path)
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_add(self):
+        self.index.add("shop", "http://s3/shop/a.jpg", "k1")
+        self.index.add("shop", "http://s3/shop/a.jpg", "k2")
+        self.index.add("shop", "http://s3/shop/a.jpg", "k1")
+        self.assertEqual(self.index.get_keys("shop", "http://s3/shop/a.jpg"),
+                         ["k1", "k2"])
+        self.assertEqual(self.index.get_keys("shop", "http://s3/shop/b.jpg"),
+                         [])
+
+    def test_get_urls(self):
+        self.index.add("shop", "http://s3/shop/a1.jpg", "k1")
+        self.index.add("shop", "http://s3/shop/a2.jpg", "k2")
+        self.index.add("shop", "http://s3/shop/b.jpg", "k3")
+        self.index.add("other", "http://s3/other/a.jpg", "k4")
+        self.assertEqual(sorted(self.index.get_urls("shop")),
+                         ["http://s3/shop/a1.jpg", "http://s3/shop/a2.jpg",
+                          "http://s3/shop/b.jpg"])
+        self.assertEqual(sorted(self.index.get_urls("shop",
+                                                    "http://s3/shop/a")),
+                         ["http://s3/shop/a1.jpg", "http://s3/shop/a2.jpg"])
+        self.assertEqual(self.index.get_urls("missing"), [])
+
+    def test_remove(self):
+        self.index.add("shop", "http://s3/shop/a.jpg", "k1")
+        self.assertTrue(self.index.remove("shop", "http://s3/shop/a.jpg"))
+        self.assertFalse(self.index.remove("shop", "http://s3/shop/a.jpg"))
+        self.assertEqual(self.index.get_urls("shop"), [])
+
+    def test_indexed_cache(self):
+        cache = IndexedCache(MemoryCache(1024), self.index, "http://s3")
+        url = "http://s3/shop/product-pictures/a b.jpg"
+        cache.set(make_key(url, w=100, h=100), b"body")
+        self.assertEqual(cache.get(make_key(url, w=100, h=100)).body, b"body")
+        self.assertEqual(self.index.get_keys("shop", url),
+                         [make_key(url, w=100, h=100)])
+
+
+class PurgeFunctionsTest(unittest.TestCase):
+    def test_get_group(self):
+        self.assertEqual(get_group("http://s3/shop/p/a.jpg", "http://s3"),
+                         "shop")
+        self.assertEqual(get_group("http://example.com/a.jpg", "http://s3"),
+                         "example.com")
+
+    def test_get_key_url(self):
+        url = "http://s3/shop/a.jpg?x=1&y=2"
+        self.assertEqual(get_key_url(make_key(url, w=1, h=1)), url)
+
+    def test_get_index_dir(self):
+        self.assertEqual(get_index_dir("/index", "/cache"), "/index")
+        self.assertEqual(get_index_dir(None, "/cache"),
+                         os.path.join("/cache", "index"))
+        self.assertEqual(get_index_dir(), None)
+
+    def test_ban_pattern(self):
+        path = "/a/shop/%s" % b64("prefix-1.jpg")
+        for kwargs, matches in [
+                (dict(bucket="shop"), True),
+                (dict(bucket="other"), False),
+                (dict(bucket="shop", filename="prefix-1.jpg"), True),
+                (dict(bucket="shop", filename="prefix-2.jpg"), False),
+                (dict(bucket="shop", prefix="prefix-"), True),
+                (dict(bucket="shop", prefix="other-"), False)]:
+            self.assertEqual(bool(re.match(get_ban_pattern(**kwargs), path)),
+                             matches, kwargs)
+        url = "http://example.com/a.jpg"
+        self.assertTrue(re.match(get_ban_pattern(url=url),
+                                 "/c/%s" % b64(url)))
+
+
+class _VarnishHandler(tornado.web.RequestHandler):
+    SUPPORTED_METHODS = ("BAN",)
+
+    def initialize(self, bans):
+        self.bans = bans
+
+    def ban(self):
+        self.bans.append(self.request.headers["X-Ban-Url"])
+
+
+class _PurgeTestApplication(_PilboxTestApplication):
+    def __init__(self, bans, **kwargs):
+        self.bans = bans
+        super(_PurgeTestApplication, self).__init__(**kwargs)
+
+    def get_handlers(self):
+        handlers = [(r"/varnish/", _VarnishHandler, dict(bans=self.bans))]
+        handlers.extend(super(_PurgeTestApplication, self).get_handlers())
+        return handlers
+
+
+class PurgeHandlerTest(_HandlerTestMixin, AsyncHTTPTestCase):
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        super(PurgeHandlerTest, self).setUp()
+
+    def tearDown(self):
+        super(PurgeHandlerTest, self).tearDown()
+        shutil.rmtree(self.cache_dir)
+
+    def get_app(self):
+        self.bans = []
+        return _PurgeTestApplication(self.bans, s3_root=self.get_s3_root(),
+                                     **self.get_app_settings())
+
+    def get_app_settings(self):
+        return dict(timeout=10.0, cache_dir=self.cache_dir, admin_key="abc",
+                    varnish_url=self.get_url("/varnish"))
+
+    def purge(self, qs):
+        resp = self.fetch("/purge?%s" % sign("abc", qs), method="POST",
+                          body=b"")
+        self.assertEqual(resp.code, 200)
+        return tornado.escape.json_decode(resp.body)
+
+    def get_key(self, filename, size=100):
+        url = "%s/shop/product-pictures/%s" % (self.get_s3_root(), filename)
+        return route_key(url, size)
+
+    def test_purge_filename(self):
+        self.fetch_image("/a/shop/%s" % b64("test1.jpg"))
+        self.fetch_image("/b/shop/%s" % b64("test1.jpg"))
+        self.fetch_image("/a/shop/%s" % b64("test2.png"))
+        resp = self.purge("bucket=shop&filename=test1.jpg")
+        self.assertEqual(resp, dict(urls=1, keys=2, peers=None, banned=True))
+        self.assertEqual(self._app.cache.get(self.get_key("test1.jpg")), None)
+        self.assertEqual(self._app.cache.get(
+            self.get_key("test1.jpg", 500)), None)
+        self.assertNotEqual(self._app.cache.get(self.get_key("test2.png")),
+                            None)
+        self.assertEqual(self.bans, [get_ban_pattern(
+            bucket="shop", filename="test1.jpg")])
+
+    def test_purge_prefix(self):
+        self.fetch_image("/a/shop/%s" % b64("test1.jpg"))
+        self.fetch_image("/a/shop/%s" % b64("test2.png"))
+        self.fetch_image("/a/other/%s" % b64("test1.jpg"))
+        resp = self.purge("bucket=shop&prefix=test")
+        self.assertEqual(resp["keys"], 2)
+        resp = self.purge("bucket=other")
+        self.assertEqual(resp["keys"], 1)
+        self.assertEqual(self.purge("bucket=shop")["keys"], 0)
+
+    def test_unsigned(self):
+        resp = self.fetch_error(403, "/purge?bucket=shop", method="POST",
+                                body=b"")
+        self.assertEqual(resp["error_code"], errors.SignatureError.get_code())
+
+    def test_body_rejected(self):
+        # Only the query string is signed
+        self.fetch_image("/a/other/%s" % b64("test1.jpg"))
+        qs = sign("abc", "bucket=shop&filename=nothing.jpg")
+        resp = self.fetch_error(400, "/purge?%s" % qs, method="POST",
+                                body=b"bucket=other&filename=test1.jpg")
+        self.assertEqual(resp["error_code"], errors.UrlError.get_code())
+        url = "%s/other/product-pictures/test1.jpg" % self.get_s3_root()
+        self.assertNotEqual(self._app.cache.get(route_key(url)), None)
+
+    def test_missing_bucket(self):
+        resp = self.fetch_error(400, "/purge?%s" % sign("abc", "prefix=a"),
+                                method="POST", body=b"")
+        self.assertEqual(resp["error_code"], errors.UrlError.get_code())
+
+
+class UnindexedPurgeHandlerTest(_HandlerTestMixin, AsyncHTTPTestCase):
+    def get_app_settings(self):
+        return dict(timeout=10.0, shm_cache_size=4 * 1024 * 1024,
+                    admin_key="abc")
+
+    def purge(self, qs, code=200):
+        resp = self.fetch("/purge?%s" % sign("abc", qs), method="POST",
+                          body=b"")
+        self.assertEqual(resp.code, code)
+        return tornado.escape.json_decode(resp.body)
+
+    def get_key(self, filename, size=100):
+        url = "%s/shop/product-pictures/%s" % (self.get_s3_root(), filename)
+        return route_key(url, size)
+
+    def test_purge_filename(self):
+        self.assertEqual(self._app.index, None)
+        self.fetch_image("/a/shop/%s" % b64("test1.jpg"))
+        self.fetch_image("/b/shop/%s" % b64("test1.jpg"))
+        self.fetch_image("/a/shop/%s" % b64("test2.png"))
+        resp = self.purge("bucket=shop&filename=test1.jpg")
+        self.assertEqual(resp["keys"], 2)
+        self.assertEqual(self._app.cache.get(self.get_key("test1.jpg")), None)
+        self.assertEqual(self._app.cache.get(
+            self.get_key("test1.jpg", 500)), None)
+        self.assertNotEqual(self._app.cache.get(self.get_key("test2.png")),
+                            None)
+        self.assertEqual(
+            self.purge("bucket=shop&filename=test1.jpg")["keys"], 0)
+
+    def test_purge_url(self):
+        self.fetch_image("/a/shop/%s" % b64("test1.jpg"))
+        url = "%s/shop/product-pictures/test1.jpg" % self.get_s3_root()
+        self.assertEqual(self.purge("url=%s" % url)["keys"], 1)
+        self.assertEqual(self._app.cache.get(self.get_key("test1.jpg")), None)
+
+    def test_prefix_refused(self):
+        self.fetch_image("/a/shop/%s" % b64("test1.jpg"))
+        for qs in ("bucket=shop&prefix=test", "bucket=shop"):
+            resp = self.purge(qs, 404)
+            self.assertEqual(resp["error_code"],
+                             errors.DisabledError.get_code())
+
+
+class DisabledPurgeHandlerTest(_HandlerTestMixin, AsyncHTTPTestCase):
+    def test_disabled(self):
+        resp = self.fetch_error(403, "/purge?%s" % sign("", "bucket=shop"),
+                                method="POST", body=b"")
+        self.assertEqual(resp["error_code"], errors.SignatureError.get_code())
@@ -0,0 +1,147 @@
+from __future__ import absolute_import, division, with_statement
+
+import os.path
+
+import PIL.Image
+from tornado.test.util import unittest
+
+from pilbox.backend import PillowBackend
+from pilbox.image import Image
+from pilbox.test.benchmark import DATADIR, iter_expected_clips, psnr
+
+try:
+    from io import BytesIO
+except ImportError:
+    from cStringIO import StringIO as BytesIO
+
+
+def _open(filename, upscale=1):
+    img = PIL.Image.open(os.path.join(DATADIR, filename))
+    fmt = img.format
+    if upscale > 1:
+        size = (img.size[0] * upscale, img.size[1] * upscale)
+        img = img.resize(size, PIL.Image.BICUBIC)
+    outfile = BytesIO()
+    img.save(outfile, fmt)
+    outfile.seek(0)
+    return outfile
+
+
+class FastResampleTest(unittest.TestCase):
+    def test_reduces_large_ratios(self):
+        img = PIL.Image.open(_open("test2.png", upscale=4))
+        img = PillowBackend()._reduce(img, (100, 100))
+        # 1600x2132 to fit 100x100 is reduced by 8 to stay above 2x
+        self.assertEqual(img.size[0], 200)
+        self.assertTrue(img.size[1] in (266, 267))
+
+    def test_keeps_small_ratios(self):
+        img = PIL.Image.open(_open("test2.png"))
+        img = PillowBackend()._reduce(img, (300, 300))
+        self.assertEqual(img.size, (400, 533))
+
+    def test_skips_palette(self):
+        img = PIL.Image.open(_open("test5.gif", upscale=4))
+        img = PillowBackend()._reduce(img, (100, 100))
+        self.assertEqual(img.size, (2400, 1552))
+
+    def test_same_size_as_quality(self):
+        for filename in ["test1.jpg", "test2.png", "test4.webp", "test5.gif"]:
+            quality = Image(_open(filename, upscale=4)).resize(100, 100)
+            fast = Image(_open(filename, upscale=4)).resize(
+                100, 100, fast=True)
+            self.assertEqual(quality.img.size, fast.img.size)
+
+    def test_close_to_quality(self):
+        for filename in ["test2.png", "test4.webp"]:
+            quality = Image(_open(filename, upscale=4)).resize(100, 100)
+            fast = Image(_open(filename, upscale=4)).resize(
+                100, 100, fast=True)
+            self.assertTrue(psnr(quality.img, fast.img) > 35)
+
+    def test_close_to_expected(self):
+        """Fast output must be as close to the expected clip outputs as the
+        quality output, within a small perceptual tolerance."""
+        for source_path, expected_path, w, h in iter_expected_clips():
+            expected = PIL.Image.open(expected_path)
+            with open(source_path, "rb") as f:
+                data = f.read()
+            quality = Image(BytesIO(data)).resize(w, h)
+            fast = Image(BytesIO(data)).resize(w, h, fast=True)
+            self.assertTrue(
+                psnr(fast.img, expected) > psnr(quality.img, expected) - 1,
+                os.path.basename(expected_path))
+
+
+def _encode(img, fmt):
+    outfile = BytesIO()
+    img.save(outfile, fmt)
+    outfile.seek(0)
+    return outfile
+
+
+def _transparent(size=(400, 300)):
+    """Returns an RGBA image, red on the left and transparent on the
+    right."""
+    img = PIL.Image.new("RGBA", size, (0, 0, 0, 0))
+    img.paste((255, 0, 0, 255), (0, 0, size[0] // 2, size[1]))
+    return img
+
+
+class ConversionTest(unittest.TestCase):
+    def _resize(self, stream, fast=False):
+        outfile = Image(stream).resize(100, 100, fast=fast).save()
+        img = PIL.Image.open(outfile)
+        self.assertEqual(img.format, "JPEG")
+        return img
+
+    def test_palette(self):
+        for fast in (False, True):
+            img = self._resize(_open("test5.gif", upscale=4), fast)
+            self.assertEqual(img.mode, "RGB")
+            self.assertEqual(img.size, (100, 65))
+
+    def test_palette_fast_reduces_before_converting(self):
+        img = PIL.Image.open(_open("test5.gif", upscale=4))
+        img = PillowBackend()._reduce_palette(img, (100, 100))
+        self.assertEqual(img.mode, "P")
+        self.assertEqual(img.size, (342, 221))
+
+    def test_rgba_composited_on_background(self):
+        for fast in (False, True):
+            img = self._resize(_encode(_transparent(), "PNG"), fast)
+            self.assertEqual(img.mode, "RGB")
+            left, right = img.getpixel((5, 37)), img.getpixel((95, 37))
+            self.assertTrue(left[0] > 240 and left[1] < 15, left)
+            self.assertTrue(min(right) > 240, right)
+
+    def test_palette_transparency(self):
+        src = _transparent().convert("RGB").convert("P")
+        src.info["transparency"] = src.getpixel((399, 0))
+        stream = BytesIO()
+        src.save(stream, "GIF", transparency=src.info["transparency"])
+        stream.seek(0)
+        img = self._resize(stream)
+        self.assertTrue(min(img.getpixel((95, 37))) > 240)
+
+    def test_cmyk(self):
+        src = PIL.Image.open(_open("test1.jpg", upscale=4))
+        cmyk = _encode(src.convert("CMYK"), "JPEG")
+        img = self._resize(cmyk)
+        self.assertEqual(img.mode, "RGB")
+
+        expected = src.convert("RGB")
+        expected.thumbnail((100, 100), PIL.Image.ANTIALIAS)
+        self.assertEqual(img.size, expected.size)
+        self.assertTrue(psnr(img, expected) > 30)
+
+    def test_cmyk_resized_before_converting(self):
+        src = PIL.Image.open(_open("test1.jpg", upscale=4)).convert("CMYK")
+        img = PillowBackend().thumbnail(
+            PIL.Image.open(_encode(src, "JPEG")), (100, 100))
+        self.assertEqual(img.mode, "CMYK")
+
+    def test_save_without_resize(self):
+        img = PIL.Image.open(Image(_encode(_transparent(), "PNG")).save())
+        self.assertEqual(img.mode, "RGB")
+        self.assertEqual(img.size, (400, 300))
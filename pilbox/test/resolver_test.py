@@ -0,0 +1,94 @@
+from __future__ import absolute_import, division, with_statement
+
+import socket
+import time
+
+import tornado.concurrent
+from tornado.testing import AsyncTestCase, gen_test
+
+from pilbox.metrics import Metrics
+from pilbox.resolver import CachingResolver, _Entry
+
+
+class _FakeResolver(object):
+    def __init__(self):
+        self.lookups = []
+        self.error = None
+
+    def resolve(self, host, port, family=socket.AF_UNSPEC):
+        self.lookups.append(host)
+        future = tornado.concurrent.Future()
+        if self.error:
+            future.set_exception(self.error)
+        else:
+            address = "10.0.0.%d" % len(self.lookups)
+            future.set_result([(socket.AF_INET, (address, port))])
+        return future
+
+    def close(self):
+        pass
+
+
+class CachingResolverTest(AsyncTestCase):
+    def setUp(self):
+        super(CachingResolverTest, self).setUp()
+        self.fake = _FakeResolver()
+        self.metrics = Metrics()
+        self.resolver = CachingResolver(resolver=self.fake, ttl=60, grace=300,
+                                        max_entries=2, metrics=self.metrics)
+
+    def age(self, host, seconds):
+        key = (host, 80, socket.AF_UNSPEC)
+        entry = self.resolver.entries[key]
+        self.resolver.entries[key] = _Entry(entry.addresses,
+                                            time.time() - seconds)
+
+    @gen_test
+    def test_cached(self):
+        first = yield self.resolver.resolve("s3.example.com", 80)
+        second = yield self.resolver.resolve("s3.example.com", 80)
+        self.assertEqual(first, second)
+        self.assertEqual(self.fake.lookups, ["s3.example.com"])
+        self.assertEqual(self.metrics.counters["dns.hits"], 1)
+
+    @gen_test
+    def test_expired(self):
+        yield self.resolver.resolve("s3.example.com", 80)
+        self.age("s3.example.com", 61)
+        addresses = yield self.resolver.resolve("s3.example.com", 80)
+        self.assertEqual(addresses[0][1][0], "10.0.0.2")
+
+    @gen_test
+    def test_refreshed_in_background(self):
+        yield self.resolver.resolve("s3.example.com", 80)
+        self.age("s3.example.com", 50)
+        addresses = yield self.resolver.resolve("s3.example.com", 80)
+        # Answered from the cache, the refreshed entry is used next time
+        self.assertEqual(addresses[0][1][0], "10.0.0.1")
+        self.assertEqual(len(self.fake.lookups), 2)
+        addresses = yield self.resolver.resolve("s3.example.com", 80)
+        self.assertEqual(addresses[0][1][0], "10.0.0.2")
+
+    @gen_test
+    def test_stale_on_error(self):
+        yield self.resolver.resolve("s3.example.com", 80)
+        self.age("s3.example.com", 120)
+        self.fake.error = socket.gaierror("Temporary failure")
+        addresses = yield self.resolver.resolve("s3.example.com", 80)
+        self.assertEqual(addresses[0][1][0], "10.0.0.1")
+        self.assertEqual(self.metrics.counters["dns.stale"], 1)
+
+    @gen_test
+    def test_error_after_grace(self):
+        yield self.resolver.resolve("s3.example.com", 80)
+        self.age("s3.example.com", 400)
+        self.fake.error = socket.gaierror("Temporary failure")
+        with self.assertRaises(socket.gaierror):
+            yield self.resolver.resolve("s3.example.com", 80)
+
+    @gen_test
+    def test_max_entries(self):
+        for host in ("a.example.com", "b.example.com", "c.example.com"):
+            yield self.resolver.resolve(host, 80)
+        hosts = [key[0] for key in self.resolver.entries]
+        self.assertEqual(hosts, ["b.example.com", "c.example.com"])
@@ -9,10 +9,31 @@ import textwrap
 from tornado.test.util import unittest
 
 TEST_MODULES = [
+    'pilbox.test.accesslog_test',
     'pilbox.test.app_test',
+    'pilbox.test.backend_test',
+    'pilbox.test.batch_test',
+    'pilbox.test.byte_budget_test',
+    'pilbox.test.cache_test',
+    'pilbox.test.cluster_test',
+    'pilbox.test.deadline_test',
+    'pilbox.test.dedup_test',
     'pilbox.test.errors_test',
+    'pilbox.test.handler_test',
+    'pilbox.test.health_test',
     'pilbox.test.image_test',
+    'pilbox.test.memory_test',
+    'pilbox.test.origin_test',
+    'pilbox.test.passthrough_test',
+    'pilbox.test.pixel_budget_test',
+    'pilbox.test.profiler_test',
+    'pilbox.test.purge_test',
+    'pilbox.test.resize_test',
+    'pilbox.test.resolver_test',
     'pilbox.test.signature_test',
+    'pilbox.test.store_test',
+    'pilbox.test.tracing_test',
+    'pilbox.test.warmup_test',
 ]
 
 
@@ -0,0 +1,106 @@
+from __future__ import absolute_import, division, with_statement
+
+import threading
+
+import tornado.escape
+from tornado.test.util import unittest
+from tornado.testing import AsyncHTTPTestCase
+
+from pilbox import errors
+from pilbox.signature import sign
+from pilbox.test.handler_test import _HandlerTestMixin, b64
+from pilbox.tracing import Tracer, make_trace
+
+
+class TracerTest(unittest.TestCase):
+    def test_keeps(self):
+        tracer = Tracer(threshold=1.0)
+        self.assertFalse(tracer.keeps(200, 0.5))
+        self.assertFalse(tracer.keeps(404, 0.5))
+        self.assertTrue(tracer.keeps(200, 1.0))
+        self.assertTrue(tracer.keeps(499, 0.1))
+        self.assertTrue(tracer.keeps(504, 0.1))
+
+    def test_ring_buffer(self):
+        tracer = Tracer(size=2)
+        for i in range(3):
+            tracer.add(dict(i=i))
+        self.assertEqual(tracer.get_traces(), [dict(i=2), dict(i=1)])
+        self.assertEqual(tracer.get_traces(1), [dict(i=2)])
+
+    def test_make_trace(self):
+        trace = make_trace(10.0, [("decode", 10.5, 10.75),
+                                  ("fetch", 10.0, 10.5)], status=200)
+        self.assertEqual(trace, dict(ts=10.0, status=200, spans=[
+            dict(name="fetch", start=0.0, duration=0.5),
+            dict(name="decode", start=0.5, duration=0.25)]))
+
+
+class TraceHandlerTest(_HandlerTestMixin, AsyncHTTPTestCase):
+    def get_app_settings(self):
+        return dict(timeout=10.0, admin_key="abc", trace_threshold=0.2,
+                    deadline=0.3, render_threads=1)
+
+    def get_traces(self, qs=""):
+        resp = self.fetch("/debug/traces?%s" % sign("abc", qs))
+        self.assertEqual(resp.code, 200)
+        return tornado.escape.json_decode(resp.body)["traces"]
+
+    def test_fast_request_dropped(self):
+        self.fetch_image("/a/bucket/%s" % b64("test1.jpg"))
+        self.assertEqual(self.get_traces(), [])
+
+    def test_slow_request_kept(self):
+        self._app.tracer.threshold = 0
+        path = "/a/bucket/%s" % b64("test1.jpg")
+        self.fetch_image(path)
+        trace, = self.get_traces()
+        self.assertEqual(trace["uri"], path)
+        self.assertEqual(trace["status"], 200)
+        self.assertEqual(trace["error"], None)
+        self.assertEqual([span["name"] for span in trace["spans"]],
+                         ["fetch", "queue", "resize", "encode", "write"])
+        for span in trace["spans"]:
+            self.assertTrue(0 <= span["start"] <= trace["total"])
+            self.assertTrue(0 <= span["duration"] <= trace["total"])
+        self.assertEqual(self._app.metrics.counters["traces.kept"], 1)
+
+    def test_error_kept(self):
+        started, release = threading.Event(), threading.Event()
+
+        def block():
+            started.set()
+            release.wait()
+        self._app.executor.submit(block)
+        started.wait()
+        try:
+            self.fetch_error(504, "/a/bucket/%s" % b64("test1.jpg"))
+        finally:
+            release.set()
+        trace, = self.get_traces()
+        self.assertEqual(trace["status"], 504)
+        self.assertEqual(trace["error"], "Deadline exceeded in queue")
+        self.assertEqual(trace["spans"][-1]["name"], "queue")
+
+    def test_invalid_limit(self):
+        resp = self.fetch("/debug/traces?%s" % sign("abc", "limit=x"))
+        self.assertEqual(resp.code, 400)
+
+    def test_unsigned(self):
+        resp = self.fetch("/debug/traces")
+        self.assertEqual(resp.code, 403)
+        body = tornado.escape.json_decode(resp.body)
+        self.assertEqual(body["error_code"], errors.SignatureError.get_code())
+
+
+class DisabledTraceHandlerTest(_HandlerTestMixin, AsyncHTTPTestCase):
+    def get_app_settings(self):
+        return dict(timeout=10.0, admin_key="abc", trace_threshold=0)
+
+    def test_disabled(self):
+        self.assertEqual(self._app.tracer, None)
+        self.fetch_image("/a/bucket/%s" % b64("test1.jpg"))
+        resp = self.fetch("/debug/traces?%s" % sign("abc", ""))
+        self.assertEqual(resp.code, 404)
+        body = tornado.escape.json_decode(resp.body)
+        self.assertEqual(body["error_code"], errors.DisabledError.get_code())
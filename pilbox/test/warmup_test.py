@@ -0,0 +1,107 @@
+from __future__ import absolute_import, division, with_statement
+
+import json
+import os.path
+import shutil
+import tempfile
+
+import tornado.escape
+from tornado.test.util import unittest
+from tornado.testing import AsyncHTTPTestCase
+
+from pilbox.test.handler_test import _HandlerTestMixin, b64, route_key
+from pilbox.warmup import get_popular, read_popular
+
+
+class PopularTest(unittest.TestCase):
+    def test_get_popular(self):
+        records = [dict(uri="/a/1", status=200), dict(uri="/a/2", status=200),
+                   dict(uri="/a/2", status=200), dict(uri="/a/3", status=404),
+                   dict(uri="/a/3", status=404), dict(status=200)]
+        self.assertEqual(get_popular(records), ["/a/2", "/a/1"])
+        self.assertEqual(get_popular(records, 1), ["/a/2"])
+
+    def test_read_list(self):
+        lines = ["# most popular first\n", "/a/1\n", "\n", "12 /a/2\n",
+                 "/a/3\n"]
+        self.assertEqual(read_popular(lines), ["/a/1", "/a/2", "/a/3"])
+        self.assertEqual(read_popular(lines, 2), ["/a/1", "/a/2"])
+
+    def test_read_access_log(self):
+        lines = [json.dumps(dict(uri=uri, status=200)) + "\n"
+                 for uri in ("/a/1", "/a/2", "/a/2")]
+        self.assertEqual(read_popular(lines), ["/a/2", "/a/1"])
+
+
+class WarmupTest(_HandlerTestMixin, AsyncHTTPTestCase):
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.warmup_file = os.path.join(self.cache_dir, "popular")
+        with open(self.warmup_file, "w") as f:
+            f.write("/a/bucket/%s\n" % b64("test1.jpg"))
+            f.write("/a/bucket/%s\n" % b64("missing.jpg"))
+            f.write("/a/bucket/%s\n" % b64("test3.jpg"))
+        super(WarmupTest, self).setUp()
+
+    def tearDown(self):
+        super(WarmupTest, self).tearDown()
+        shutil.rmtree(self.cache_dir)
+
+    def get_app_settings(self):
+        return dict(timeout=10.0, cache_dir=self.cache_dir,
+                    warmup_file=self.warmup_file, warmup_top=2)
+
+    def get_ready(self, code):
+        resp = self.fetch("/ready")
+        self.assertEqual(resp.code, code)
+        return tornado.escape.json_decode(resp.body)
+
+    def get_cached(self, filename):
+        url = "%s/bucket/product-pictures/%s" % (self.get_s3_root(), filename)
+        return self._app.cache.get(route_key(url))
+
+    def test_warm_up(self):
+        resp = self.get_ready(503)
+        self.assertEqual(resp["status"], "warming")
+        self.assertEqual(resp["reasons"], ["warming"])
+
+        self.io_loop.run_sync(lambda: self._app.warm_up(self.get_url("/")))
+        self.assertTrue(self.get_cached("test1.jpg") is not None)
+        self.assertEqual(self.get_cached("test3.jpg"), None)
+        self.assertEqual(self._app.metrics.counters["warmup.requests"], 2)
+        self.assertEqual(self._app.metrics.counters["warmup.errors"], 1)
+        self.assertEqual(self.get_ready(200)["status"], "ready")
+
+    def test_time_budget(self):
+        self._app.settings["warmup_seconds"] = 0
+        self.io_loop.run_sync(lambda: self._app.warm_up(self.get_url("/")))
+        self.assertFalse(self._app.warming.value)
+        self.assertEqual(self.get_cached("test1.jpg"), None)
+
+    def test_missing_file(self):
+        os.unlink(self.warmup_file)
+        self.io_loop.run_sync(lambda: self._app.warm_up(self.get_url("/")))
+        self.assertFalse(self._app.warming.value)
+
+
+class NoCacheWarmupTest(_HandlerTestMixin, AsyncHTTPTestCase):
+    def setUp(self):
+        fd, self.warmup_file = tempfile.mkstemp()
+        with os.fdopen(fd, "w") as f:
+            f.write("/a/bucket/%s\n" % b64("test1.jpg"))
+        super(NoCacheWarmupTest, self).setUp()
+
+    def tearDown(self):
+        super(NoCacheWarmupTest, self).tearDown()
+        os.unlink(self.warmup_file)
+
+    def get_app_settings(self):
+        return dict(timeout=10.0, warmup_file=self.warmup_file)
+
+    def test_not_warmed_up(self):
+        # Nothing would be kept, so workers are ready at once
+        self.assertFalse(self._app.can_warm_up())
+        resp = self.fetch("/ready")
+        self.assertEqual(resp.code, 200)
+        self.assertEqual(tornado.escape.json_decode(resp.body)["status"],
+                         "ready")
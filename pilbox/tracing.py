@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+#
+# Copyright 2013 Adam Gschwender
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Keeps the traces of slow and failed image requests.
+
+Every image request records the spans of its stages, i.e. fetch, queue,
+decode (unless Pillow decodes while resizing), resize, encode and write,
+as well as store and forward. Which
+requests are kept is decided once they have finished: only those slower
+than the threshold or that failed with a server error. The others are
+dropped, so tracing a fast request costs a few tuples. Kept traces are
+held in a ring buffer in each worker and returned by the traces route,
+newest first, e.g.
+
+    {"ts": 1381442212.61, "uri": "/a/shop/MS5qcGc=", "status": 504,
+     "total": 2.013, "error": "Deadline exceeded in queue",
+     "spans": [{"name": "fetch", "start": 0.001, "duration": 0.041},
+               {"name": "queue", "start": 0.043, "duration": 1.97}]}
+
+Span starts are in seconds since the request started.
+"""
+
+from __future__ import absolute_import, division, print_function, \
+    with_statement
+
+import collections
+
+from pilbox import errors
+from pilbox.admin import AdminHandler
+
+
+class Tracer(object):
+    """Keeps the last size traces of requests that took at least threshold
+    seconds or failed."""
+
+    def __init__(self, threshold=1.0, size=100):
+        self.threshold = threshold
+        self.traces = collections.deque(maxlen=size)
+
+    def keeps(self, status, duration):
+        """Returns whether the trace of a request that finished with status
+        after duration seconds is kept."""
+        return duration >= self.threshold or status >= 500 or status == 499
+
+    def add(self, trace):
+        self.traces.append(trace)
+
+    def get_traces(self, limit=None):
+        """Returns the kept traces, newest first."""
+        traces = list(reversed(self.traces))
+        return traces[:limit] if limit else traces
+
+
+def make_trace(start, spans, **fields):
+    """Returns the trace of a request that started at start with spans,
+    a list of (name, start, end) times, plus fields."""
+    trace = dict(fields, ts=start)
+    trace["spans"] = [dict(name=name, start=round(begin - start, 6),
+                           duration=round(end - begin, 6))
+                      for name, begin, end in sorted(
+                          spans, key=lambda span: span[1])]
+    return trace
+
+
+class TraceHandler(AdminHandler):
+    """Returns the kept traces of this worker, at most limit of them."""
+
+    def get(self):
+        try:
+            limit = int(self.get_query_argument("limit", 0))
+        except ValueError:
+            limit = -1
+        if limit < 0:
+            raise errors.UrlError("Invalid limit")
+        tracer = self.application.tracer
+        if not tracer:
+            raise errors.DisabledError("Tracing is disabled")
+        self.write_json(dict(threshold=tracer.threshold,
+                             traces=tracer.get_traces(limit)))
@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+#
+# Copyright 2013 Adam Gschwender
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Warms the render caches when the server starts.
+
+The popularity file lists the uris of image requests, most popular
+first, one per line and optionally preceded by its number of requests.
+A structured access log, see pilbox.accesslog, can be used as is, in
+which case its most requested uris are warmed; or a list can be made
+from several logs, e.g.
+
+    $ python -m pilbox.warmup --top=1000 access.log.1 access.log > popular
+
+Once the server has forked, the first worker requests the top uris from
+the server itself, so that they take the normal path through the caches,
+the cluster and the store and are spread over all workers. At most
+warmup_concurrency requests are made at once, which bounds the render
+threads the warm-up takes from live traffic, and no more are started
+after warmup_seconds. Until the warm-up has finished, every worker
+answers /ready with 503, see pilbox.health. Without a cache or a store,
+there is nothing to warm and the popularity file is ignored.
+"""
+
+from __future__ import absolute_import, division, print_function, \
+    with_statement
+
+import collections
+import logging
+import time
+
+import tornado.gen
+import tornado.httpclient
+
+from pilbox.accesslog import read_records
+
+logger = logging.getLogger("tornado.application")
+
+
+def get_popular(records, top=None):
+    """Returns the uris of the successful requests among the access log
+    records, most requested first, at most top of them."""
+    counts = collections.Counter()
+    for record in records:
+        if record.get("status") == 200 and record.get("uri") and \
+                record.get("method", "GET") == "GET":
+            counts[record["uri"]] += 1
+    return [uri for uri, _ in counts.most_common(top)]
+
+
+def read_popular(f, top=None):
+    """Returns the uris of the popularity file f, see above, at most top
+    of them."""
+    lines = [line.strip() for line in f]
+    lines = [line for line in lines if line and not line.startswith("#")]
+    if lines and lines[0].startswith("{"):
+        return get_popular(read_records(lines), top)
+    uris = [line.split()[-1] for line in lines]
+    return uris[:top] if top else uris
+
+
+class Warmer(object):
+    """Requests uris from the server at base_url, at most concurrency at
+    once, and starts no more requests after seconds."""
+
+    def __init__(self, base_url, uris, concurrency=2, seconds=60,
+                 timeout=10, metrics=None):
+        self.base_url = base_url.rstrip("/")
+        self.uris = uris
+        self.concurrency = max(1, concurrency)
+        self.seconds = seconds
+        self.timeout = timeout
+        self.metrics = metrics
+        self.requests = 0
+        self.errors = 0
+
+    @tornado.gen.coroutine
+    def run(self):
+        """Returns the number of requests made and of errors once all
+        have finished."""
+        client = tornado.httpclient.AsyncHTTPClient(
+            force_instance=True, max_clients=self.concurrency)
+        deadline = time.time() + self.seconds
+        pending = iter(self.uris)
+        try:
+            yield [self._work(client, pending, deadline)
+                   for _ in range(self.concurrency)]
+        finally:
+            client.close()
+        raise tornado.gen.Return(dict(requests=self.requests,
+                                      errors=self.errors))
+
+    @tornado.gen.coroutine
+    def _work(self, client, pending, deadline):
+        for uri in pending:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return
+            self.requests += 1
+            self._incr("warmup.requests")
+            try:
+                yield client.fetch(self.base_url + uri,
+                                   request_timeout=min(self.timeout,
+                                                       remaining))
+            except Exception as e:
+                logger.warn("Warm-up of %s failed: %s" % (uri, e))
+                self.errors += 1
+                self._incr("warmup.errors")
+
+    def _incr(self, name):
+        if self.metrics:
+            self.metrics.incr(name)
+
+
+def main():
+    """Prints the most requested uris of the access logs given as
+    arguments, for use as a popularity file."""
+    import tornado.options
+    from tornado.options import define, options, parse_command_line
+    define("top", help="number of uris to print, 0 for all", type=int,
+           default=1000)
+    paths = parse_command_line()
+    if not paths:
+        tornado.options.print_help()
+        return
+
+    def records():
+        for path in paths:
+            with open(path) as f:
+                for record in read_records(f):
+                    yield record
+    for uri in get_popular(records(), options.top or None):
+        print(uri)
+
+
+if __name__ == "__main__":
+    main()
@@ -47,6 +47,11 @@ setup(name='pilbox',
         'Pillow==2.4.0',
         'sphinx-me==0.2.1',
         ],
+      entry_points={
+        'console_scripts': [
+            'pilbox-batch = pilbox.batch:main',
+            ],
+        },
       zip_safe=True,
       cmdclass={'test': PilboxTest}
       )